@@ -1,8 +1,13 @@
 import os
 import re
+import json
+import uuid
 import string
 import IPython
 from collections import defaultdict
+from ipynb2catsoop import course_index
+
+SESSION_AUTH = {}	# (api_token, username) for each catsoop urlbase, kept for the kernel session
 
 class CatsoopInterface:
     '''
@@ -59,6 +64,62 @@ class CatsoopInterface:
     </script>
     """
 
+    JS_lazy_load = """
+    <script type="text/javascript">
+        if (typeof(window.cif_lazy_observe)=="undefined"){
+            window.cif_lazy_load = function(iframe){
+                iframe.src = iframe.dataset.src;
+                var start_resize = function(){
+                    if (typeof(iFrameResize)=="undefined"){
+                        setTimeout(start_resize, 100);
+                        return;
+                    }
+                    iFrameResize({log:false, checkOrigin:false}, iframe);
+                }
+                start_resize();
+            };
+            if ("IntersectionObserver" in window){
+                var cif_observer = new IntersectionObserver(function(entries){
+                    entries.forEach(function(entry){
+                        if (entry.isIntersecting){
+                            cif_observer.unobserve(entry.target);
+                            window.cif_lazy_load(entry.target);
+                        }
+                    });
+                }, {rootMargin: "200px"});
+                window.cif_lazy_observe = function(iframe){ cif_observer.observe(iframe); };
+            } else {
+                window.cif_lazy_observe = window.cif_lazy_load;
+            }
+        }
+    </script>
+    """
+
+    JS_lazy_show = """
+        (function(){
+            var iframe = document.getElementById('IFRAME_ID');
+            if (typeof(window.cif_lazy_observe)!="undefined"){
+                window.cif_lazy_observe(iframe);
+                return;
+            }
+            // lazy loading scripts are gone (e.g. page reloaded, or outputs cleared): load now,
+            // loading the iframe resizer script too if it is gone
+            iframe.src = iframe.dataset.src;
+            var resize = function(){ iFrameResize({log:false, checkOrigin:false}, iframe); };
+            if (typeof(iFrameResize)!="undefined"){
+                resize();
+                return;
+            }
+            var script = document.createElement("script");
+            script.src = "https://cdnjs.cloudflare.com/ajax/libs/iframe-resizer/4.3.2/iframeResizer.min.js";
+            script.integrity = "sha512-dnvR4Aebv5bAtJxDunq3eE8puKAJrY9GBJYl9GC6lTOEC76s1dbDfJFcL9GyzpaDW4vlI/UjR8sKbc1j6Ynx6w==";
+            script.crossOrigin = "anonymous";
+            script.referrerPolicy = "no-referrer";
+            script.onload = resize;
+            document.head.appendChild(script);
+        })();
+    """
+
     JS_set_auth = """
     console.log("catsoop interface set_auth loaded")
 
@@ -87,21 +148,29 @@ class CatsoopInterface:
         }
     });
     """    
-    def __init__(self, host=None, course=None, urlbase=None):
+    def __init__(self, host=None, course=None, urlbase=None, lazy=False, timeout=30):
         '''
         Initialize catsoop interface
         host = (str) catsoop hostname
         course = (str) catsoop course number or name
         urlbase = (str) base URL of catsoop instance, including path to course 
                         (used if host & course not specified)
+        lazy = (bool) if True, then questions are only loaded when their iframe scrolls into view,
+                      and the lazy loading scripts are only injected with the first question shown
+                      (questions shown after a browser reload load immediately, without them)
+        timeout = (float) timeout in seconds for JSON requests to catsoop (see get_question and submit)
         '''
-        self.api_token = None
-        self.username = None
         if host and course:
             urlbase = f"https://{host}/{course}"
         urlbase = urlbase or "https://localhost:6010/course"
         self.urlbase = urlbase
-        do_register = "google.colab" in str(get_ipython())	# register callback for js in google colab notebooks
+        self.api_token, self.username = SESSION_AUTH.get(urlbase, (None, None))
+        self.lazy = lazy
+        self.scripts_injected = False
+        self.timeout = timeout
+        self.session = None
+        do_register = "google.colab" in str(IPython.get_ipython())	# register callback for js in google colab notebooks
+        self.in_colab = do_register
         if do_register:
             import google.colab 
             google.colab.output.register_callback('notebook.cif_set_auth', 
@@ -114,12 +183,37 @@ class CatsoopInterface:
         '''
         self.api_token = api_token
         self.username = username
+        SESSION_AUTH[self.urlbase] = (api_token, username)
+
+    def do_auth(self, force=False):
+        '''
+        Authenticate to catsoop.  If an api_token is already known in this kernel session (e.g. from
+        an earlier CatsoopInterface instance for the same catsoop course), then it is checked with
+        a JSON ping (see check_auth), and the authentication iframe is only loaded if that fails.
+        The iframe uses the minimal nbif auth_token action, which does not render a catsoop page.
 
-    def do_auth(self):
-        url = f"{self.urlbase}/nbif?do=auth"
+        force = (bool) if True, then always load the authentication iframe
+        '''
+        if not force and self.api_token and self.check_auth():
+            return IPython.display.HTML(f"You have been authenticated to catsoop as {self.username}")
+        url = f"{self.urlbase}/nbif?do=auth_token"
         html = f'''<script type="text/javascript">{self.JS_set_auth}</script>
-                   <iframe src="{url}" width=700 height=350></iframe>'''
-        return IPython.display.HTML(html)   
+                   <iframe src="{url}" width=700 height=60></iframe>'''
+        return IPython.display.HTML(html)
+
+    def check_auth(self):
+        '''
+        Return True if the current api_token is accepted by catsoop (using the nbif ping action);
+        otherwise forget the token, and return False
+        '''
+        try:
+            data = self.nbif_json("post", do="ping", api_token=self.api_token)
+        except Exception as err:
+            SESSION_AUTH.pop(self.urlbase, None)
+            self.api_token = self.username = None
+            return False
+        self.username = data.get('username', self.username)
+        return True
 
     def print_auth(self):
         if self.api_token and self.username:
@@ -127,17 +221,81 @@ class CatsoopInterface:
         else:
             print(f"Authentication not yet established to {self.urlbase}")
 
-    def show_question(self, page="test_problems", csq_name="sum42", height=50):
+    def question_url(self, page, csq_name):
+        '''
+        Return nbif URL for specified question
+        '''
+        return f"{self.urlbase}/nbif?page={page}&csq_name={csq_name}"
+
+    def show_question(self, page="test_problems", csq_name="sum42", height=50, lazy=None):
         '''
         Display specified (single) question in notebook output cell
         page = (str) catsoop page with questions
         csq_name = (str) name of question to display
         height = (int) height of iframe where question is displayed
+        lazy = (bool) if True, only load the question when it scrolls into view (defaults to self.lazy)
         '''
-        url = f"{self.urlbase}/nbif?page={page}&csq_name={csq_name}"
-        return IPython.display.HTML(f"""{self.JS_iframe_resize}
+        url = self.question_url(page, csq_name)
+        if not (self.lazy if lazy is None else lazy):
+            return IPython.display.HTML(f"""{self.JS_iframe_resize}
                     <iframe src='{url}' width='100%' height='{height}'></iframe>""")
 
+        scripts = ""
+        if self.in_colab or not self.scripts_injected:	# colab isolates each output cell, so always inject there
+            scripts = self.JS_iframe_resize + self.JS_lazy_load
+            self.scripts_injected = True
+        iframe_id = f"cif_{uuid.uuid4().hex[:12]}"
+        return IPython.display.HTML(f"""{scripts}
+                    <iframe id='{iframe_id}' data-src='{url}' width='100%' height='{height}'></iframe>
+                    <script type="text/javascript">{self.JS_lazy_show.replace("IFRAME_ID", iframe_id)}</script>""")
+
+    def http_session(self):
+        '''
+        Return HTTP session shared by all JSON requests to catsoop, so that connections are kept alive
+        '''
+        if self.session is None:
+            import requests
+            self.session = requests.Session()
+        return self.session
+
+    def nbif_json(self, method, **params):
+        '''
+        Make JSON request to the catsoop nbif page, and return the decoded response
+        '''
+        url = f"{self.urlbase}/nbif"
+        if method=="post":
+            ret = self.http_session().post(url, data=params, timeout=self.timeout)
+        else:
+            ret = self.http_session().get(url, params=params, timeout=self.timeout)
+        ret.raise_for_status()
+        data = ret.json()
+        if not data.get('ok'):
+            raise Exception(f"[CatsoopInterface] request to {url} with do={params.get('do')} failed: {data.get('error')}")
+        return data
+
+    def get_question(self, page="test_problems", csq_name="sum42"):
+        '''
+        Return dict with prompt and metadata for specified question (e.g. csq_prompt, csq_initial, qtype)
+        page = (str) catsoop page with questions
+        csq_name = (str) name of question
+        '''
+        data = self.nbif_json("get", do="question_json", page=page, csq_name=csq_name)
+        return data['question']
+
+    def submit(self, page="test_problems", csq_name="sum42", submission=""):
+        '''
+        Submit response to specified question, authenticated using the api_token from do_auth.
+        Returns dict with catsoop's result for the submission.
+        page = (str) catsoop page with questions
+        csq_name = (str) name of question
+        submission = (str) response to submit, e.g. python code for a pythoncode question
+        '''
+        if not self.api_token:
+            raise Exception(f"[CatsoopInterface] Authentication not yet established to {self.urlbase} -- run do_auth() first")
+        data = self.nbif_json("post", do="submit", page=page, csq_name=csq_name, submission=submission,
+                              api_token=self.api_token)
+        return data['result']
+
 #-----------------------------------------------------------------------------
 
 class catsoop2ipynb:
@@ -184,10 +342,53 @@ class catsoop2ipynb:
         code +=  "from ipynb2catsoop.catsoop2nb import CatsoopInterface"
 
         code2  =  "# Evaluate this cell to authenticate to the interactive problems server, after evaluating the cell above\n\n"
-        code2 += f'CIF = CatsoopInterface(host="{self.hostname}", course="{self.course}")\n'
+        code2 += f'CIF = CatsoopInterface(host="{self.hostname}", course="{self.course}", lazy=True)\n'
         code2 +=  'CIF.do_auth()'
         return code, code2
 
+    PAGES_INDEX_FN = ".ipynb2catsoop_pages.json"
+
+    def read_page(self, catsoopfn):
+        '''
+        Return text of catsoop page file.  If the page was split into several catsoop pages by
+        ipynb2catsoop, as recorded in the pages index in its directory, then return the text
+        of all its sub-pages, joined together, without their navigation links.  Question links
+        still use the original page name, which nbif resolves to the right sub-page.
+        '''
+        pdir = os.path.dirname(catsoopfn)
+        index_fn = os.path.join(pdir, self.PAGES_INDEX_FN)
+        fns = [catsoopfn]
+        if os.path.exists(index_fn):
+            with open(index_fn) as fp:
+                index = json.load(fp)
+            for key in [self.page.strip("/"), os.path.basename(os.path.normpath(self.page))]:
+                entries = index.get('pages', {}).get(key)
+                if entries and entries[0]['file']==os.path.basename(catsoopfn):
+                    fns = [os.path.join(pdir, entry['file']) for entry in entries]
+                    break
+        text = []
+        for fn in fns:
+            with open(fn) as fp:
+                text += [line for line in fp.read().split("\n") if not line.startswith('<div class="ipynb2catsoop-nav">')]
+        return "\n".join(text)
+
+    def indexed_question_names(self, catsoopfn):
+        '''
+        Return the csq_names of the named questions on the page, in order, from the course index
+        written by ipynb2catsoop (in the directory containing the page), or None if there is no index,
+        or it is older than the page file (and so may not describe it)
+        '''
+        page = os.path.normpath(self.page)
+        index = course_index.open_index(os.path.dirname(page) or ".")
+        if index is None:
+            return None
+        page_info = index.page(os.path.basename(page))
+        index_mtime = index.mtime
+        index.close()
+        if page_info is None or os.path.getmtime(catsoopfn) > index_mtime:
+            return None
+        return [course_index.normalize_csq_name(name) for name in page_info['questions']]
+
     def convert(self, catsoopfn=None):
         '''
         Generate <ofn> notebook file from <page>/content.md catsoop file
@@ -201,8 +402,8 @@ class catsoop2ipynb:
         if self.verbose:
             print(f"[catsoop2nb] Converting catsoop {catsoopfn} to '{self.ofn}'")
 
-        with open(catsoopfn) as fp:
-            catsoopmd = fp.read()
+        catsoopmd = self.read_page(catsoopfn)
+        indexed_names = self.indexed_question_names(catsoopfn)
         
         nb = nbformat.v4.new_notebook()
 
@@ -241,9 +442,17 @@ class catsoop2ipynb:
             if mode=='qcode':
                 qcode.append(line)
                 if line.startswith("csq_name"):
-                    env = {}
-                    exec(line, env)
-                    this_csq_name = env.get("csq_name")
+                    if indexed_names is not None and counts['n_named_questions'] < len(indexed_names):
+                        # use name from course index (which handles multi-line names)
+                        this_csq_name = indexed_names[counts['n_named_questions']]
+                        counts['n_named_questions'] += 1
+                    else:
+                        env = {}
+                        try:
+                            exec(line, env)
+                        except Exception as err:
+                            pass
+                        this_csq_name = env.get("csq_name")
                 if line.count("</question"):
                     mode = None
                     if not this_csq_name:
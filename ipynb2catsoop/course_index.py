@@ -0,0 +1,190 @@
+'''
+Compact, memory-mappable index of a converted course, written by ipynb2catsoop.write_course_index,
+so that tools (nbif, catsoop2ipynb, stale asset cleanup) can look up units, pages, questions,
+notebooks, and static assets without scanning the course tree.
+
+The index file, {course_dir}/.ipynb2catsoop_index, has a fixed-size header, then an open-addressing
+hash table of fixed-size slots, then the records.  Each record is a (kind, key) pair and a compact
+JSON value; a slot gives the 64-bit hash of the record's kind and key, and the record's offset and
+sizes.  A lookup maps the file, hashes the key, and probes the table, decoding only the record it
+finds.  The file is replaced atomically when rewritten, so readers with the old file open keep a
+consistent view.
+
+Record kinds and values:
+
+    course      ""           {'units': [unit names]}
+    unit        unit name    {'notebooks': [notebook paths], 'pages': [page paths],
+                              'unconverted': [paths of notebooks with no page file]}
+    page        page path    {'unit', 'notebook', 'file', 'title', 'sub_pages': [page paths],
+                              'questions': [csq_names, in page order], 'assets': [referenced asset paths]}
+    question    page path + "\0" + csq_name (normalized, see normalize_csq_name)
+                             {'csq_name' (as on the page), 'page', 'sub_page', 'notebook', 'cell', 'qtype'}
+    notebook    notebook path  {'mtime', 'size', 'questions': [[csq_name, cell number, qtype], ...]}
+    asset       asset path   {'unit', 'sha256', 'size', 'generated' (made by ipynb2catsoop)}
+
+All paths are relative to the course directory.
+'''
+import os
+import re
+import ast
+import json
+import mmap
+import struct
+import hashlib
+
+INDEX_FN = ".ipynb2catsoop_index"
+MAGIC = b"I2CINDX1"
+HEADER = struct.Struct("<8sII")		# magic, number of slots, number of records
+SLOT = struct.Struct("<QQII")		# key hash, record offset, key size, value size
+KINDS = ("course", "unit", "page", "question", "notebook", "asset")
+
+def normalize_csq_name(csq_name):
+    '''
+    Return csq_name without surrounding whitespace and quotes (pythoncode problem names written by
+    ipynb2catsoop keep the quotes and newline of the notebook cell, e.g. '"ex1"\\n')
+    '''
+    return (csq_name or "").strip().strip("'\"").strip()
+
+def question_blocks(text):
+    '''
+    Return list of (qtype, csq_name) for the catsoop questions in text, in order (questions without
+    a csq_name are omitted)
+    '''
+    blocks = []
+    for qtype, qtext in re.findall(r"<question\s*([^>]*)>(.*?)</question>", text, re.DOTALL):
+        try:
+            tree = ast.parse(qtext)
+        except Exception as err:
+            continue
+        for node in tree.body:
+            if (isinstance(node, ast.Assign) and any(getattr(t, 'id', None)=="csq_name" for t in node.targets)
+                and isinstance(node.value, ast.Constant) and isinstance(node.value.value, str)
+                and node.value.value.strip()):
+                blocks.append((qtype.strip() or None, node.value.value))
+    return blocks
+
+def record_key(kind, key):
+    return f"{kind}\0{key}".encode()
+
+def key_hash(kbytes):
+    return int.from_bytes(hashlib.blake2b(kbytes, digest_size=8).digest(), "little")
+
+def write_index(fn, records):
+    '''
+    Write index file fn, atomically, with records given as a dict with (kind, key) keys and
+    JSON-serializable values
+    '''
+    nslots = 8
+    while nslots < 2 * len(records):
+        nslots *= 2
+    slots = [None] * nslots
+    data = []
+    offset = HEADER.size + nslots * SLOT.size
+    for (kind, key), value in sorted(records.items()):
+        kbytes = record_key(kind, key)
+        vbytes = json.dumps(value, separators=(",", ":")).encode()
+        h = key_hash(kbytes)
+        k = h & (nslots - 1)
+        while slots[k] is not None:
+            k = (k + 1) & (nslots - 1)
+        slots[k] = SLOT.pack(h, offset, len(kbytes), len(vbytes))
+        data += [kbytes, vbytes]
+        offset += len(kbytes) + len(vbytes)
+    empty = SLOT.pack(0, 0, 0, 0)
+    tmpfn = f"{fn}.{os.getpid()}.tmp"
+    with open(tmpfn, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, nslots, len(records)))
+        fp.write(b"".join(slot or empty for slot in slots))
+        fp.write(b"".join(data))
+    os.replace(tmpfn, fn)
+
+class CourseIndex:
+    '''
+    Reader for a course index file, which is memory-mapped, so that opening it is cheap, and only
+    the records looked up are read and decoded
+    '''
+    def __init__(self, fn):
+        '''
+        fn = (str) index file path, or course directory containing the index
+        '''
+        if os.path.isdir(fn):
+            fn = os.path.join(fn, INDEX_FN)
+        self.fn = fn
+        with open(fn, 'rb') as fp:
+            stat = os.fstat(fp.fileno())
+            self.mtime = stat.st_mtime
+            self.inode = stat.st_ino
+            self.buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.nslots, self.nrecords = HEADER.unpack_from(self.buf, 0)
+        if magic!=MAGIC:
+            raise Exception(f"[ipynb2catsoop] {fn} is not an ipynb2catsoop course index")
+
+    def is_current(self):
+        '''
+        Return True if the index file has not been replaced since it was opened
+        '''
+        try:
+            stat = os.stat(self.fn)
+        except OSError:
+            return False
+        return (stat.st_mtime, stat.st_ino)==(self.mtime, self.inode)
+
+    def get(self, kind, key, default=None):
+        '''
+        Return value of record (kind, key), or default if there is none
+        '''
+        kbytes = record_key(kind, key)
+        h = key_hash(kbytes)
+        k = h & (self.nslots - 1)
+        while True:
+            shash, offset, ksize, vsize = SLOT.unpack_from(self.buf, HEADER.size + k * SLOT.size)
+            if offset==0:
+                return default
+            if shash==h and self.buf[offset:offset + ksize]==kbytes:
+                return json.loads(self.buf[offset + ksize:offset + ksize + vsize])
+            k = (k + 1) & (self.nslots - 1)
+
+    def items(self, kind):
+        '''
+        Generate (key, value) for all records of the given kind (this reads the whole table)
+        '''
+        prefix = record_key(kind, "")
+        for k in range(self.nslots):
+            shash, offset, ksize, vsize = SLOT.unpack_from(self.buf, HEADER.size + k * SLOT.size)
+            if offset and self.buf[offset:offset + len(prefix)]==prefix:
+                key = self.buf[offset + len(prefix):offset + ksize].decode()
+                yield key, json.loads(self.buf[offset + ksize:offset + ksize + vsize])
+
+    def units(self):
+        return self.get("course", "", {}).get('units', [])
+
+    def unit(self, name):
+        return self.get("unit", name)
+
+    def page(self, page):
+        return self.get("page", page.strip("/"))
+
+    def question(self, page, csq_name):
+        '''
+        Return record for question csq_name on page (page as given in nbif and question links, i.e.
+        before any splitting into sub-pages), or None
+        '''
+        return self.get("question", f"{page.strip('/')}\0{normalize_csq_name(csq_name)}")
+
+    def notebook(self, path):
+        return self.get("notebook", path)
+
+    def asset(self, path):
+        return self.get("asset", path)
+
+    def close(self):
+        self.buf.close()
+
+def open_index(course_dir):
+    '''
+    Return CourseIndex for course_dir, or None if it has no index
+    '''
+    try:
+        return CourseIndex(os.path.join(course_dir, INDEX_FN))
+    except Exception:
+        return None
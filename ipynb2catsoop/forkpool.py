@@ -0,0 +1,375 @@
+'''
+Warm pre-forked interpreter pool, for running catsoop pythoncode tests without starting a fresh
+python (and importing numpy and other student libraries again) for every test of every submission.
+
+Each pool worker is a "zygote" python process, started once, which imports commonly used modules
+and then waits for requests.  For each request, the zygote forks a clean child, which applies the
+same isolation as catsoop's python sandbox (new session, resource limits, death signal), and runs
+the catsoop test script in its sandbox directory, with stdin, stdout, and stderr connected to pipes
+passed from the caller.
+
+Use this within catsoop by setting csq_python_sandbox_type to forkpool.SANDBOX_TYPE, or, in
+ipynb2catsoop.do_submit and pythoncode_test, by including 'sandbox': 'forkpool' in
+csq_sandbox_options.  Further csq_sandbox_options keys used are:
+
+    forkpool_size = number of zygote processes in the pool (default 1)
+    forkpool_preload = list of names of modules imported by the zygotes (default ["numpy"])
+'''
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import runpy
+import atexit
+import shutil
+import signal
+import socket
+import resource
+import selectors
+import threading
+import traceback
+import subprocess
+
+SANDBOX_TYPE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "forkpool_sandbox")
+DEFAULT_PRELOAD = ["numpy"]
+
+_resource_mapper = {
+    "CPUTIME": (resource.RLIMIT_CPU, lambda x: (x, x + 1)),
+    "MEMORY": (resource.RLIMIT_AS, lambda x: (x, x)),
+    "FILESIZE": (resource.RLIMIT_FSIZE, lambda x: (x, x)),
+}
+
+class ForkPool:
+    '''
+    Pool of zygote processes, each of which forks a child to run each requested script
+    '''
+    def __init__(self, size=1, preload=None, python=None):
+        '''
+        size = (int) number of zygote processes
+        preload = (list) names of modules to import in the zygotes (defaults to DEFAULT_PRELOAD)
+        python = (str) python interpreter used for the zygotes (defaults to sys.executable)
+        '''
+        self.size = size
+        self.preload = DEFAULT_PRELOAD if preload is None else preload
+        self.python = python or sys.executable
+        self.workers = []
+        self.idle = queue.Queue()
+        for k in range(size):
+            self.idle.put(self.start_worker())
+
+    def start_worker(self):
+        '''
+        Start zygote process, connected by a unix socket
+        '''
+        parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        cmd = [self.python, "-E", "-B", os.path.abspath(__file__), str(child_sock.fileno()), ",".join(self.preload)]
+        proc = subprocess.Popen(cmd, pass_fds=[child_sock.fileno()], stdin=subprocess.DEVNULL)
+        child_sock.close()
+        worker = {'proc': proc, 'sock': parent_sock}
+        self.workers.append(worker)
+        return worker
+
+    def stop_worker(self, worker):
+        worker['sock'].close()
+        try:
+            worker['proc'].wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            worker['proc'].kill()
+            worker['proc'].wait()
+        self.workers.remove(worker)
+
+    def shutdown(self):
+        for worker in list(self.workers):
+            self.stop_worker(worker)
+
+    def fork_child(self, worker, request, fds):
+        '''
+        Send request and file descriptors (stdin, stdout, stderr) to zygote; return pid of forked child
+        '''
+        socket.send_fds(worker['sock'], [json.dumps(request).encode()], fds)
+        resp = b""
+        while not resp.endswith(b"\n"):
+            data = worker['sock'].recv(64)
+            if not data:
+                raise OSError("[forkpool] zygote process exited")
+            resp += data
+        return int(resp)
+
+    def run(self, cwd, script, stdin="", timeout=1, rlimits=(), memory=None):
+        '''
+        Run python script in directory cwd, in a child forked from a zygote, with the specified
+        resource limits (list of (resource, (soft, hard)) tuples), and a wall clock timeout in seconds.
+        The child is killed if it runs past the timeout.
+
+        memory = (int) address space limit (RLIMIT_AS) in bytes, counted from the address space the child
+                 inherits from the zygote (which has its preload modules already loaded), so that the
+                 script may use as much memory as it would in a freshly started python
+
+        Returns tuple (out, err) of strings, with the child's stdout and stderr.
+        '''
+        request = {'cwd': cwd, 'script': script, 'rlimits': [[r, lim[0], lim[1]] for r, lim in rlimits],
+                   'memory': memory}
+        in_r, in_w = os.pipe()
+        out_r, out_w = os.pipe()
+        err_r, err_w = os.pipe()
+        worker = self.idle.get()
+        try:
+            try:
+                pid = self.fork_child(worker, request, [in_r, out_w, err_w])
+            except OSError:		# zygote died; replace it and retry once
+                self.stop_worker(worker)
+                worker = self.start_worker()
+                pid = self.fork_child(worker, request, [in_r, out_w, err_w])
+        finally:
+            self.idle.put(worker)
+            for fd in [in_r, out_w, err_w]:
+                os.close(fd)
+        return communicate(pid, in_w, out_r, err_r, (stdin or "").encode(), timeout)
+
+def communicate(pid, in_w, out_r, err_r, data, timeout):
+    '''
+    Write data to child's stdin, and read its stdout and stderr until they are closed, killing the
+    child's process group if this takes longer than timeout seconds.  Closes all the file descriptors.
+    '''
+    output = {out_r: b"", err_r: b""}
+    sel = selectors.DefaultSelector()
+    for fd in output:
+        sel.register(fd, selectors.EVENT_READ)
+    if data:
+        os.set_blocking(in_w, False)
+        sel.register(in_w, selectors.EVENT_WRITE)
+    else:
+        os.close(in_w)
+    deadline = time.monotonic() + timeout
+    killed = False
+    while sel.get_map():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 and not killed:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+            killed = True
+        for key, events in sel.select(timeout=max(remaining, 0) if not killed else 1):
+            fd = key.fd
+            if fd==in_w:
+                try:
+                    data = data[os.write(in_w, data[:65536]):]
+                except BrokenPipeError:
+                    data = b""
+                if not data:
+                    sel.unregister(in_w)
+                    os.close(in_w)
+                continue
+            chunk = os.read(fd, 65536)
+            if chunk:
+                output[fd] += chunk
+            else:
+                sel.unregister(fd)
+                os.close(fd)
+        if killed and time.monotonic() > deadline + 1:	# pipes held open by an escaped process
+            break
+    for key in list(sel.get_map().values()):
+        os.close(key.fd)
+    sel.close()
+    return output[out_r].decode(errors="replace"), output[err_r].decode(errors="replace")
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+def get_pool(size=1, preload=None):
+    '''
+    Return the process-wide ForkPool with the given size and preloaded modules, starting it if needed
+    '''
+    key = (size, tuple(DEFAULT_PRELOAD if preload is None else preload))
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            _POOLS[key] = ForkPool(size=size, preload=list(key[1]))
+        return _POOLS[key]
+
+@atexit.register
+def shutdown_pools():
+    with _POOLS_LOCK:
+        for pool in _POOLS.values():
+            pool.shutdown()
+        _POOLS.clear()
+
+def run_code(context, code, options, count_opcodes=False, opcode_limit=None, result_as_string=False):
+    '''
+    catsoop pythoncode sandbox run_code, with the same interface and semantics as catsoop's
+    python sandbox, but running the test in a child forked from a warm zygote process
+    '''
+    memory = None
+    if options.get("do_rlimits", True):
+        rlimits = [(resource.RLIMIT_NPROC, (0, 0))]
+        for key, val in _resource_mapper.items():
+            if key == "MEMORY":		# applied relative to the zygote's address space (see ForkPool.run)
+                if options[key] > 0:
+                    memory = options[key]
+                continue
+            rlimits.append((val[0], val[1](options[key])))
+    else:
+        rlimits = []
+
+    tmpdir = context.get("csq_sandbox_dir", "/tmp/sandbox")
+    this_one = "_%s" % uuid.uuid4().hex
+    tmpdir = os.path.join(tmpdir, this_one)
+    template_fn = os.path.join(context["cs_fs_root"], "__QTYPES__", "pythoncode", "__SANDBOXES__", "_template")
+    with open(template_fn) as f:
+        template = f.read()
+    template %= {
+        "enable_opcode_count": count_opcodes,
+        "result_as_string": result_as_string,
+        "test_module": this_one,
+        "opcode_limit": opcode_limit or float("inf"),
+    }
+    os.makedirs(tmpdir, 0o777)
+    with open(os.path.join(tmpdir, "run_catsoop_test.py"), "w") as f:
+        f.write(template)
+    for f in options["FILES"]:
+        typ = f[0].strip().lower()
+        if typ == "copy":
+            shutil.copyfile(f[1], os.path.join(tmpdir, f[2]))
+        elif typ == "string":
+            with open(os.path.join(tmpdir, f[1]), "w") as fileobj:
+                fileobj.write(f[2])
+    fname = "%s.py" % this_one
+    with open(os.path.join(tmpdir, fname), "w") as fileobj:
+        fileobj.write(code.replace("\r\n", "\n"))
+
+    pool = get_pool(options.get("forkpool_size", 1), options.get("forkpool_preload"))
+    out, err = pool.run(tmpdir, "run_catsoop_test.py", stdin=options["STDIN"], timeout=options["CLOCKTIME"],
+                        rlimits=rlimits, memory=memory)
+    shutil.rmtree(tmpdir, True)
+
+    n = out.rsplit("---", 1)
+    log = {}
+    if len(n) == 2:
+        out, log = n
+        try:
+            log = context["csm_util"].literal_eval(log)
+        except Exception:
+            log = {}
+
+    if log == {} or log.get("opcode_limit_reached", False):
+        if err.strip() == "":
+            err = (
+                "Your code did not run to completion, "
+                "but no error message was returned."
+                "\nThis normally means that your code contains an "
+                "infinite loop or otherwise took too long to run."
+            )
+
+    if len(n) > 2:
+        out = ""
+        log = {}
+        err = "BAD CODE - this will be logged"
+
+    return {"fname": fname, "out": out, "err": err, "info": log}
+
+#-----------------------------------------------------------------------------
+# zygote process
+
+def set_pdeathsig(sig=signal.SIGKILL):
+    '''
+    Have this process receive sig when its parent dies (linux only)
+    '''
+    try:
+        import ctypes
+        ctypes.CDLL("libc.so.6").prctl(1, sig)		# PR_SET_PDEATHSIG
+    except Exception:
+        pass
+
+def address_space_size():
+    '''
+    Return size in bytes of this process's address space (0 if it is not known, e.g. without /proc)
+    '''
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[0]) * resource.getpagesize()
+    except (OSError, ValueError, IndexError):
+        return 0
+
+def run_child(sock, request, fds):
+    '''
+    In forked child: isolate, connect stdin/stdout/stderr, apply resource limits, and run script
+    '''
+    code = 1
+    try:
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        sock.close()
+        os.setsid()
+        for k, fd in enumerate(fds):
+            os.dup2(fd, k)
+        for fd in fds:
+            if fd > 2:
+                os.close(fd)
+        set_pdeathsig()
+        os.chdir(request['cwd'])
+        for res, soft, hard in request['rlimits']:
+            resource.setrlimit(res, (soft, hard))
+        if request.get('memory'):
+            limit = address_space_size() + request['memory']
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        sys.argv = [request['script']]
+        sys.path[0] = request['cwd']
+        try:
+            runpy.run_path(request['script'], run_name="__main__")
+            code = 0
+        except SystemExit as err:
+            code = err.code if isinstance(err.code, int) else (0 if err.code is None else 1)
+        except BaseException:
+            etype, value, tb = sys.exc_info()
+            internal = [__file__, runpy.__file__, "<frozen runpy>"]
+            while tb is not None and tb.tb_frame.f_code.co_filename in internal:	# hide pool frames
+                tb = tb.tb_next
+            traceback.print_exception(etype, value, tb)
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(code)
+
+def zygote(fd, preload):
+    '''
+    Import preload modules, then fork a child for each request received on socket fd
+    '''
+    import importlib
+    for name in preload:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            pass
+    sock = socket.socket(fileno=fd)
+    set_pdeathsig()
+
+    def reap(signum, frame):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid==0:
+                return
+    signal.signal(signal.SIGCHLD, reap)
+
+    while True:
+        try:
+            msg, fds, flags, addr = socket.recv_fds(sock, 65536, 3)
+        except OSError:
+            break
+        if not msg:
+            break
+        request = json.loads(msg)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid==0:
+            run_child(sock, request, fds)
+        for cfd in fds:
+            os.close(cfd)
+        sock.sendall(f"{pid}\n".encode())
+
+if __name__=="__main__":
+    zygote(int(sys.argv[1]), [x for x in sys.argv[2].split(",") if x])
@@ -0,0 +1,5 @@
+'''
+catsoop pythoncode sandbox which runs tests using the warm interpreter pool in ipynb2catsoop.forkpool.
+catsoop loads sandboxes by file path: set csq_python_sandbox_type to ipynb2catsoop.forkpool.SANDBOX_TYPE
+'''
+from ipynb2catsoop.forkpool import run_code
@@ -2,136 +2,1213 @@
 Python code / class to convert ipython / jupyter notebook to catsoop page
 '''
 
+import io
 import os
+import ast
 import re
 import sys
 import glob
 import json
+import time
 import base64
+import struct
+import hashlib
 import logging
+import threading
+from collections import defaultdict, OrderedDict
+from ipynb2catsoop import course_index
+from ipynb2catsoop.course_index import question_blocks
 
 try:
     import nbformat
 except Exception as err:
     pass
 
+try:
+    from PIL import Image
+except Exception as err:
+    Image = None
+
+try:
+    import orjson
+except Exception as err:
+    orjson = None
+
+try:
+    import numpy as np
+except Exception as err:
+    np = None
+
 class ipynb2catsoop:
     '''
     Convert ipython / jupyter notebook to catsoop.
     Handle pythoncode questions.
     '''
-    def __init__(self, unit_name=None, course_dir=None, verbose=False, force_conversion=False):
+    IMAGE_CACHE_FN = ".ipynb2catsoop_images.json"
+    CELL_CACHE_FN = ".ipynb2catsoop_cells.json"
+    CELL_CACHE_VERSION = 1
+    PAGES_INDEX_FN = ".ipynb2catsoop_pages.json"
+    IGNORED_CODE_PREFIXES = ("# run this once at startup", "# catsoop-ignore")
+
+    def __init__(self, unit_name=None, course_dir=None, verbose=False, force_conversion=False,
+                 optimize_images=False, max_image_width=None, image_format="png",
+                 max_inline_text=None, text_preview_length=1000, time_stages=False,
+                 validate=False, validate_timeout=60, validate_nprocs=None, fast_reader=False,
+                 grade_cache_size=0, grade_cache_dir=None, output_format="md", cell_cache=False,
+                 split_heading_level=None, max_page_cells=None, max_page_bytes=None):
+        '''
+        optimize_images = (bool) if True, then resize / recompress display_data images, and add
+                          width, height, and loading="lazy" to the generated <img> tags
+        max_image_width = (int) maximum width in pixels of optimized images (None for no limit)
+        image_format = (str) "png" (lossless recompression) or "webp", for optimized images
+        max_inline_text = (int) maximum number of bytes of text output to inline in the page, per cell;
+                          text outputs beyond this are written to __STATIC__, and replaced by a
+                          truncated preview and a link (None for no limit)
+        text_preview_length = (int) number of characters of spilled text output shown as a preview
+        time_stages = (bool) if True, then accumulate time spent in each conversion stage in stage_times
+        validate = (bool) if True, then convert_all also validates all pythoncode problems in the course,
+                   by running their staff solutions (and sample submissions) through the grader
+        validate_timeout = (float) maximum time in seconds allowed for validating each problem
+        validate_nprocs = (int) number of processes used for validation (None for number of CPUs)
+        fast_reader = (bool) if True, then read notebooks without nbformat schema validation (see read_notebook)
+        grade_cache_size = (int) maximum number of grading results kept in memory by do_submit, so that
+                           duplicate submissions are not graded again (0, the default, disables the cache;
+                           leave it off while editing tests, since the key does not cover code they call)
+        grade_cache_dir = (str) directory in which grading results are also stored (None for memory only)
+        output_format = (str) "md" to output catsoop markdown (content.md), or "html" to output the
+                        page with its markdown pre-rendered to HTML (content.xml); "html" requires catsoop
+        cell_cache = (bool) if True, then keep the catsoop text generated for each cell in a per-unit cache
+                     file, so that reconversion only re-renders the cells which changed (see transform_cells_cached)
+        split_heading_level = (int) if set, then split notebooks into multiple catsoop pages, starting a new page
+                              at each markdown cell beginning with a heading of this level or above (e.g. 1 for "# ")
+        max_page_cells = (int) if set, then split notebooks into catsoop pages of at most this many cells
+        max_page_bytes = (int) if set, then split notebooks into catsoop pages of at most about this many bytes
+                         (see split_pages)
+        '''
         self.unit_name = unit_name
         self.course_dir = os.path.abspath(course_dir or ".")
+        self.converting_all = False
         self.verbose = verbose
         self.force_conversion = force_conversion
+        self.optimize_images = optimize_images
+        self.max_image_width = max_image_width
+        self.image_format = image_format
+        self.max_inline_text = max_inline_text
+        self.text_preview_length = text_preview_length
+        self.time_stages = time_stages
+        self.stage_times = defaultdict(float)
+        self.validate = validate
+        self.validate_timeout = validate_timeout
+        self.validate_nprocs = validate_nprocs
+        self.pythoncode_problems = []
+        self.fast_reader = fast_reader
+        self.output_format = output_format
+        self.output_ext = "xml" if output_format=="html" else "md"
+        self.cell_cache = cell_cache
+        self.image_cache = None		# optimized image cache of the notebook being converted (see image_cache_entries)
+        self.split_heading_level = split_heading_level
+        self.max_page_cells = max_page_cells
+        self.max_page_bytes = max_page_bytes
+        self.do_split = bool(split_heading_level or max_page_cells or max_page_bytes)
+        self.grade_cache = GradeCache(grade_cache_size, grade_cache_dir) if grade_cache_size else None
+        self.skip_rules = [self.skip_colab_link, self.skip_ignored_code]
+        self.cell_handlers = {'markdown': self.handle_markdown_cell,
+                              'code': self.handle_code_cell,
+                              'pythoncode': self.handle_pythoncode_cell,
+        }
+        self.output_handlers = {'display_data': self.handle_display_data}
+        self.data_handlers = {'text': self.handle_text_data,
+                              'image': self.handle_image_data,
+        }
 
-    def convert_all(self, cdir):
+    SHARDS_DIR = ".ipynb2catsoop_shards"
+
+    def convert_all(self, cdir, shard=None):
         '''
         Convert all */*.ipynb files to */content.md 
 
         Does this only if there is a single *.ipynb file in the directory
         
         cdir = (str) course content directory path
+        shard = (tuple) (i, N) to only convert the units in shard i of N (see unit_shard), and
+                write a manifest of this shard's outputs and assets (see write_shard_manifest)
         '''
         cdir = os.path.abspath(cdir)
         self.course_dir = cdir
         if self.verbose:
             print(f"[ipynb2catsoop] Converting all */*.ipynb files in {cdir}")
-        for unit_name in sorted(glob.glob(f"{cdir}/*")):
-            if not os.path.isdir(unit_name):
-                continue
-            self.convert_unit(unit_name)
+        units = {}
+        self.converting_all = True		# write course index once, at the end
+        try:
+            for unit_name in sorted(glob.glob(f"{cdir}/*")):
+                if not os.path.isdir(unit_name):
+                    continue
+                if shard and unit_shard(os.path.basename(unit_name), shard[1])!=shard[0]:
+                    continue
+                units[unit_name] = self.convert_unit(unit_name)
+        finally:
+            self.converting_all = False
+        if shard:
+            self.write_shard_manifest(shard, units)
+        else:
+            self.write_course_index(cdir)
+        if self.validate:
+            return self.validate_pythoncode_problems()
 
     def convert_unit(self, unit_name):
         '''
         Convert *.npynb file(s) in the specified unit_name directory
+
+        Returns list of output files for the unit (whether or not they needed to be updated).
         '''
-        if os.path.exists(f"{unit_name}/.ipynb2catsoop.ignore"):
-            return
-        nbfiles = list(glob.glob(f"{unit_name}/*.ipynb"))
-        to_convert = {}
-        if len(nbfiles)==0:
-            return
-        elif len(nbfiles)==1:
-            to_convert[nbfiles[0]] = f"{unit_name}/content.md"
-        else:
-            for nbfn in nbfiles:
-                to_convert[nbfn] = nbfn.replace(".ipynb", ".md")
-            
+        to_convert = self.unit_outputs(unit_name)
         for nbfn, ofn in to_convert.items():
             self.unit_name = os.path.basename(unit_name)
+            if self.validate:
+                self.pythoncode_problems += self.collect_pythoncode_problems(nbfn)
             if (not self.force_conversion) and  os.path.exists(ofn) and os.path.getmtime(nbfn) < os.path.getmtime(ofn):
                 if self.verbose:
                     print(f"    Skipping '{nbfn}' -- '{ofn}' already up to date")
                 continue
             self.convert(nbfn, ofn=ofn)
+        outputs = []
+        for ofn in to_convert.values():
+            outputs += self.page_files(ofn)
+        return outputs
+
+    def unit_outputs(self, unit_name):
+        '''
+        Return dict giving the output file for each *.ipynb file in the unit_name directory:
+        content.md if there is a single notebook, else <notebook name>.md (or .xml, for HTML output)
+        '''
+        if os.path.exists(f"{unit_name}/.ipynb2catsoop.ignore"):
+            return {}
+        nbfiles = list(glob.glob(f"{unit_name}/*.ipynb"))
+        to_convert = {}
+        if len(nbfiles)==1:
+            to_convert[nbfiles[0]] = f"{unit_name}/content.{self.output_ext}"
+        else:
+            for nbfn in nbfiles:
+                to_convert[nbfn] = nbfn.replace(".ipynb", f".{self.output_ext}")
+        return to_convert
+
+    GENERATED_ASSET_PAT = re.compile(r"(cell_\d+_display_data_\d+\.\w+|cell_\d+_text_output_\d+_\d+\.(txt|html)"
+                                     r"|img_[0-9a-f]{16}\.\w+)$")
+
+    def write_course_index(self, cdir=None):
+        '''
+        Write compact index of the course in cdir (see course_index), with its units, pages, questions
+        (with the notebook and cell each comes from), notebooks, and __STATIC__ assets (with their hashes).
+        Notebooks and assets unchanged since the previous index are not read again.
+        Returns the number of records in the index.
+        '''
+        cdir = os.path.abspath(cdir or self.course_dir)
+        self.course_dir = cdir
+        old = course_index.open_index(cdir)
+        records = {}
+        units = []
+        for unit_dir in sorted(glob.glob(f"{cdir}/*")):
+            to_convert = self.unit_outputs(unit_dir) if os.path.isdir(unit_dir) else {}
+            if not to_convert:
+                continue
+            unit = os.path.basename(unit_dir)
+            units.append(unit)
+            notebooks = []
+            pages = []
+            unconverted = []
+            for nbfn, ofn in sorted(to_convert.items()):
+                nbpath = os.path.relpath(nbfn, cdir)
+                notebooks.append(nbpath)
+                nbrec = self.index_notebook(nbfn, nbpath, old)
+                records[("notebook", nbpath)] = nbrec
+                ofn = self.existing_page_file(ofn)
+                if ofn is None:
+                    unconverted.append(nbpath)
+                    continue
+                pages.append(self.index_page(unit, nbpath, nbrec, ofn, records))
+            records[("unit", unit)] = {'notebooks': notebooks, 'pages': pages, 'unconverted': unconverted}
+            static_dir = f"{unit_dir}/__STATIC__"
+            for fnb in sorted(os.listdir(static_dir)) if os.path.isdir(static_dir) else []:
+                path = f"{unit}/__STATIC__/{fnb}"
+                if not fnb.startswith(".") and os.path.isfile(f"{cdir}/{path}"):
+                    records[("asset", path)] = self.index_asset(f"{cdir}/{path}", path, unit, old)
+        records[("course", "")] = {'units': units}
+        course_index.write_index(f"{cdir}/{course_index.INDEX_FN}", records)
+        if old is not None:
+            old.close()
+        if self.verbose:
+            print(f"[ipynb2catsoop] Wrote course index with {len(records)} records")
+        return len(records)
+
+    def index_page(self, unit, nbpath, nbrec, ofn, records):
+        '''
+        Add course index records for the page in file ofn (converted from notebook nbpath, with notebook
+        record nbrec), and for its questions, to records.  Returns the page path.
+        '''
+        page = self.page_path(ofn)
+        cells = {course_index.normalize_csq_name(name): (cell, qtype) for name, cell, qtype in nbrec['questions']}
+        page_rec = {'unit': unit, 'notebook': nbpath, 'file': os.path.relpath(ofn, self.course_dir), 'title': None,
+                    'sub_pages': [], 'questions': [], 'assets': []}
+        for fn in self.page_files(ofn):
+            if not os.path.exists(fn):
+                continue
+            with open(fn) as fp:
+                text = fp.read()
+            sub_page = self.page_path(fn)
+            page_rec['sub_pages'].append(sub_page)
+            page_rec['title'] = page_rec['title'] or self.page_title(text.split("\n\n"))
+            for fnb in re.findall('(?:src|href)="CURRENT/([^"]+)"', text):
+                if os.path.exists(f"{self.course_dir}/{unit}/__STATIC__/{fnb}"):
+                    page_rec['assets'].append(f"{unit}/__STATIC__/{fnb}")
+            for qtype, name in question_blocks(text):
+                key = ("question", f"{page}\0{course_index.normalize_csq_name(name)}")
+                if key in records:
+                    print(f"[ipynb2catsoop] Warning: duplicate question csq_name={name.strip()} in page {page} "
+                          f"({sub_page}) -- not added to the course index")
+                    continue
+                page_rec['questions'].append(name)
+                cell, nb_qtype = cells.get(course_index.normalize_csq_name(name), (None, None))
+                records[key] = {'csq_name': name, 'page': page, 'sub_page': sub_page, 'notebook': nbpath,
+                                'cell': cell, 'qtype': qtype or nb_qtype}
+        page_rec['assets'] = sorted(set(page_rec['assets']))
+        records[("page", page)] = page_rec
+        return page
+
+    def update_course_index(self, nbfn, ofn):
+        '''
+        Update the existing course index for the conversion of the single notebook nbfn to ofn: only the
+        records of that notebook, its page and questions, its unit, and the assets the page links to
+        are rebuilt; all other records are copied from the existing index.  The full index is rewritten
+        instead if the notebook is not in the course directory.  Returns the number of records in the index.
+        '''
+        cdir = self.course_dir
+        nbpath = os.path.relpath(os.path.abspath(nbfn), cdir)
+        unit = nbpath.split(os.sep)[0]
+        if nbpath.startswith("..") or unit==nbpath:
+            return self.write_course_index()
+        old = course_index.open_index(cdir)
+        if old is None:
+            return self.write_course_index()
+        records = {(kind, key): value for kind in course_index.KINDS for key, value in old.items(kind)}
+        page = self.page_path(ofn)
+        records.pop(("page", page), None)
+        for key in [key for key in records if key[0]=="question" and key[1].startswith(f"{page}\0")]:
+            del records[key]
+        nbrec = self.index_notebook(nbfn, nbpath, old)
+        records[("notebook", nbpath)] = nbrec
+        self.index_page(unit, nbpath, nbrec, ofn, records)
+        unit_rec = records.setdefault(("unit", unit), {'notebooks': [], 'pages': [], 'unconverted': []})
+        unit_rec['notebooks'] = sorted(set(unit_rec['notebooks']) | {nbpath})
+        unit_rec['pages'] += [] if page in unit_rec['pages'] else [page]
+        unit_rec['unconverted'] = [path for path in unit_rec['unconverted'] if path!=nbpath]
+        course_rec = records.setdefault(("course", ""), {'units': []})
+        course_rec['units'] = sorted(set(course_rec['units']) | {unit})
+        for path in records[("page", page)]['assets']:
+            records[("asset", path)] = self.index_asset(f"{cdir}/{path}", path, unit, old)
+        course_index.write_index(f"{cdir}/{course_index.INDEX_FN}", records)
+        old.close()
+        if self.verbose:
+            print(f"[ipynb2catsoop] Updated course index for {nbpath} ({len(records)} records)")
+        return len(records)
+
+    def existing_page_file(self, ofn):
+        '''
+        Return the file holding the page for output file ofn as it exists on disk: ofn, or the same page
+        written in the other output format (content.xml instead of content.md, or vice versa); None if
+        the notebook has not been converted
+        '''
+        stem = os.path.splitext(ofn)[0]
+        for fn in [ofn, f"{stem}.md", f"{stem}.xml"]:
+            if os.path.exists(fn):
+                return fn
+        return None
+
+    def index_notebook(self, nbfn, nbpath, old):
+        '''
+        Return course index record for notebook nbfn, with the questions defined in it, and the cell
+        number of each; the record in the old index is reused if the notebook has not changed
+        '''
+        stat = os.stat(nbfn)
+        prev = old.notebook(nbpath) if old is not None else None
+        if prev and prev['mtime']==stat.st_mtime and prev['size']==stat.st_size:
+            return prev
+        questions = []
+        for cnt, cell in enumerate(self.read_notebook(nbfn).cells):
+            kind = self.cell_kind(cell)
+            if kind=="pythoncode":
+                try:
+                    name = self.make_pythoncode_problem(cell['source'])['parameters']['csq_name']
+                except Exception as err:
+                    continue
+                questions.append([name if name.strip() else self.unnamed_question_name(cell), cnt+1, "pythoncode"])
+            elif kind=="markdown":
+                questions += [[name, cnt+1, qtype] for qtype, name in question_blocks(cell['source'])]
+        return {'mtime': stat.st_mtime, 'size': stat.st_size, 'questions': questions}
+
+    def index_asset(self, fn, path, unit, old):
+        '''
+        Return course index record for static asset file fn; the sha256 hash in the old index
+        is reused if the file has not changed
+        '''
+        stat = os.stat(fn)
+        prev = old.asset(path) if old is not None else None
+        if prev and prev['mtime']==stat.st_mtime and prev['size']==stat.st_size:
+            return prev
+        with open(fn, 'rb') as fp:
+            sha256 = hashlib.sha256(fp.read()).hexdigest()
+        return {'unit': unit, 'sha256': sha256, 'size': stat.st_size, 'mtime': stat.st_mtime,
+                'generated': bool(self.GENERATED_ASSET_PAT.match(os.path.basename(fn)))}
+
+    def clean_stale_assets(self, cdir=None, dry_run=False):
+        '''
+        Remove __STATIC__ files generated by ipynb2catsoop (output images and text), which are no longer
+        linked to by any page of their unit, using the course index (which is rewritten first).
+        Other static files are never removed, and nor are any files of units with a notebook which has
+        no page on disk (e.g. not yet converted), since its assets cannot be known.  Returns list of the
+        paths removed (or to be removed, if dry_run is True), relative to the course directory.
+        '''
+        cdir = os.path.abspath(cdir or self.course_dir)
+        self.write_course_index(cdir)
+        index = course_index.CourseIndex(cdir)
+        referenced = set()
+        cleanable = set()
+        for unit in index.units():
+            unit_rec = index.unit(unit)
+            if unit_rec['unconverted']:
+                print(f"[ipynb2catsoop] Warning: not cleaning assets of unit {unit}, which has unconverted "
+                      f"notebooks {', '.join(unit_rec['unconverted'])}")
+                continue
+            cleanable.add(unit)
+            for page in unit_rec['pages']:
+                referenced.update(index.page(page)['assets'])
+        stale = sorted(path for path, asset in index.items("asset")
+                       if asset['generated'] and asset['unit'] in cleanable and path not in referenced)
+        index.close()
+        if stale and not dry_run:
+            for path in stale:
+                os.unlink(f"{cdir}/{path}")
+            self.write_course_index(cdir)
+        return stale
+
+    def write_shard_manifest(self, shard, units):
+        '''
+        Write manifest of the outputs and __STATIC__ assets of the units converted for shard (i, N),
+        with their sha256 hashes, to {course_dir}/.ipynb2catsoop_shards/shard-{i}-of-{N}.json
+
+        units = (dict) unit directory paths, with values giving the list of output files for each unit
+        '''
+        def hashes(fns):
+            ret = {}
+            for fn in sorted(fns):
+                with open(fn, 'rb') as fp:
+                    ret[os.path.relpath(fn, self.course_dir)] = hashlib.sha256(fp.read()).hexdigest()
+            return ret
+
+        manifest = {'shard': shard[0], 'nshards': shard[1], 'units': {}}
+        for unit_name, outputs in units.items():
+            if not outputs:
+                continue
+            static_dir = f"{unit_name}/__STATIC__"
+            assets = [f"{static_dir}/{x}" for x in os.listdir(static_dir)
+                      if not x.startswith(".")] if os.path.isdir(static_dir) else []
+            manifest['units'][os.path.basename(unit_name)] = {'outputs': hashes(outputs),
+                                                              'assets': hashes(assets)}
+        mdir = f"{self.course_dir}/{self.SHARDS_DIR}"
+        if not os.path.exists(mdir):
+            os.mkdir(mdir)
+        mfn = f"{mdir}/shard-{shard[0]}-of-{shard[1]}.json"
+        with open(mfn, 'w') as fp:
+            json.dump(manifest, fp, indent=1)
+        if self.verbose:
+            print(f"[ipynb2catsoop] Wrote manifest {mfn} for {len(manifest['units'])} units")
+        return manifest
+
+    def merge_shard_manifests(self, cdir):
+        '''
+        Merge the shard manifests in {cdir}/.ipynb2catsoop_shards, checking that all N shards are
+        present, and that no unit, output, or __STATIC__ asset path is claimed by more than one shard.
+        Writes the merged manifest to {cdir}/.ipynb2catsoop_shards/manifest.json, and returns it.
+        '''
+        cdir = os.path.abspath(cdir)
+        manifests = []
+        for mfn in sorted(glob.glob(f"{cdir}/{self.SHARDS_DIR}/shard-*-of-*.json")):
+            with open(mfn) as fp:
+                manifests.append(json.load(fp))
+        if not manifests:
+            raise Exception(f"[ipynb2catsoop] no shard manifests found in {cdir}/{self.SHARDS_DIR}")
+        nshards = set(m['nshards'] for m in manifests)
+        if len(nshards) > 1:
+            raise Exception(f"[ipynb2catsoop] shard manifests have inconsistent numbers of shards {sorted(nshards)}")
+        nshards = nshards.pop()
+        missing = set(range(nshards)) - set(m['shard'] for m in manifests)
+        if missing:
+            raise Exception(f"[ipynb2catsoop] missing manifests for shards {sorted(missing)} of {nshards}")
+
+        merged = {'nshards': nshards, 'units': {}}
+        owner = {}
+        conflicts = []
+        for m in manifests:
+            for unit, info in m['units'].items():
+                if unit in merged['units']:
+                    conflicts.append(f"unit {unit} in shards {owner[unit]} and {m['shard']}")
+                merged['units'][unit] = info
+                owner[unit] = m['shard']
+                for path in list(info['outputs']) + list(info['assets']):
+                    if path in owner and owner[path]!=m['shard']:
+                        conflicts.append(f"{path} in shards {owner[path]} and {m['shard']}")
+                    owner[path] = m['shard']
+        if conflicts:
+            raise Exception("[ipynb2catsoop] conflicts between shard manifests: " + "; ".join(conflicts))
+        with open(f"{cdir}/{self.SHARDS_DIR}/manifest.json", 'w') as fp:
+            json.dump(merged, fp, indent=1)
+        self.write_course_index(cdir)
+        if self.verbose:
+            print(f"[ipynb2catsoop] Merged {nshards} shard manifests, with {len(merged['units'])} units")
+        return merged
+
+    def collect_pythoncode_problems(self, nbfn):
+        '''
+        Return list of pythoncode problems in notebook file nbfn, each a dict with
+        nbfn, cell (cell number), and celltext
+        '''
+        notebook = self.read_notebook(nbfn)
+        return [{'nbfn': nbfn, 'cell': cnt+1, 'celltext': cell['source']}
+                for cnt, cell in self.filter_cells(enumerate(notebook.cells))
+                if self.cell_kind(cell)=="pythoncode"]
+
+    VALIDATE_KILL_GRACE = 5	# seconds past validate_timeout after which a stuck validation worker is killed
+
+    def validate_pythoncode_problems(self, problems=None):
+        '''
+        Validate pythoncode problems (defaults to those collected during conversion), in parallel, using
+        a pool of validate_nprocs processes.  For each problem, csq_tests is evaluated, and the staff
+        solution, as well as the sample #csq_submission if present, is run through the catsoop grader.
+        A problem passes if its staff solution gets full score.
+
+        Each problem is allowed validate_timeout seconds, counted from when a worker starts on it: the
+        worker interrupts itself when the time is up, and if it is still stuck VALIDATE_KILL_GRACE
+        seconds later, it is killed (and replaced by the pool), so that a hung problem does not hold
+        up the others.
+
+        Prints a report, and returns a list of dicts, one per problem, with keys nbfn, cell, csq_name,
+        status ("pass", "fail", "error", or "timeout"), soln_score, submission_score, msg, and time.
+        '''
+        import queue
+        import signal
+        import multiprocessing
+        problems = self.pythoncode_problems if problems is None else problems
+        if self.verbose:
+            print(f"[ipynb2catsoop] Validating {len(problems)} pythoncode problems")
+        results = [None] * len(problems)
+        started = multiprocessing.Queue()
+        pool = multiprocessing.Pool(self.validate_nprocs, initializer=init_validation_worker, initargs=(started,))
+        try:
+            pending = {k: pool.apply_async(validate_pythoncode_problem, (problem['celltext'], self.validate_timeout, k))
+                       for k, problem in enumerate(problems)}
+            starts = {}		# problem index: (worker pid, start time)
+            while pending:
+                try:
+                    while True:
+                        k, pid, t0 = started.get_nowait()
+                        starts[k] = (pid, t0)
+                except queue.Empty:
+                    pass
+                for k, aret in list(pending.items()):
+                    if aret.ready():
+                        try:
+                            ret = aret.get()
+                        except Exception as err:
+                            ret = {'status': "error", 'msg': str(err), 'time': 0}
+                    elif k in starts and time.time() - starts[k][1] > self.validate_timeout + self.VALIDATE_KILL_GRACE:
+                        pid, t0 = starts[k]
+                        kill_child_processes(pid)
+                        try:
+                            os.kill(pid, signal.SIGKILL)
+                        except OSError:
+                            pass
+                        ret = {'status': "timeout", 'msg': f"no result after {self.validate_timeout} seconds (worker killed)",
+                               'time': time.time() - t0}
+                    else:
+                        continue
+                    del pending[k]
+                    problem = problems[k]
+                    results[k] = {'nbfn': problem['nbfn'], 'cell': problem['cell'], 'csq_name': None,
+                                  'soln_score': None, 'submission_score': None}
+                    results[k].update(ret)
+                if pending:
+                    time.sleep(0.05)
+        finally:
+            pool.terminate()
+        print(self.validation_report(results))
+        return results
+
+    def validation_report(self, results):
+        '''
+        Return text report of pythoncode problem validation results
+        '''
+        lines = []
+        for r in results:
+            nbfn = os.path.relpath(r['nbfn'], self.course_dir)
+            line = f"{r['status'].upper():8s} {nbfn} cell {r['cell']} [{r['csq_name']}] soln_score={r['soln_score']}"
+            if r['submission_score'] is not None:
+                line += f" submission_score={r['submission_score']}"
+            line += f" ({r['time']:.2f}s)"
+            if r['status']!="pass" and r.get('msg'):
+                line += f"\n         {r['msg']}"
+            lines.append(line)
+        npass = len([r for r in results if r['status']=="pass"])
+        lines.append(f"{npass} of {len(results)} pythoncode problems passed validation")
+        return '\n'.join(lines)
 
     def convert(self, nbfn, ofn=None):
         '''
         Convert notebook *.ipynb file to content.md, saved using the configured course content directory
+        (or to content.xml, with pre-rendered HTML, if output_format is "html")
+
+        Conversion is done as a pipeline of generator stages:
+
+            iter_cells -> filter_cells -> transform_cells [-> render_fragments] -> write_fragments
+
+        where cells are filtered using the functions in skip_rules, and transformed into catsoop
+        text fragments using the handlers in the cell_handlers, output_handlers, and data_handlers
+        dispatch tables.  If time_stages is set, then the time spent in each stage is accumulated
+        in stage_times.  If cell_cache is set, then transform_cells_cached is used instead of
+        transform_cells (and render_fragments), so only the cells which changed are transformed.
+        If page splitting is enabled (split_heading_level, max_page_cells, or max_page_bytes),
+        then the notebook may be written as several catsoop pages (see split_pages and write_pages).
         '''
         odir = f"{self.course_dir}/{self.unit_name}"
         self.static_dir = f"{odir}/__STATIC__"
+        self.image_cache = None		# re-read for each conversion
         if not ofn:
-            ofn = f"{odir}/content.md"
+            ofn = f"{odir}/content.{self.output_ext}"
 
         if self.verbose:
             print(f"[ipynb2catsoop] Converting python notebook '{nbfn}' to '{ofn}'")
 
-        with open(nbfn) as fp:
+        notebook = self.read_notebook(nbfn)
+
+        cells = self.timed_stage("source", self.iter_cells(notebook))
+        cells = self.timed_stage("filter", self.filter_cells(cells))
+        if self.do_split:
+            cell_fragments = self.timed_stage("transform", self.transform_cells_grouped(cells, ofn))
+            self.write_pages(self.timed_stage("split", self.split_pages(cell_fragments)), ofn)
+        else:
+            if self.cell_cache:
+                fragments = self.timed_stage("transform", self.transform_cells_cached(cells, ofn))
+            else:
+                fragments = self.timed_stage("transform", self.transform_cells(cells))
+                if self.output_format=="html":
+                    fragments = self.timed_stage("render", self.render_fragments(fragments))
+            self.write_page(ofn, fragments)
+            self.remove_split_pages(ofn)
+        self.save_image_cache()
+        if not self.converting_all and os.path.exists(f"{self.course_dir}/{course_index.INDEX_FN}"):
+            self.update_course_index(nbfn, ofn)		# keep existing course index up to date
+
+        if self.time_stages and self.verbose:
+            print("    stage times (cumulative): " + ", ".join([f"{k}={v:.3f}s" for k, v in self.stage_times.items()]))
+
+    def read_notebook(self, nbfn):
+        '''
+        Read notebook file nbfn, returning an object with a cells attribute, giving the list of
+        notebook cells.  Normally this uses nbformat, which validates the notebook against the
+        nbformat schema.  If fast_reader is set, then the notebook JSON is instead decoded
+        directly (using orjson if it is installed), without schema validation.
+        '''
+        if not self.fast_reader:
+            with open(nbfn) as fp:
+                return nbformat.reads(fp.read(), as_version=4)
+        with open(nbfn, 'rb') as fp:
             nbdata = fp.read()
-        
-        notebook = nbformat.reads(nbdata, as_version=4)
-        
-        with open(ofn, 'w') as fp:
-            for cnt, cell in enumerate(notebook.cells):
+        nbdict = orjson.loads(nbdata) if orjson is not None else json.loads(nbdata)
+        if nbdict.get('nbformat')!=4:		# older notebook formats need conversion by nbformat
+            return nbformat.reads(nbdata.decode(), as_version=4)
+        return FastNotebook(nbdict)
+
+    def timed_stage(self, name, stage):
+        '''
+        Wrap generator stage, accumulating the time spent producing each of its items in
+        stage_times[name], if time_stages is set.  Times are cumulative, i.e. they include
+        the time spent in upstream stages.
+        '''
+        if not self.time_stages:
+            return stage
+        def timed():
+            it = iter(stage)
+            while True:
+                t0 = time.perf_counter()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    self.stage_times[name] += time.perf_counter() - t0
+                    return
+                self.stage_times[name] += time.perf_counter() - t0
+                yield item
+        return timed()
+
+    def iter_cells(self, notebook):
+        '''
+        Source stage: generate (cell number, cell) for each cell in notebook
+        '''
+        for cnt, cell in enumerate(notebook.cells):
+            if self.verbose:
+                print("    " + str(cell)[:100])
+            yield cnt, cell
+
+    def filter_cells(self, cells):
+        '''
+        Filter stage: drop cells for which any of the skip_rules functions returns True
+        '''
+        skip_rules = self.skip_rules
+        for cnt, cell in cells:
+            if any(rule(cell) for rule in skip_rules):
+                continue
+            yield cnt, cell
+
+    def transform_cells(self, cells):
+        '''
+        Transform stage: generate catsoop text fragments for each cell, using the handler
+        registered in cell_handlers for the cell's kind (see cell_kind)
+        '''
+        for cnt, cell in cells:
+            kind = self.cell_kind(cell)
+            handler = self.cell_handlers.get(kind)
+            if handler is None:
                 if self.verbose:
-                    print("    " + str(cell)[:100])
-                ctype = cell['cell_type']
-                cell_md = cell.get('metadata', {})
-                if ctype=="markdown":
-                    if cell_md.get("id")=="view-in-github":	# skip "Open in Colab" at top of notebooks
-                        continue
-                    mdout = self.fix_markdown(cell['source'])
-                    fp.write(mdout + "\n\n")
-                    continue
-                elif ctype=='code':
-                    source = cell['source']
-                    outputs = cell['outputs']
-                    if source.startswith("# run this once at startup"):
-                        continue
-                    if source.startswith("# catsoop-ignore"):
-                        continue
-                    if source.count("ret = pythoncode_test(_i)"):
-                        continue
-                    if source.startswith("#csq_pythoncode"):
-                        csq = self.make_pythoncode_problem(source)
-                        fp.write(csq['text'])
-                        continue
-                    fp.write(f"<pre>{source}</pre>\n\n")
-                    for out in outputs:
-                        if 0:
-                            fp.write(str(out) + "\n")
-                        elif out['output_type']=='execute_result':
-                            continue
-                        elif out['output_type']=='display_data':
-                            data = out['data']
-                            for datacnt, (ctype, b64dat) in enumerate(data.items()):
-                                if ctype.startswith("text"):
-                                    fp.write(f'<p>{b64dat}</p>\n\n')
-                                elif ctype.startswith("image"):
-                                    fext = ctype.split("/")[-1]
-                                    dfn = f"{self.static_dir}/cell_{cnt+1}_display_data_{datacnt+1:02d}.{fext}"
-                                    dfnb = os.path.basename(dfn)
-                                    if not os.path.exists(self.static_dir):
-                                        os.mkdir(self.static_dir)
-                                    with open(dfn, 'wb') as imfp:
-                                        imfp.write(base64.b64decode(b64dat))
-                                    fp.write(f'<img src="CURRENT/{dfnb}" alt="{dfnb}"/>\n\n')
-                                else:
-                                    print(f"Warning: unknown content type {ctype} in cell number {cnt+1}: skipping")
-                            
+                    print(f"Warning: no handler for cell type {kind} in cell number {cnt+1}: skipping")
+                continue
+            yield from handler(cnt, cell)
+
+    def transform_cells_cached(self, cells, ofn):
+        '''
+        Transform stage, with a persistent per-cell cache: the catsoop text fragments for each cell
+        (rendered to HTML, if output_format is "html") are saved in {unit dir}/.ipynb2catsoop_cells.json,
+        keyed by a hash of the cell's number, source, metadata, and outputs, and the converter
+        options (see cell_cache_key).  Only cells missing from the cache are transformed; the
+        cache is then rewritten with just the entries for the current cells.
+
+        A cached entry is not used if a __STATIC__ file it links to is missing, or is older than
+        the corresponding source file in the unit directory (e.g. an image used by a markdown cell).
+        Note that the cell number is part of the key (it is used in static file names), so
+        inserting or deleting a cell invalidates the entries for the cells after it.
+
+        ofn = (str) output filename, which the cache entries are stored under
+        '''
+        for cnt, cell, fragments in self.cached_cell_fragments(cells, ofn):
+            yield from fragments
+
+    def transform_cells_grouped(self, cells, ofn):
+        '''
+        Transform stage generating (cnt, cell, fragments) for each cell, where fragments is the list of
+        catsoop text fragments for the cell (rendered to HTML, if output_format is "html"), using
+        the cell cache if cell_cache is set
+        '''
+        if self.cell_cache:
+            yield from self.cached_cell_fragments(cells, ofn)
+            return
+        for cnt, cell in cells:
+            fragments = list(self.transform_cells([(cnt, cell)]))
+            if self.output_format=="html":
+                fragments = list(self.render_fragments(fragments))
+            yield cnt, cell, fragments
+
+    def cached_cell_fragments(self, cells, ofn):
+        '''
+        Generate (cnt, cell, fragments) for each cell, using and updating the cell cache
+        (see transform_cells_cached)
+        '''
+        cache_fn = f"{os.path.dirname(ofn)}/{self.CELL_CACHE_FN}"
+        cache = {}
+        if os.path.exists(cache_fn):
+            try:
+                with open(cache_fn) as cfp:
+                    cache = json.load(cfp)
+            except Exception as err:
+                cache = {}
+        ofnb = os.path.basename(ofn)
+        entries = cache.get(ofnb, {})
+        new_entries = {}
+        options = self.cell_cache_options()
+        nhits = 0
+        for cnt, cell in cells:
+            key = self.cell_cache_key(cnt, cell, options)
+            fragments = entries.get(key)
+            if fragments is not None and self.static_files_current(fragments):
+                nhits += 1
+            else:
+                fragments = list(self.transform_cells([(cnt, cell)]))
+                if self.output_format=="html":
+                    fragments = list(self.render_fragments(fragments))
+            new_entries[key] = fragments
+            yield cnt, cell, fragments
+        if self.verbose:
+            print(f"    cell cache: {nhits} of {len(new_entries)} cells unchanged")
+        cache[ofnb] = new_entries
+        tmpfn = f"{cache_fn}.{os.getpid()}.tmp"
+        with open(tmpfn, 'w') as cfp:
+            json.dump(cache, cfp)
+        os.replace(tmpfn, cache_fn)
+
+    def cell_cache_options(self):
+        '''
+        Return string describing the converter options and handlers which affect the catsoop text
+        generated for a cell, for use in cell cache keys
+        '''
+        def names(handlers):
+            return sorted((k, getattr(h, '__qualname__', repr(h))) for k, h in handlers.items())
+        return json.dumps([self.CELL_CACHE_VERSION, self.unit_name, self.optimize_images, self.max_image_width,
+                           self.image_format, self.max_inline_text, self.text_preview_length, self.output_format,
+                           self.do_split,
+                           names(self.cell_handlers), names(self.output_handlers), names(self.data_handlers)])
+
+    def cell_cache_key(self, cnt, cell, options):
+        '''
+        Return cell cache key: hash of cell number, source, metadata, and outputs, and options
+        '''
+        data = json.dumps([cnt, cell['cell_type'], cell['source'], cell.get('metadata', {}),
+                           cell.get('outputs', []), options], sort_keys=True, default=str)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def static_files_current(self, fragments):
+        '''
+        Return True if all the CURRENT/ files linked to by fragments exist in the static directory,
+        and are no older than their source files in the unit directory (if any)
+        '''
+        for fragment in fragments:
+            for fnb in re.findall('(?:src|href)="CURRENT/([^"]+)"', fragment):
+                dfn = f"{self.static_dir}/{fnb}"
+                if not os.path.exists(dfn):
+                    return False
+                sfn = f"{self.course_dir}/{self.unit_name}/{fnb}"
+                if os.path.exists(sfn) and os.path.getmtime(sfn) > os.path.getmtime(dfn):
+                    return False
+        return True
+
+    def write_page(self, ofn, fragments):
+        '''
+        Write catsoop page with the given text fragments to file ofn (see write_html_page for HTML output)
+        '''
+        if self.output_format=="html":
+            self.write_html_page(ofn, "".join(fragments))
+        else:
+            with open(ofn, 'w') as fp:
+                self.write_fragments(fragments, fp)
+
+    def split_pages(self, cell_fragments):
+        '''
+        Split stage: group (cnt, cell, fragments) items into pages, returning list of pages, each being
+        a list of text fragments.  A new page is started at each markdown cell which begins with a
+        heading of level split_heading_level or above, and when adding a cell to the current page
+        would take it over max_page_cells cells, or max_page_bytes bytes.  A single cell larger than
+        max_page_bytes is put on a page of its own.
+        '''
+        heading_pat = None
+        if self.split_heading_level:
+            heading_pat = re.compile(r"\s*#{1,%d}\s" % self.split_heading_level)
+        pages = [[]]
+        ncells = nbytes = 0
+        for cnt, cell, fragments in cell_fragments:
+            size = sum(len(fragment.encode()) for fragment in fragments)
+            new_page = (heading_pat is not None and cell['cell_type']=="markdown"
+                        and heading_pat.match(cell['source']))
+            new_page = new_page or (self.max_page_cells and ncells + 1 > self.max_page_cells)
+            new_page = new_page or (self.max_page_bytes and nbytes + size > self.max_page_bytes)
+            if new_page and ncells:
+                pages.append([])
+                ncells = nbytes = 0
+            pages[-1] += fragments
+            ncells += 1
+            nbytes += size
+        return pages
+
+    def write_pages(self, pages, ofn):
+        '''
+        Write pages (list of lists of text fragments) as catsoop pages, with navigation links between them.
+        The first page is written to ofn; the others are written next to it, as single-file catsoop pages
+        named part02, part03, ... (or <name>_part02, ... if ofn is not content.md), so that CURRENT/ links
+        to __STATIC__ files work from all the pages.  The pages, and the questions on each, are recorded
+        in the unit's pages index, {unit dir}/.ipynb2catsoop_pages.json, which nbif and catsoop2ipynb
+        use to find questions by the original page name (see update_pages_index).  Parts left over
+        from a previous conversion with more pages are removed.
+        '''
+        odir, ofnb = os.path.split(ofn)
+        stem, ext = os.path.splitext(ofnb)
+        prefix = "" if stem=="content" else f"{stem}_"
+        files = [ofnb] + [f"{prefix}part{k+1:02d}{ext}" for k in range(1, len(pages))]
+        names = ["" if stem=="content" else stem] + [os.path.splitext(fnb)[0] for fnb in files[1:]]
+        titles = []
+        for k, page in enumerate(pages):
+            titles.append(self.page_title(page) or (f"{titles[-1].split(' (continued)')[0]} (continued)" if k else "Part 1"))
+
+        def nav(k):
+            link = lambda j, label: f'<a href="CURRENT{"/" if names[j] else ""}{names[j]}">{label}</a>'
+            items = []
+            if k > 0:
+                items.append(link(k-1, f"&laquo; {titles[k-1]}"))
+            items.append(f"Part {k+1} of {len(pages)}")
+            if k < len(pages) - 1:
+                items.append(link(k+1, f"{titles[k+1]} &raquo;"))
+            return f'<div class="ipynb2catsoop-nav">{" | ".join(items)}</div>\n\n'
+
+        entries = []
+        for k, page in enumerate(pages):
+            fragments = page
+            if len(pages) > 1:
+                fragments = [nav(k)] + page + [nav(k)]
+            self.write_page(f"{odir}/{files[k]}", fragments)
+            entries.append({'file': files[k], 'title': titles[k], 'questions': question_names("".join(page))})
+        if self.verbose:
+            print(f"    split into {len(pages)} pages")
+        for fnb in self.update_pages_index(ofn, entries):
+            if fnb not in files and os.path.exists(f"{odir}/{fnb}"):
+                os.unlink(f"{odir}/{fnb}")
+
+    def remove_split_pages(self, ofn):
+        '''
+        Remove the parts, and pages index entry, left over from a previous conversion of the page in ofn
+        which split it into several pages (called when the page is written unsplit)
+        '''
+        odir, ofnb = os.path.split(ofn)
+        for fnb in self.update_pages_index(ofn, []):
+            if fnb!=ofnb and os.path.exists(f"{odir}/{fnb}"):
+                os.unlink(f"{odir}/{fnb}")
+
+    def page_title(self, fragments):
+        '''
+        Return title for a page: the text of the first markdown heading in fragments, or None
+        '''
+        for fragment in fragments:
+            mo = re.match(r"\s*#+\s+(.+)", fragment) or re.match(r"\s*<h[1-6][^>]*>(.+?)</h[1-6]>", fragment)
+            if mo:
+                return re.sub("<[^>]+>", "", mo.group(1)).strip()
+        return None
+
+    def page_path(self, ofn):
+        '''
+        Return catsoop page path (relative to the course) for the page in file ofn
+        '''
+        odir, ofnb = os.path.split(os.path.relpath(ofn, self.course_dir))
+        stem = os.path.splitext(ofnb)[0]
+        return odir if stem=="content" else f"{odir}/{stem}" if odir else stem
+
+    def update_pages_index(self, ofn, entries):
+        '''
+        Record the pages written for the page in file ofn, in the pages index of its directory, which is
+
+            {'pages': {page_path: [{'page': sub-page path, 'file': filename, 'title': title}, ...]},
+             'questions': {page_path: {csq_name: sub-page path}}}
+
+        Returns list of the filenames previously recorded for the page.
+
+        entries = (list) dicts with file, title, and questions (list of csq_names) for each page;
+                  if empty, then the page's entry is removed
+        '''
+        odir = os.path.dirname(ofn)
+        index_fn = f"{odir}/{self.PAGES_INDEX_FN}"
+        index = read_pages_index(index_fn)
+        if index is None and not entries:
+            return []
+        index = index or {'pages': {}, 'questions': {}}
+        page = self.page_path(ofn)
+        old_files = [entry['file'] for entry in index['pages'].get(page, [])]
+        if not entries and page not in index['pages']:
+            return old_files
+        pages = []
+        questions = {}
+        for entry in entries:
+            sub_page = self.page_path(f"{odir}/{entry['file']}")
+            pages.append({'page': sub_page, 'file': entry['file'], 'title': entry['title']})
+            for csq_name in entry['questions']:
+                questions[csq_name] = sub_page
+        index['pages'][page] = pages
+        index['questions'][page] = questions
+        if not entries:
+            del index['pages'][page], index['questions'][page]
+        tmpfn = f"{index_fn}.{os.getpid()}.tmp"
+        with open(tmpfn, 'w') as fp:
+            json.dump(index, fp, indent=1)
+        os.replace(tmpfn, index_fn)
+        return old_files
+
+    def page_files(self, ofn):
+        '''
+        Return list of the files for the page in ofn: just ofn, unless it was split into several pages
+        '''
+        odir = os.path.dirname(ofn)
+        index = read_pages_index(f"{odir}/{self.PAGES_INDEX_FN}")
+        entries = (index or {}).get('pages', {}).get(self.page_path(ofn))
+        if not entries:
+            return [ofn]
+        return [f"{odir}/{entry['file']}" for entry in entries]
+
+    def write_fragments(self, fragments, fp):
+        '''
+        Sink stage: write catsoop text fragments to file
+        '''
+        for fragment in fragments:
+            fp.write(fragment)
+
+    def render_fragments(self, fragments):
+        '''
+        Render stage: convert markdown in catsoop text fragments to HTML, leaving <question> blocks
+        untouched, so that catsoop does not need to render the markdown on every page view
+        '''
+        for fragment in fragments:
+            if fragment.lstrip().startswith("<question"):
+                yield fragment
+            else:
+                yield render_markdown(fragment) + "\n"
+
+    def write_html_page(self, ofn, html):
+        '''
+        Write pre-rendered HTML page to ofn, preceded by a comment with the hash of its content.
+        The file is left untouched if its content is unchanged, so catsoop's page caches stay valid.
+        '''
+        content_hash = hashlib.sha256(html.encode()).hexdigest()
+        header = f"<!-- ipynb2catsoop content_hash={content_hash} -->\n"
+        if os.path.exists(ofn):
+            with open(ofn) as fp:
+                if fp.readline()==header:
+                    if self.verbose:
+                        print(f"    '{ofn}' content unchanged")
+                    return
+        md_fn = ofn[:-len(".xml")] + ".md"
+        if os.path.exists(md_fn):
+            print(f"Warning: '{md_fn}' exists, and will be used by catsoop instead of '{ofn}'")
+        with open(ofn, 'w') as fp:
+            fp.write(header + html)
+
+    def cell_kind(self, cell):
+        '''
+        Return kind of cell, used as the key for the cell_handlers dispatch table.
+        This is the cell_type, except for code cells defining pythoncode problems.
+        '''
+        ctype = cell['cell_type']
+        if ctype=='code' and cell['source'].startswith("#csq_pythoncode"):
+            return "pythoncode"
+        return ctype
+
+    def register_cell_handler(self, kind, handler):
+        '''
+        Register handler(cnt, cell) generating catsoop text fragments for cells of the given kind
+        '''
+        self.cell_handlers[kind] = handler
+
+    def register_output_handler(self, output_type, handler):
+        '''
+        Register handler(cnt, cell, outcnt, out, state) generating catsoop text fragments for
+        code cell outputs of the given output_type (e.g. display_data).  state is a dict shared
+        by all outputs of a cell.
+        '''
+        self.output_handlers[output_type] = handler
+
+    def register_data_handler(self, ctype, handler):
+        '''
+        Register handler(cnt, outcnt, datacnt, ctype, data, state) generating catsoop text
+        fragments for display_data of the given content type.  ctype may be a full content
+        type (e.g. image/svg+xml), or just its major type (e.g. image).
+        '''
+        self.data_handlers[ctype] = handler
+
+    def skip_colab_link(self, cell):
+        '''
+        Skip "Open in Colab" at top of notebooks
+        '''
+        return cell['cell_type']=="markdown" and cell.get('metadata', {}).get("id")=="view-in-github"
+
+    def skip_ignored_code(self, cell):
+        '''
+        Skip code cells marked to be ignored, and cells which test pythoncode problems
+        '''
+        if cell['cell_type']!='code':
+            return False
+        source = cell['source']
+        return source.startswith(self.IGNORED_CODE_PREFIXES) or ("ret = pythoncode_test(_i)" in source)
+
+    def handle_markdown_cell(self, cnt, cell):
+        yield self.fix_markdown(cell['source']) + "\n\n"
+
+    def handle_pythoncode_cell(self, cnt, cell):
+        csq = self.make_pythoncode_problem(cell['source'])
+        if not csq['parameters']['csq_name'].strip():
+            csq['text'] = csq['text'].replace('csq_name =""""""', f'csq_name ="""{self.unnamed_question_name(cell)}"""', 1)
+        yield csq['text']
+
+    def unnamed_question_name(self, cell):
+        '''
+        Return csq_name for pythoncode problem cell which does not specify one.  This is stable when
+        cells are added or removed, and when the page is split: it is made from the nbformat cell id,
+        or, for notebooks without cell ids, from a hash of the cell source.
+        '''
+        cell_id = cell.get('id') or hashlib.sha256(cell['source'].encode()).hexdigest()[:12]
+        return f"cell_{cell_id}"
+
+    def handle_code_cell(self, cnt, cell):
+        yield f"<pre>{cell['source']}</pre>\n\n"
+        state = {'text_budget': self.max_inline_text}
+        output_handlers = self.output_handlers
+        for outcnt, out in enumerate(cell['outputs']):
+            handler = output_handlers.get(out['output_type'])
+            if handler is not None:
+                yield from handler(cnt, cell, outcnt, out, state)
+
+    def handle_display_data(self, cnt, cell, outcnt, out, state):
+        data_handlers = self.data_handlers
+        for datacnt, (ctype, data) in enumerate(out['data'].items()):
+            handler = data_handlers.get(ctype) or data_handlers.get(ctype.split("/")[0])
+            if handler is None:
+                print(f"Warning: unknown content type {ctype} in cell number {cnt+1}: skipping")
+                continue
+            yield from handler(cnt, outcnt, datacnt, ctype, data, state)
+
+    def handle_text_data(self, cnt, outcnt, datacnt, ctype, text, state):
+        text_budget = state['text_budget']
+        if text_budget is not None:
+            nbytes = len(text.encode())
+            if nbytes > text_budget:
+                dfn = f"{self.static_dir}/cell_{cnt+1}_text_output_{outcnt+1:02d}_{datacnt+1:02d}"
+                yield self.make_spilled_text_output(text, ctype, dfn) + "\n\n"
+                return
+            state['text_budget'] = text_budget - nbytes
+        yield f'<p>{text}</p>\n\n'
+
+    def handle_image_data(self, cnt, outcnt, datacnt, ctype, b64dat, state):
+        fext = ctype.split("/")[-1]
+        dfn = f"{self.static_dir}/cell_{cnt+1}_display_data_{datacnt+1:02d}.{fext}"
+        dfnb = os.path.basename(dfn)
+        if not os.path.exists(self.static_dir):
+            os.mkdir(self.static_dir)
+        if self.optimize_images:
+            yield self.make_optimized_img_tag(base64.b64decode(b64dat), fext) + "\n\n"
+            return
+        with open(dfn, 'wb') as imfp:
+            imfp.write(base64.b64decode(b64dat))
+        yield f'<img src="CURRENT/{dfnb}" alt="{dfnb}"/>\n\n'
+
+    def make_spilled_text_output(self, text, ctype, dfn):
+        '''
+        Write oversized text output to a static file, and return HTML with a truncated preview
+        of the text (plain text only), and a link to the full output.
+
+        text = (str) text output, from the notebook's display_data output
+        ctype = (str) content type, e.g. text/plain or text/html
+        dfn = (str) static file path, without extension
+        '''
+        dfn += ".html" if ctype=="text/html" else ".txt"
+        dfnb = os.path.basename(dfn)
+        if not os.path.exists(self.static_dir):
+            os.mkdir(self.static_dir)
+        with open(dfn, 'w') as tfp:
+            tfp.write(text)
+        html = ""
+        if ctype!="text/html":
+            html = f'<p>{text[:self.text_preview_length]}</p>\n\n'
+        html += f'<p><a href="CURRENT/{dfnb}" target="_blank">[output truncated: view full output ({len(text.encode())} bytes)]</a></p>'
+        if self.verbose:
+            print(f"        wrote oversized text output to {dfnb}")
+        return html
+
+    def make_optimized_img_tag(self, imdata, fext):
+        '''
+        Write optimized version of image data to the static directory, and return <img> tag for it.
+        Optimized images are named by the hash of their source data (and the optimization options),
+        and the results are cached in {static_dir}/.ipynb2catsoop_images.json (read once, and written
+        once at the end of each conversion), so that an unchanged image is only processed once.
+
+        imdata = (bytes) raw image data, from the notebook's display_data output
+        fext = (str) image file extension, e.g. png
+        '''
+        options = f"|{self.max_image_width}|{self.image_format}".encode()
+        key = hashlib.sha256(imdata + options).hexdigest()
+        cache = self.image_cache_entries()
+        entry = cache.get(key)
+        if not (entry and os.path.exists(f"{self.static_dir}/{entry['fn']}")):
+            odata, ofext, width, height = self.optimize_image(imdata, fext)
+            entry = {'fn': f"img_{key[:16]}.{ofext}", 'width': width, 'height': height}
+            with open(f"{self.static_dir}/{entry['fn']}", 'wb') as imfp:
+                imfp.write(odata)
+            cache[key] = entry
+            self.image_cache['dirty'] = True
+            if self.verbose:
+                print(f"        optimized image {entry['fn']}: {len(imdata)} -> {len(odata)} bytes")
+        dfnb = entry['fn']
+        size = ""
+        if entry['width'] and entry['height']:
+            size = f' width="{entry["width"]}" height="{entry["height"]}"'
+        return f'<img src="CURRENT/{dfnb}" alt="{dfnb}"{size} loading="lazy"/>'
+
+    def image_cache_entries(self):
+        '''
+        Return dict of optimized image cache entries for static_dir, read from its image cache file
+        once per conversion; new entries are written out by save_image_cache
+        '''
+        cache_fn = f"{self.static_dir}/{self.IMAGE_CACHE_FN}"
+        if self.image_cache is None or self.image_cache['fn']!=cache_fn:
+            self.save_image_cache()
+            entries = {}
+            if os.path.exists(cache_fn):
+                try:
+                    with open(cache_fn) as cfp:
+                        entries = json.load(cfp)
+                except Exception as err:
+                    entries = {}
+            self.image_cache = {'fn': cache_fn, 'entries': entries, 'dirty': False}
+        return self.image_cache['entries']
+
+    def save_image_cache(self):
+        '''
+        Write the optimized image cache file, if images were added to it since it was read
+        '''
+        if not (self.image_cache and self.image_cache['dirty']):
+            return
+        cache_fn = self.image_cache['fn']
+        tmpfn = f"{cache_fn}.{os.getpid()}.tmp"
+        with open(tmpfn, 'w') as cfp:
+            json.dump(self.image_cache['entries'], cfp, indent=1)
+        os.replace(tmpfn, cache_fn)
+        self.image_cache['dirty'] = False
+
+    def optimize_image(self, imdata, fext):
+        '''
+        Cap image width at max_image_width, and recompress PNG images, either losslessly
+        or to WebP (per image_format).  Requires PIL; without it, the image is returned unchanged.
+
+        Returns tuple (data, fext, width, height), where width and height may be None if unknown.
+        Image data which PIL cannot decode is returned unchanged.
+        '''
+        if Image is None or fext not in ["png", "jpeg", "jpg", "gif", "webp"]:
+            width, height = png_dimensions(imdata) if fext=="png" else (None, None)
+            return imdata, fext, width, height
+        try:
+            im = Image.open(io.BytesIO(imdata))
+            im.load()
+        except Exception as err:	# not decodable by PIL: keep the original image data
+            if self.verbose:
+                print(f"        could not decode {fext} image ({err}); not optimized")
+            width, height = png_dimensions(imdata) if fext=="png" else (None, None)
+            return imdata, fext, width, height
+        im_format = im.format
+        resized = False
+        if self.max_image_width and im.width > self.max_image_width:
+            height = max(1, round(im.height * self.max_image_width / im.width))
+            im = im.resize((self.max_image_width, height), Image.LANCZOS)
+            resized = True
+        out = io.BytesIO()
+        if fext=="png" and self.image_format=="webp":
+            im.save(out, "WEBP", quality=90, method=6)
+            fext = "webp"
+        elif fext=="png":
+            im.save(out, "PNG", optimize=True)
+        elif resized:
+            im.save(out, im_format)
+        else:
+            return imdata, fext, im.width, im.height
+        odata = out.getvalue()
+        if fext=="png" and not resized and len(odata) >= len(imdata):
+            odata = imdata
+        return odata, fext, im.width, im.height
+
     def fix_markdown(self, md):
         '''
         Fix markdown to match what is needed for catsoop.
@@ -232,7 +1309,7 @@ class ipynb2catsoop:
         }
 
     def do_submit(self, csq_submission=None, csq_soln="", csq_tests=None, csq_code_pre="",
-                  verbose=True, return_csq=False, **kwargs):
+                  verbose=True, return_csq=False, csq_sandbox_options=None, **kwargs):
         '''
         Run catsoop python code checker on the pythoncode problem with the given parameters
     
@@ -247,6 +1324,8 @@ class ipynb2catsoop:
                     is because in production, the answer is obtained from running python in a sandbox,
                     with the connection being strings passed back and forth.
         csq_code_pre = (str) code pre-pended to submission (and solution?) before running
+        csq_sandbox_options = (dict) extra catsoop sandbox options; include 'sandbox': 'forkpool' to run
+                              tests using the warm interpreter pool in ipynb2catsoop.forkpool
         verbose = (bool) if True, then print out final score (should be 1 if correct, or 0 if incorrect) and msg
         '''
         if verbose > 1:
@@ -258,6 +1337,16 @@ class ipynb2catsoop:
             raise Exception("[pycode_question.do_submit] aborting: csq_soln is undefined!")
         if not csq_tests:
             raise Exception("[pycode_question.do_submit] aborting: csq_tests is undefined!")
+
+        cache_key = None
+        if self.grade_cache is not None and not return_csq:
+            cache_key = self.grade_cache.make_key(csq_submission, csq_soln, csq_tests, csq_code_pre, csq_sandbox_options)
+            ret = self.grade_cache.get(cache_key)
+            if ret is not None:
+                if verbose:
+                    print("score=", ret['score'], "(cached)")
+                    display(HTML(ret['msg']))
+                return ret
     
         context = {}
         # os.environ['CATSOOP_CONFIG'] = f"{os.getcwd()}/catsoop_config.py"
@@ -286,6 +1375,11 @@ class ipynb2catsoop:
         info["csq_python_interpreter"] = sys.executable
         info["csq_python_sandbox"] = "python"
         info['csq_sandbox_options'] = {'do_rlimits': False}
+        info['csq_sandbox_options'].update(csq_sandbox_options or {})
+        if info['csq_sandbox_options'].get("sandbox")=="forkpool":
+            from ipynb2catsoop import forkpool
+            info["csq_python_sandbox"] = forkpool.SANDBOX_TYPE
+            info["csq_python_sandbox_type"] = forkpool.SANDBOX_TYPE
         
         form = {csq_name: csq_submission}
         if return_csq:
@@ -293,8 +1387,16 @@ class ipynb2catsoop:
                     'form': form,
                     'info': info,
                 }
-    
+
+        outcome = {'cacheable': cache_key is not None and not info.get("csq_use_simple_checker"), 'checks': 0}
+        if outcome['cacheable']:	# watch the test runs, so that errors and timeouts are not cached
+            default_checker = info.get("csq_check_function", csq["_default_check_function"])
+            info["csq_tests"] = [dict(test, check_function=GradeCache.watch_checker(test.get("check_function", default_checker), outcome))
+                                 for test in info["csq_tests"]]
         ret = csq["handle_submission"](form, **info)
+        ngraded = len([test for test in info["csq_tests"] if test.get("grade", True)])
+        if outcome['cacheable'] and outcome['checks']==ngraded:	# every test was run and checked
+            self.grade_cache.put(cache_key, ret)
         if verbose:
             print("score=", ret['score'])
             # print("msg=", ret['msg'])
@@ -321,13 +1423,15 @@ class ipynb2catsoop:
             raise Exception(f"[pythoncode_test] aborting - could not evaluate csq_tests, got err={err}")
         return parameters
 
-    def pythoncode_test(self, celltext, verbose=False, return_csq=False):
+    def pythoncode_test(self, celltext, verbose=False, return_csq=False, sandbox_options=None):
         '''
         Call this function with _i as the celltext argument, in a jupyter notebook code cell,
         to test the catsoop pythoncode problem defined in the previous cell.
+
+        sandbox_options = (dict) extra catsoop sandbox options, e.g. {'sandbox': 'forkpool'} (see do_submit)
         '''
         parameters = self.celltext_to_parameters_pythoncode(celltext, verbose=verbose)
-        return self.do_submit(return_csq=return_csq, **parameters)
+        return self.do_submit(return_csq=return_csq, csq_sandbox_options=sandbox_options, **parameters)
 
     def set_verbose_logging(self):
         '''
@@ -367,6 +1471,257 @@ class ipynb2catsoop:
             pass
         return ret
 
+    def trigger_webhooks(self, hosts=None, urls=None, branch='master', repo_name='ipynb', verify=True,
+                         concurrency=10, retries=3, timeout=30, host_timeouts=None):
+        '''
+        Send github-like webhook update to many servers at once (e.g. a fleet of catsoop replicas),
+        concurrently, over pooled connections, with retries (see webhook.push_webhooks_async).
+        Prints a line for each server, and returns the report, a list with a dict for each server.
+
+        hosts = (list) server hostnames (the webhook URL used is https://<host>/gitreload/)
+        urls = (list) webhook URLs, used in addition to hosts
+        concurrency = (int) maximum number of requests in progress at once
+        retries = (int) number of retries for each server, after a connection error, timeout, or 5xx response
+        timeout = (float) timeout in seconds for each request
+        host_timeouts = (dict) timeouts for specific hostnames, overriding timeout
+        '''
+        from ipynb2catsoop.webhook import push_webhooks
+        headers = {'X-GitHub-Event': 'push'}
+        payload = {'ref': f"a/b/{branch}",
+                   'repository': {'name': repo_name},
+                   'deleted': False,
+        }
+        targets = [f"https://{host}/gitreload/" for host in (hosts or [])] + list(urls or [])
+        report = push_webhooks(targets, payload, headers=headers, verify=verify, concurrency=concurrency,
+                               retries=retries, timeout=timeout, host_timeouts=host_timeouts)
+        for result in report:
+            status = "ok" if result['ok'] else f"FAILED ({result['error']})"
+            print(f"{result['url']}: {status}, {result['attempts']} attempt(s), {result['time']:.2f}s")
+            if self.verbose and isinstance(result['response'], dict):
+                print(result['response'].get('all', {}).get('stdout', ""))
+        return report
+
+#-----------------------------------------------------------------------------
+
+def read_pages_index(index_fn):
+    '''
+    Return pages index (see ipynb2catsoop.update_pages_index) read from file index_fn, or None if there is none
+    '''
+    if not os.path.exists(index_fn):
+        return None
+    try:
+        with open(index_fn) as fp:
+            return json.load(fp)
+    except Exception as err:
+        return None
+
+def question_names(text):
+    '''
+    Return list of the csq_names of the catsoop questions in text (questions without a csq_name are omitted)
+    '''
+    return [name for qtype, name in question_blocks(text)]
+
+def render_markdown(text):
+    '''
+    Render markdown text to HTML, the same way catsoop does for markdown pages, with the
+    contents of pre, question, math, and script tags passed through untouched
+    '''
+    from catsoop import markdown
+
+    protected = []
+    def protect(mo):
+        protected.append(mo.group(0))
+        return f"CSQPROTECTED{len(protected)-1}X"
+
+    tags = ("pre", "question", "(?:display)?math", "script")
+    checker = re.compile(r"<(%s)(.*?)>(.*?)</\1>" % "|".join(tags), re.MULTILINE | re.DOTALL)
+    html = markdown.markdown(checker.sub(protect, text))
+    return re.sub("CSQPROTECTED([0-9]+)X", lambda mo: protected[int(mo.group(1))], html)
+
+class GradeCache:
+    '''
+    Size-bounded LRU cache of pythoncode grading results, keyed by a hash of the normalized
+    submission and of the problem (csq_soln, csq_tests, csq_code_pre, csq_sandbox_options), with an
+    optional on-disk store (one JSON file per result), which may be shared between processes.
+    Only results from runs which completed without error are cached (see watch_checker).
+    '''
+    def __init__(self, maxsize=1024, cache_dir=None):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if cache_dir and not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def normalize_code(code):
+        '''
+        Return code as its sequence of python tokens, so that submissions which differ only in line endings,
+        trailing whitespace, or blank lines share cache entries; whitespace within string literals, and
+        indentation, are kept.  Code which cannot be tokenized is kept as is (apart from line endings).
+        '''
+        import tokenize
+        code = code.replace("\r\n", "\n").replace("\r", "\n")
+        try:
+            tokens = list(tokenize.generate_tokens(io.StringIO(code).readline))
+        except (tokenize.TokenError, SyntaxError):
+            return code
+        return "\n".join([f"{tok.type} {tok.string.rstrip() if tok.type==tokenize.COMMENT else tok.string!r}"
+                          for tok in tokens if tok.type not in (tokenize.NL, tokenize.ENDMARKER)])
+
+    @staticmethod
+    def stable_repr(obj, seen=None):
+        '''
+        Return repr of obj which is stable across processes.  Functions are given by name, bytecode,
+        constants, defaults, and closure cell values, so that functions with the same name but different
+        code or closed-over values (e.g. pycode_allclose_checker(rtol=...) checkers) differ.
+        '''
+        seen = seen or set()
+        if id(obj) in seen:
+            return "<...>"
+        code = getattr(obj, '__code__', None)
+        if callable(obj):
+            name = f"{getattr(obj, '__module__', '')}.{getattr(obj, '__qualname__', type(obj).__name__)}"
+            if code is None:
+                return f"<{name}>"
+            seen = seen | {id(obj)}
+            closure = []
+            for cell in getattr(obj, '__closure__', None) or ():
+                try:
+                    closure.append(GradeCache.stable_repr(cell.cell_contents, seen))
+                except ValueError:		# empty cell
+                    closure.append("<empty>")
+            return (f"<{name} {GradeCache.stable_repr(code, seen)} defaults={GradeCache.stable_repr(obj.__defaults__, seen)}"
+                    f" kwdefaults={GradeCache.stable_repr(getattr(obj, '__kwdefaults__', None), seen)}"
+                    f" closure=({', '.join(closure)})>")
+        if isinstance(obj, type(GradeCache.stable_repr.__code__)):
+            return (f"<code {hashlib.sha256(obj.co_code).hexdigest()} {GradeCache.stable_repr(obj.co_consts, seen)}"
+                    f" {GradeCache.stable_repr(obj.co_names, seen)}>")
+        if isinstance(obj, dict):
+            items = sorted([(repr(k), GradeCache.stable_repr(v, seen)) for k, v in obj.items()])
+            return "{" + ", ".join([f"{k}: {v}" for k, v in items]) + "}"
+        if isinstance(obj, (list, tuple)):
+            return type(obj).__name__ + "(" + ", ".join([GradeCache.stable_repr(x, seen) for x in obj]) + ")"
+        if isinstance(obj, (set, frozenset)):
+            return type(obj).__name__ + "(" + ", ".join(sorted([GradeCache.stable_repr(x, seen) for x in obj])) + ")"
+        return repr(obj)
+
+    def make_key(self, submission, csq_soln, csq_tests, csq_code_pre, csq_sandbox_options=None):
+        problem = "\0".join([csq_soln, self.stable_repr(csq_tests), csq_code_pre or "",
+                             self.stable_repr(csq_sandbox_options or {})])
+        problem_hash = hashlib.sha256(problem.encode()).hexdigest()
+        submission_hash = hashlib.sha256(self.normalize_code(submission).encode()).hexdigest()
+        return f"{problem_hash[:32]}_{submission_hash[:32]}"
+
+    @staticmethod
+    def watch_checker(checker, outcome):
+        '''
+        Return check_function wrapping checker, which counts the checks done in outcome['checks'], and sets
+        outcome['cacheable'] to False if the submission or solution run produced an error or did not
+        complete (e.g. timed out), or if checker fails, since such results may differ when graded again
+        '''
+        def check(submission, solution):
+            outcome['checks'] = outcome.get('checks', 0) + 1
+            for result in (submission, solution):
+                if result.get('err') or not result.get('details', {}).get('complete', True):
+                    outcome['cacheable'] = False
+            try:
+                return checker(submission, solution)
+            except Exception:
+                outcome['cacheable'] = False
+                raise
+        return check
+
+    def get(self, key):
+        '''
+        Return cached result for key, or None
+        '''
+        with self.lock:
+            ret = self.results.get(key)
+            if ret is not None:
+                self.results.move_to_end(key)
+                self.hits += 1
+                return ret
+        if self.cache_dir and os.path.exists(f"{self.cache_dir}/{key}.json"):
+            try:
+                with open(f"{self.cache_dir}/{key}.json") as fp:
+                    ret = json.load(fp)
+            except Exception as err:
+                ret = None
+            if ret is not None:
+                self.put(key, ret, store=False)
+                with self.lock:
+                    self.hits += 1
+                return ret
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, ret, store=True):
+        with self.lock:
+            self.results[key] = ret
+            self.results.move_to_end(key)
+            while len(self.results) > self.maxsize:
+                self.results.popitem(last=False)
+        if store and self.cache_dir:
+            try:
+                data = json.dumps(ret)
+            except Exception as err:		# keep just the score and message if there is anything else
+                data = json.dumps({'score': ret.get('score'), 'msg': ret.get('msg')})
+            tmpfn = f"{self.cache_dir}/{key}.json.{os.getpid()}.tmp"
+            with open(tmpfn, 'w') as fp:
+                fp.write(data)
+            os.replace(tmpfn, f"{self.cache_dir}/{key}.json")
+
+def unit_shard(unit_name, nshards):
+    '''
+    Return shard number (0 to nshards-1) for the named unit, using a hash which is stable
+    across machines and python processes
+    '''
+    return int(hashlib.sha1(unit_name.encode()).hexdigest(), 16) % nshards
+
+class FastNotebook:
+    '''
+    Minimal stand-in for nbformat's v4 NotebookNode, made from the decoded notebook JSON, providing
+    the cells, with multi-line strings given as lists of lines joined (as nbformat.reads does).
+    '''
+    def __init__(self, nbdict):
+        self.metadata = nbdict.get('metadata', {})
+        self.cells = nbdict.get('cells', [])
+        for cell in self.cells:
+            rejoin_lines(cell)
+
+def rejoin_lines(cell):
+    '''
+    Join cell source, stream text, and non-JSON output data, which nbformat v4 allows to be
+    given as lists of lines, into strings
+    '''
+    def join(x):
+        return "".join(x) if isinstance(x, list) else x
+
+    cell.setdefault('metadata', {})
+    cell['source'] = join(cell.get('source', ""))
+    if cell['cell_type']!='code':
+        return
+    for out in cell.setdefault('outputs', []):
+        if 'text' in out:
+            out['text'] = join(out['text'])
+        data = out.get('data', {})
+        for ctype, value in data.items():
+            if not (ctype=="application/json" or ctype.endswith("+json")):
+                data[ctype] = join(value)
+
+def png_dimensions(data):
+    '''
+    Return (width, height) of PNG image data, read from its IHDR header, or (None, None)
+    if the data is not a PNG image
+    '''
+    if len(data) < 24 or data[:8] != b"\x89PNG\r\n\x1a\n" or data[12:16] != b"IHDR":
+        return None, None
+    return struct.unpack(">II", data[16:24])
+
 #-----------------------------------------------------------------------------
 
 def pycode_equal(submission, solution):
@@ -383,10 +1738,173 @@ def pycode_equal(submission, solution):
         print("submission=%s, solution=%s" % (submission, solution))
     return submission == solution
 
+NUMPY_SCALAR_PAT = re.compile(r"(?:np|numpy)\.(?:float|int|uint|complex|bool_)\w*\(([^()]*)\)")
+NUMPY_ARRAY_PAT = re.compile(r"^\s*(?:(?:np|numpy)\.)?array\((.*?)(?:,\s*dtype=[\w.]+)?\)\s*$", re.DOTALL)
+
+def numeric_array(value):
+    '''
+    Convert result value (a python number or sequence of numbers, or the repr string of one, as
+    returned by catsoop when result_as_string is set) into a numpy array.  Reprs of numpy scalars
+    (e.g. "np.float64(0.5)") and arrays are accepted.  Flat lists are parsed without literal_eval.
+    Returns None if the value is not numeric.
+    '''
+    if not isinstance(value, str):
+        try:
+            arr = np.asarray(value)
+        except Exception as err:
+            return None
+        return arr if arr.dtype.kind in "biufc" else None
+    text = NUMPY_SCALAR_PAT.sub(r"\1", value)
+    mo = NUMPY_ARRAY_PAT.match(text)
+    if mo:
+        text = mo.group(1)
+    text = text.strip()
+    if text[:1] in "[(" and text[-1:] in "])" and not any(c in text[1:-1] for c in "[]()"):
+        inner = text[1:-1].strip().rstrip(",")		# flat list or tuple: vectorized parse
+        try:
+            return np.array(inner.split(",") if inner else [], dtype=float)
+        except ValueError:
+            pass
+    try:
+        return numeric_array(ast.literal_eval(text))
+    except Exception as err:
+        return None
+
+def pycode_allclose(submission, solution, rtol=1e-5, atol=1e-8):
+    '''
+    procedure used to check for correctness of test, given results from submission and from solution,
+    which are numbers or (nested) lists of numbers, compared elementwise as numpy arrays with
+    relative tolerance rtol and absolute tolerance atol (see numpy.isclose; nan matches nan).
+    Results may be strings (as with result_as_string), which are parsed once each; identical
+    strings match without being parsed.
+
+    Returns (score, msg) tuple, as accepted by catsoop from a check_function, with msg giving the
+    index of the first mismatch, if any.  Use pycode_allclose_checker to make a check_function with
+    other tolerances.
+    '''
+    if isinstance(submission, dict):
+        submission = submission.get("result")
+    if isinstance(solution, dict):
+        solution = solution.get("result")
+    if submission is None or solution is None:
+        return (0.0, "No result")
+    if isinstance(submission, str) and submission == solution:
+        return (1.0, "")
+    if np is None:
+        raise Exception("[ipynb2catsoop] pycode_allclose requires numpy")
+    sub = numeric_array(submission)
+    soln = numeric_array(solution)
+    if soln is None:
+        return (1.0, "") if submission == solution else (0.0, "Expected result is not numeric")
+    if sub is None:
+        return (0.0, "Result is not numeric")
+    if sub.shape != soln.shape:
+        return (0.0, f"Result has shape {sub.shape}, expected shape {soln.shape}")
+    close = np.isclose(sub, soln, rtol=rtol, atol=atol, equal_nan=True)
+    if close.all():
+        return (1.0, "")
+    idx = np.unravel_index(np.argmin(close), close.shape)
+    where = f" at index {idx[0] if len(idx)==1 else tuple(int(k) for k in idx)}" if idx else ""
+    return (0.0, f"{np.size(close) - np.count_nonzero(close)} value(s) differ; first mismatch{where}: "
+            f"got {sub[idx].item()!r}, expected {soln[idx].item()!r}")
+
+def pycode_allclose_checker(rtol=1e-5, atol=1e-8):
+    '''
+    Return check_function for csq_tests, which is pycode_allclose with the given tolerances, e.g.
+
+        [{'code': 'ans = [p(x) for x in range(10)]', 'check_function': pycode_allclose_checker(rtol=1e-3)}]
+    '''
+    def check(submission, solution):
+        return pycode_allclose(submission, solution, rtol=rtol, atol=atol)
+    return check
+
+class ValidationTimeout(BaseException):	# not an Exception, so that it is not caught by the grading code
+    pass
+
+VALIDATION_STARTED = None	# queue for reporting (problem index, pid, start time), in validation workers
+
+def kill_child_processes(pid):
+    '''
+    Kill the child processes of process pid, with their process groups if they lead one (e.g. catsoop
+    sandbox processes, which start their own session), so they are not orphaned when a validation
+    is interrupted.  Does nothing where /proc is not available.
+    '''
+    import signal
+    for stat_fn in glob.glob("/proc/[0-9]*/stat"):
+        try:
+            with open(stat_fn) as fp:
+                fields = fp.read().rsplit(")", 1)[1].split()	# state, ppid, pgrp, ...
+            child, ppid, pgrp = int(stat_fn.split("/")[2]), int(fields[1]), int(fields[2])
+        except (OSError, ValueError, IndexError):
+            continue
+        if ppid!=pid:
+            continue
+        try:
+            if pgrp==child:
+                os.killpg(pgrp, signal.SIGKILL)
+            else:
+                os.kill(child, signal.SIGKILL)
+        except OSError:
+            pass
+
+def init_validation_worker(started):
+    global VALIDATION_STARTED
+    VALIDATION_STARTED = started
+    init_catsoop(False)
+
+def validate_pythoncode_problem(celltext, timeout=None, key=None):
+    '''
+    Validate a single pythoncode problem, given its cell text, by running its staff solution,
+    and sample submission if present, through the catsoop grader.  Runs in a validation worker
+    process (see ipynb2catsoop.validate_pythoncode_problems), after init_validation_worker.
+
+    timeout = (float) seconds after which validation is interrupted, with status "timeout"
+    key = (int) problem index, reported with the start time to the process running the validation
+
+    Returns dict with csq_name, status, soln_score, submission_score, msg, and time.
+    '''
+    import signal
+    t0 = time.time()
+    if key is not None and VALIDATION_STARTED is not None:
+        VALIDATION_STARTED.put((key, os.getpid(), t0))
+    ret = {'csq_name': None, 'soln_score': None, 'submission_score': None, 'msg': ""}
+    use_alarm = timeout and hasattr(signal, "setitimer")
+    if use_alarm:
+        def on_alarm(signum, frame):
+            raise ValidationTimeout()
+        old_handler = signal.signal(signal.SIGALRM, on_alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        parameters = I2C.celltext_to_parameters_pythoncode(celltext)
+        ret['csq_name'] = parameters['csq_name'].strip().strip("'\"") or None
+        submission = parameters.pop('csq_submission')
+        soln = I2C.do_submit(csq_submission=parameters['csq_soln'], verbose=False, **parameters)
+        ret['soln_score'] = soln['score']
+        if submission.strip():
+            ret['submission_score'] = I2C.do_submit(csq_submission=submission, verbose=False, **parameters)['score']
+        if soln['score']==1:
+            ret['status'] = "pass"
+        else:
+            ret['status'] = "fail"
+            ret['msg'] = "staff solution did not get full score"
+    except ValidationTimeout:
+        kill_child_processes(os.getpid())	# e.g. the sandbox running the interrupted test
+        ret['status'] = "timeout"
+        ret['msg'] = f"no result after {timeout} seconds"
+    except Exception as err:
+        ret['status'] = "error"
+        ret['msg'] = str(err)
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, old_handler)
+    ret['time'] = time.time() - t0
+    return ret
+
 #-----------------------------------------------------------------------------
 # use in an ipython / jypyter notebook
 
-def init_catsoop():
+def init_catsoop(verbose=True):
     ccfn = "/tmp/config.py"
     with open(ccfn, 'w') as ofp:
         ofp.write("cs_data_root='/tmp'\n")
@@ -418,11 +1936,13 @@ def init_catsoop():
     globals()['I2C'] = I2C
     globals()['pythoncode_test'] = I2C.pythoncode_test            
     globals()['trigger_webhook'] = I2C.trigger_webhook
+    globals()['trigger_webhooks'] = I2C.trigger_webhooks
     context = {}
     globals()['context'] = context
     loader.load_global_data(context)
     if 'tutor' in context:
-        print(f"[ipynb2catsoop.init_catsoop] success!")
+        if verbose:
+            print(f"[ipynb2catsoop.init_catsoop] success!")
     else:
         print(f"[ipynb2catsoop.init_catsoop] catsoop failed to initialize properly?  missing tutor - grading code probably will not work")
 
@@ -442,14 +1962,57 @@ def I2C_CommandLine():
     parser.add_argument("-o", "--output-filename", type=str, help="name of output file (for single conversion - defaults to content.md if unspecified)", default=None)
     parser.add_argument("--convert-all", action="store_true", help="convert all <inputfn>/*.ipynb notebooks, using <inputfn> as the course content directory")
     parser.add_argument("--force", action="store_true", help="force conversion even if output is newer than input")
+    parser.add_argument("--shard", type=str, help="with --convert-all, only convert shard i of N of the units (given as i/N), and write a shard manifest", default=None)
+    parser.add_argument("--merge-shards", action="store_true", help="merge the shard manifests for course directory <inputfn>, checking for conflicts")
+    parser.add_argument("--build-index", action="store_true", help="(re)write the course index for course directory <inputfn>, without converting")
+    parser.add_argument("--clean-assets", action="store_true", help="remove generated __STATIC__ files no longer used by any page of course directory <inputfn>")
+    parser.add_argument("--dry-run", action="store_true", help="with --clean-assets, only list the files which would be removed")
+    parser.add_argument("--optimize-images", action="store_true", help="resize / recompress notebook output images, and add size hints to <img> tags")
+    parser.add_argument("--max-image-width", type=int, help="maximum width (pixels) of optimized images", default=None)
+    parser.add_argument("--image-format", type=str, help="format for optimized PNG images: png or webp", default="png",
+                        choices=["png", "webp"])
+    parser.add_argument("--time-stages", action="store_true", help="report time spent in each conversion stage (with --verbose)")
+    parser.add_argument("--html", action="store_true", help="output content.xml, with markdown pre-rendered to HTML, instead of content.md")
+    parser.add_argument("--split-heading-level", type=int, help="split notebooks into multiple pages at headings of this level or above", default=None)
+    parser.add_argument("--max-page-cells", type=int, help="split notebooks into pages of at most this many cells", default=None)
+    parser.add_argument("--max-page-bytes", type=int, help="split notebooks into pages of at most about this many bytes", default=None)
+    parser.add_argument("--cell-cache", action="store_true", help="cache the output for each cell, so that reconversion only re-renders changed cells")
+    parser.add_argument("--fast-reader", action="store_true", help="read notebooks without nbformat schema validation (faster)")
+    parser.add_argument("--validate", action="store_true", help="validate all pythoncode problems, by running their solutions through the grader")
+    parser.add_argument("--validate-timeout", type=float, help="maximum time (seconds) for validating each pythoncode problem", default=60)
+    parser.add_argument("--max-inline-text", type=int, help="maximum bytes of text output inlined per cell; larger outputs are written to __STATIC__", default=None)
 
     args = parser.parse_args()
-    i2c = ipynb2catsoop(args.unit_name, args.directory, verbose=args.verbose, force_conversion=args.force)
+    i2c = ipynb2catsoop(args.unit_name, args.directory, verbose=args.verbose, force_conversion=args.force,
+                        optimize_images=args.optimize_images, max_image_width=args.max_image_width,
+                        image_format=args.image_format, max_inline_text=args.max_inline_text,
+                        time_stages=args.time_stages, validate=args.validate, validate_timeout=args.validate_timeout,
+                        fast_reader=args.fast_reader, output_format="html" if args.html else "md",
+                        cell_cache=args.cell_cache, split_heading_level=args.split_heading_level,
+                        max_page_cells=args.max_page_cells, max_page_bytes=args.max_page_bytes)
 
-    if args.convert_all:
-        i2c.convert_all(args.ifn)
+    if args.merge_shards:
+        i2c.merge_shard_manifests(args.ifn)
+    elif args.build_index:
+        i2c.write_course_index(args.ifn)
+    elif args.clean_assets:
+        for path in i2c.clean_stale_assets(args.ifn, dry_run=args.dry_run):
+            print(f"{'would remove' if args.dry_run else 'removed'} {path}")
+    elif args.convert_all:
+        shard = None
+        if args.shard:
+            try:
+                shard = tuple(int(x) for x in args.shard.split("/"))
+            except ValueError:
+                shard = ()
+            if len(shard)!=2 or not (0 <= shard[0] < shard[1]):
+                parser.error(f"invalid shard {args.shard}: should be i/N, with 0 <= i < N")
+        i2c.convert_all(args.ifn, shard=shard)
     else:
         i2c.convert(args.ifn, ofn=args.output_filename)
+        if args.validate:
+            i2c.pythoncode_problems += i2c.collect_pythoncode_problems(args.ifn)
+            i2c.validate_pythoncode_problems()
 
 if __name__=="__main__":
     I2C_CommandLine()
@@ -5,18 +5,287 @@ Instantiate this within a catsoop instance, at /nbif, using (within content.py):
     from ipynb2catsoop import nbif
     nbif.catsoop_response(globals())
 '''
+import os
+import gzip
 import json
+import time
+import hashlib
 import logging
+import threading
+from collections import defaultdict, OrderedDict
+from ipynb2catsoop import course_index
+from ipynb2catsoop.course_index import normalize_csq_name
+
+try:
+    import brotli
+except Exception as err:
+    brotli = None
+
+LOGGER = logging.getLogger("cs.nbif")
+HANDLER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nbif_handler")
+
+class SingleFlight:
+    '''
+    Coalesce concurrent calls with the same key: the first caller runs the computation, and
+    callers arriving while it is in flight wait for it, and share its result.  Nothing is
+    kept once the computation has finished.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+
+    def do(self, key, func):
+        '''
+        Return tuple (result, shared), where result is func(), or the result of the in-flight call
+        of func with the same key, and shared is True if the result came from another caller.
+        '''
+        with self.lock:
+            call = self.in_flight.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self.in_flight[key] = {'done': threading.Event()}
+        if not is_leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result'], True
+        try:
+            call['result'] = func()
+        except Exception as err:
+            call['error'] = err
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            call['done'].set()
+        return call['result'], False
+
+class Metrics:
+    '''
+    In-process counters and latency histograms, which can be output in Prometheus text format.
+    Each metric is identified by its name and labels (given as keyword arguments).
+    '''
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.histograms = {}
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += amount
+
+    def observe(self, name, seconds, **labels):
+        '''
+        Add observation (in seconds) to histogram
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = {'buckets': [0] * len(self.BUCKETS), 'sum': 0.0, 'count': 0}
+            for k, le in enumerate(self.BUCKETS):
+                if seconds <= le:
+                    hist['buckets'][k] += 1
+                    break
+            hist['sum'] += seconds
+            hist['count'] += 1
+
+    def timed(self, name, func, **labels):
+        '''
+        Return func(), recording the time it takes in histogram name
+        '''
+        t0 = time.perf_counter()
+        try:
+            return func()
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    def prometheus_text(self):
+        '''
+        Return all metrics, in Prometheus text exposition format
+        '''
+        def fmt(labels, extra=()):
+            labels = tuple(labels) + tuple(extra)
+            if not labels:
+                return ""
+            esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+            return "{" + ",".join([f'{k}="{esc(v)}"' for k, v in labels]) + "}"
+
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {k: dict(v, buckets=list(v['buckets'])) for k, v in self.histograms.items()}
+        lines = []
+        for name in sorted(set(k[0] for k in counters)):
+            lines.append(f"# TYPE {name} counter")
+            for (cname, labels), value in sorted(counters.items()):
+                if cname==name:
+                    lines.append(f"{name}{fmt(labels)} {value}")
+        for name in sorted(set(k[0] for k in histograms)):
+            lines.append(f"# TYPE {name} histogram")
+            for (hname, labels), hist in sorted(histograms.items()):
+                if hname!=name:
+                    continue
+                cumulative = 0
+                for le, n in zip(self.BUCKETS, hist['buckets']):
+                    cumulative += n
+                    lines.append(f"{name}_bucket{fmt(labels, [('le', le)])} {cumulative}")
+                lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {hist['count']}")
+                lines.append(f"{name}_sum{fmt(labels)} {hist['sum']}")
+                lines.append(f"{name}_count{fmt(labels)} {hist['count']}")
+        return "\n".join(lines) + "\n"
+
+class CompressionCache:
+    '''
+    Compress response bodies, with gzip or brotli, negotiated using the request's Accept-Encoding
+    header.  Compressed bodies are kept in a least-recently-used cache keyed by the hash of the
+    body and the encoding, so that a response which is the same for many requests (e.g. a
+    question page, or question JSON) is only compressed once.
+    '''
+    MIN_SIZE = 1024		# bodies smaller than this are sent uncompressed
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        '''
+        max_bytes = (int) maximum total size of the compressed bodies kept in the cache
+        '''
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()
+
+    @staticmethod
+    def choose_encoding(accept_encoding):
+        '''
+        Return the preferred content encoding ("br", "gzip", or None for identity) accepted by
+        the client, given the value of its Accept-Encoding header
+        '''
+        accepted = {}
+        for item in (accept_encoding or "").split(","):
+            name, _, params = item.strip().partition(";")
+            q = 1.0
+            for param in params.split(";"):
+                key, _, value = param.strip().partition("=")
+                if key=="q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0
+            accepted[name.strip().lower()] = q
+        candidates = (["br"] if brotli is not None else []) + ["gzip"]
+        candidates = [enc for enc in candidates if accepted.get(enc, accepted.get("*", 0)) > 0]
+        if not candidates:
+            return None
+        return max(candidates, key=lambda enc: accepted.get(enc, accepted.get("*", 0)))	# stable: br first on ties
+
+    def compress(self, body, accept_encoding):
+        '''
+        Return tuple (body, encoding), with body (bytes) compressed with the encoding chosen from
+        accept_encoding, or unchanged (with encoding None) if it is small or no encoding is accepted
+        '''
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        encoding = self.choose_encoding(accept_encoding)
+        if encoding is None or len(body) < self.MIN_SIZE:
+            return body, None
+        key = (hashlib.sha256(body).digest(), encoding)
+        with self.lock:
+            data = self.cache.get(key)
+            if data is not None:
+                self.cache.move_to_end(key)
+        METRICS.inc("nbif_cache_total", cache="compress", result="miss" if data is None else "hit")
+        if data is None:
+            if encoding=="br":
+                data = brotli.compress(body, quality=5)
+            else:
+                data = gzip.compress(body, compresslevel=6, mtime=0)
+            with self.lock:
+                if key not in self.cache:
+                    self.cache[key] = data
+                    self.nbytes += len(data)
+                while self.nbytes > self.max_bytes and self.cache:
+                    self.nbytes -= len(self.cache.popitem(last=False)[1])
+        return data, encoding
+
+PAGES_INDEX_FN = ".ipynb2catsoop_pages.json"	# written by ipynb2catsoop when splitting pages
+_PAGES_INDEXES = {}
+
+def read_pages_index(index_fn):
+    '''
+    Return ipynb2catsoop pages index read from index_fn (cached until the file changes), or None
+    '''
+    try:
+        mtime = os.path.getmtime(index_fn)
+    except OSError:
+        return None
+    cached = _PAGES_INDEXES.get(index_fn)
+    if cached and cached[0]==mtime:
+        return cached[1]
+    try:
+        with open(index_fn) as fp:
+            index = json.load(fp)
+    except Exception as err:
+        return None
+    _PAGES_INDEXES[index_fn] = (mtime, index)
+    return index
+
+_COURSE_INDEXES = {}
+_COURSE_INDEXES_LOCK = threading.Lock()
+
+def get_course_index(root):
+    '''
+    Return CourseIndex for the course directory root (kept open, and reopened when the index file
+    is replaced), or None if the course has no index
+    '''
+    if root is None:
+        return None
+    with _COURSE_INDEXES_LOCK:
+        index = _COURSE_INDEXES.get(root)
+        if index is not None and index.is_current():
+            return index
+        index = _COURSE_INDEXES[root] = course_index.open_index(root)	# old one is closed when unreferenced
+        return index
+
+MAX_PAGE_LABELS = 1000		# limit on the number of distinct page labels in metrics
+_PAGE_LABELS = set()
+_PAGE_LABELS_LOCK = threading.Lock()
+
+def page_label(page):
+    '''
+    Return metrics label for an existing page: the page name, or "other" once MAX_PAGE_LABELS pages
+    have been labelled, so that the number of time series stays bounded
+    '''
+    page = (page or "").strip("/")
+    with _PAGE_LABELS_LOCK:
+        if page in _PAGE_LABELS or len(_PAGE_LABELS) < MAX_PAGE_LABELS:
+            _PAGE_LABELS.add(page)
+            return page
+    return "other"
+
+PAGE_LOADS = SingleFlight()	# shared by all requests handled by this process
+PAGE_RENDERS = SingleFlight()
+METRICS = Metrics()
+COMPRESSED = CompressionCache()
 
 class catsoop_response:
     '''
     Generate response from catsoop to a given HTTP query.
     The query should specify (via URL arguments or a POST):
 
-        do = action to be taken, either "question" (default) or "auth"
+        do = action to be taken, either "question" (default), "auth", "list", "debug",
+             "auth_token" (minimal page handing the api_token to the notebook, without catsoop page rendering),
+             "ping" (check an api_token, returning JSON; requires api_token),
+             "question_json" (question prompt and metadata, as JSON),
+             "submit" (submit a response, returning JSON; requires api_token and submission), or
+             "metrics" (request counts and latencies, in Prometheus text format; staff only)
         page = page to extract question from
         csq_name = name of question to be extracted from page
     '''
+    QUESTION_JSON_KEYS = ["csq_name", "csq_display_name", "csq_prompt", "csq_initial", "csq_npoints",
+                          "csq_nsubmits", "csq_interface"]
+    ACTIONS = {"question", "auth", "auth_token", "ping", "list", "debug", "question_json", "submit", "metrics"}
+
     def __init__(self, the_context):
         '''
         the_context = catsoop context, with cs_* variables defined
@@ -38,18 +307,54 @@ class catsoop_response:
         is_admin = user_role in {'Admin', 'Instructor'}
         is_student = user_role in {'Student'}
 
+        self.is_staff = is_staff
+
         do = self.cs_form.get("do", "question")
         page = self.cs_form.get("page")
         csq_name = self.cs_form.get("csq_name")
+        if type(page)==list:
+            try:
+                page = page[0]
+                page = page.value
+            except Exception as err:
+                pass
 
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("[nbif] do=%s, course=%s, page=%s, csq_name=%s, user=%s", do, self.cs_course, page,
+                         csq_name, self.cs_username)
+        action = do if do in self.ACTIONS else "unknown"
+        self.metrics_page = "" if not page else "other"	# set to page by do_question_page, once it is found
+        t0 = time.perf_counter()
+        try:
+            self.respond(do, page, csq_name)
+        finally:		# labelled after responding, so that unknown (client-supplied) pages do not add time series
+            METRICS.inc("nbif_requests_total", action=action, page=self.metrics_page)
+            METRICS.observe("nbif_request_seconds", time.perf_counter() - t0, action=action, page=self.metrics_page)
+
+    def respond(self, do, page, csq_name):
+        '''
+        Dispatch request to the handler for the <do> action
+        '''
         if do=="auth":
             return self.do_auth()
+        if do=="auth_token":
+            return self.do_auth_token()
+        if do=="ping":
+            return self.do_ping()
+        if do=="metrics":
+            return self.do_metrics()
         if page:
             return self.do_question_page(page, csq_name, doaction=do)
 
-        self.the_context['cs_handler'] = "raw_response"
-        self.the_context['content_type'] = "text/html"
-        self.the_context['response'] = "unknown nbif action"
+        self.send_response("unknown nbif action", "text/html")
+
+    def do_metrics(self):
+        '''
+        Metrics page (staff only): request counts, cache hits, and latencies, in Prometheus text format
+        '''
+        if not self.is_staff:
+            return self.send_response("metrics are only available to staff", "text/plain", status=("403", "Forbidden"))
+        self.send_response(METRICS.prometheus_text(), "text/plain; version=0.0.4")
         
     def do_auth(self):
         '''
@@ -90,6 +395,42 @@ class catsoop_response:
             self.the_context['cs_problem_spec'] = html
         return
 
+    def do_auth_token(self):
+        '''
+        Minimal authentication page: just the script handing api_token and username to the notebook
+        (via postMessage to the parent window), or a login link if the user is not logged in.
+        Unlike do_auth, this does not render a catsoop page.
+        '''
+        api_token = self.cs_user_info.get("api_token")
+        if not self.cs_username or self.cs_username=="None" or not api_token:
+            url = f"{self.cs_url_root}/{self.cs_course}/nbif?do=auth&loginaction=login"
+            html = f"<html><body>please <a target='blank' href='{url}'>login</a></body></html>"
+        else:
+            auth = json.dumps({'api_token': api_token, 'username': self.cs_user_info.get("username")})
+            auth = auth.replace("</", "<\\/")
+            html = (f"<html><body>You have been authenticated to catsoop as {self.cs_username}"
+                    f"<script type='text/javascript'>window.parent.postMessage({auth}, '*');</script></body></html>")
+        self.send_response(html, "text/html", headers={'Cache-Control': "no-store"})
+
+    def do_ping(self):
+        '''
+        Check the form's api_token, returning JSON with ok and username; this does not load any page
+        '''
+        auth = self.authenticate_api_token()
+        if not auth['ok']:
+            return self.json_response({'ok': False, 'error': auth['error']})
+        self.json_response({'ok': True, 'username': auth['user_info']['username']})
+
+    def authenticate_api_token(self):
+        '''
+        Return catsoop user information (dict with ok, and user_info or error) for the form's api_token
+        '''
+        api_token = self.cs_form.get("api_token")
+        if not api_token:
+            return {'ok': False, 'error': "missing api_token"}
+        return self.the_context["csm_api"].get_user_information(self.the_context, api_token=api_token,
+                                                                course=self.cs_course)
+
     JS_iframe_resize = """
         console.log("hello nbif");
         var do_nbif_resize = function(){
@@ -130,6 +471,32 @@ class catsoop_response:
 
     """
 
+    def send_response(self, body, content_type, headers=None, status=("200", "OK")):
+        '''
+        Respond with body (str), compressed if the client accepts gzip or brotli (see CompressionCache).
+        The response is sent by the nbif catsoop handler (see nbif_handler), which, unlike catsoop's
+        raw_response handler, includes the Content-Encoding and Vary headers, and the HTTP status.
+
+        headers = (dict) extra HTTP headers to send with the response
+        status = (tuple) HTTP status code and message, as strings
+        '''
+        accept_encoding = (self.the_context.get("cs_env") or {}).get("HTTP_ACCEPT_ENCODING", "")
+        body, encoding = COMPRESSED.compress(body, accept_encoding)
+        headers = dict(headers or {}, Vary="Accept-Encoding")
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        self.the_context['response'] = body
+        self.the_context['nbif_headers'] = headers
+        self.the_context['nbif_status'] = status
+        self.the_context['cs_handler'] = HANDLER
+        self.the_context['content_type'] = content_type
+
+    def json_response(self, data):
+        '''
+        Respond with data (a dict), encoded as JSON
+        '''
+        self.send_response(json.dumps(data), "application/json")
+
     def do_question_page(self, page, csq_name, doaction=None):
         '''
         Display single question
@@ -138,29 +505,55 @@ class catsoop_response:
         csq_name = (str) catsoop question name -- should be unique to each question on a given page
         doaction = (str) the <do> action requested in the HTTP GET urlargs or HTTP POST form
                    If doaction is "list" then return a list of available problems on the given page.
+                   If doaction is "question_json" then return the question's prompt and metadata as JSON.
+                   If doaction is "submit" then submit the form's submission for the question, as the
+                   user owning the form's api_token, and return the result as JSON.
                    Otherwise return catsoop HTML for the specified question.
         '''
-        from catsoop import loader, tutor, dispatch
-        
-        if type(page)==list:
-            try:
-                page = page[0]
-                page = page.value
-            except Exception as err:
-                pass
+        from catsoop import tutor
 
+        requested_page = page
+        index, page_info = self.indexed_page_info(page)
+        if page_info is not None:	# page is in the course index: list its questions, or find the sub-page of the question
+            self.metrics_page = page_label(page)
+            if doaction=="list":
+                return self.json_response({'problem_names': page_info['questions']})
+            question = index.question(page, csq_name)
+            page = question['sub_page'] if question else (page_info['sub_pages'] or [page])[0]
+        else:
+            split = self.split_page_info(page)
+            if split is not None:	# page was split by ipynb2catsoop: find the sub-page with the question
+                if doaction=="list":
+                    return self.json_response({'problem_names': list(split['questions'])})
+                sub_page = split['questions'].get(csq_name)
+                if sub_page is None:
+                    matches = [v for k, v in split['questions'].items() if normalize_csq_name(k)==normalize_csq_name(csq_name)]
+                    sub_page = matches[0] if matches else split['pages'][0]['page']
+                page = sub_page
         path = [self.cs_course, page]
-        context = loader.generate_context(path)
-        context["cs_course"] = self.cs_course
-        context["cs_path_info"] = path
-        context["cs_username"] = self.cs_username
-        context["cs_user_info"] = self.cs_user_info
-        context['csq_name'] = csq_name
+        username = self.cs_username
+        user_info = self.cs_user_info
+        if doaction=="submit":	# authenticate using api_token, and act as that user
+            auth = self.authenticate_api_token()
+            if not auth['ok']:
+                return self.json_response({'ok': False, 'error': auth['error']})
+            username = auth['user_info']['username']
+            user_info = auth['user_info']
 
-        # load page into context
-        cfile = dispatch.content_file_location(context, path)
-        logging.error(f"[nbquestion] Loading course=%s, cfile=%s" % (self.cs_course, cfile) )
-        loader.load_content(context, self.cs_course, path, context, cfile)
+        # load page into context; concurrent requests for the same page by the same user share a single load
+        # (not across users: the page's cs_random is seeded per user, by tutor.init_random)
+        is_authenticated = bool(username) and username!="None"
+        role_key = ((user_info or {}).get('role'), is_authenticated)
+        user_key = username if is_authenticated else None
+        loaded, shared = PAGE_LOADS.do((self.cs_course, page, user_key, role_key),
+                                       lambda: self.load_page(path, username, user_info))
+        METRICS.inc("nbif_cache_total", cache="page_load", result="hit" if shared else "miss")
+        context = dict(loaded)
+        if any(not isinstance(elt, str) for elt in context["cs_problem_spec"]):	# page exists, with questions
+            self.metrics_page = page_label(requested_page)
+        context["cs_username"] = username
+        context["cs_user_info"] = user_info
+        context['csq_name'] = csq_name
 
         # extract the problem spec with specified csq_name
         this_problem_spec = None
@@ -171,7 +564,8 @@ class catsoop_response:
             # each elt is (problem_context, problem_kwargs)
             m = elt[1]
             problem_names.append(m['csq_name'])
-            if m['csq_name']==csq_name:
+            if m['csq_name']==csq_name or (this_problem_spec is None and csq_name is not None
+                                           and normalize_csq_name(m['csq_name'])==normalize_csq_name(csq_name)):
                 this_problem_spec = elt
 
         if doaction=="debug":
@@ -181,46 +575,130 @@ class catsoop_response:
                     html += f"<li><pre>{str(elt)[:100].replace('<','&lt;')}</pre><br/>"
                 else:
                     html += f"<li><pre>{[ str(x)[:100].replace('<','&lt;') for x in elt]}</pre><br/>"
-            self.the_context['response'] = html
-            self.the_context['cs_handler'] = "raw_response"
-            self.the_context['content_type'] = "text/html"
-            return
+            return self.send_response(html, "text/html")
 
         if doaction=="list":
-            html = json.dumps({'problem_names': problem_names})
-            self.the_context['response'] = html
-            self.the_context['cs_handler'] = "raw_response"
-            self.the_context['content_type'] = "application/json"
-            return
+            return self.json_response({'problem_names': problem_names})
+
+        if doaction in ["question_json", "submit"]:
+            if not this_problem_spec:
+                return self.json_response({'ok': False,
+                                           'error': f"question with csq_name={csq_name} in page={page} not found"})
+            if doaction=="question_json":
+                m = this_problem_spec[1]
+                question = {k: m[k] for k in self.QUESTION_JSON_KEYS if k in m}
+                question['qtype'] = this_problem_spec[0].get('qtype')
+                return self.json_response({'ok': True, 'page': page, 'question': question})
+            context['cs_problem_spec'] = [this_problem_spec]
+            context['cs_form'] = {'action': 'submit',
+                                  'names': json.dumps([csq_name]),
+                                  'data': json.dumps({csq_name: self.cs_form.get("submission", "")}),
+            }
+            res = METRICS.timed("nbif_step_seconds", lambda: tutor.handle_page(context), step="handle_page")
+            result = json.loads(res[2]) if isinstance(res, tuple) else {}
+            return self.json_response({'ok': True, 'result': result.get(csq_name, result)})
 
         if not this_problem_spec:
             html = f"question with csq_name={csq_name} in page={page} not found"
-        else:
-            context['cs_problem_spec'] = [this_problem_spec]
-            context['cs_form'] = {}
-            context["cs_footer"] = ""
-            context['cs_scripts'] += '<script type="text/javascript" src="https://cdnjs.cloudflare.com/ajax/libs/iframe-resizer/3.6.3/iframeResizer.contentWindow.min.js"></script>'
-            context['cs_scripts'] += f'<script type="text/javascript">{self.JS_iframe_resize}</script>'
-            context["cs_content_header"] = ''
-            if (not self.cs_username) or (self.cs_username=="None"):
-                 msg = 'Warning: you are not authenticated'
-                 url = f"{self.cs_url_root}/{self.cs_course}/nbif?do=auth&loginaction=login"
-                 msg += f"; please <a target='blank' href='{url}'>login</a> first."
-                 msg += f"<br/>You may also need to enable third-party cookies for {self.cs_url_root}"
-                 context["cs_content_header"] = msg
-            try:
-                cs_handle_lti_page_modifications(context)
-            except Exception as err:
-                pass
-            res = tutor.handle_page(context)
-            out = dispatch.display_page(context)  # tweak and display HTML
-            html = out[2]
-            html = html.replace('id="cs_header"', 'id="cs_header" style="display:none"')
-            html = html.replace('id="cs_top_navigation"', 'id="cs_top_navigation" style="display:none"')
-            html = html.replace('<footer>', '<footer style="display:none">')
-
-        self.the_context['response'] = html
-        self.the_context['cs_handler'] = "raw_response"
-        self.the_context['content_type'] = "text/html"
-        return
+        elif is_authenticated:
+            html = self.render_question(context, this_problem_spec)
+        else:		# pages for unauthenticated users are identical, so share concurrent renders
+            html, shared = PAGE_RENDERS.do((self.cs_course, page, csq_name, role_key),
+                                           lambda: self.render_question(context, this_problem_spec))
+            METRICS.inc("nbif_cache_total", cache="render", result="hit" if shared else "miss")
+
+        self.send_response(html, "text/html")
+
+    def course_root(self):
+        '''
+        Return filesystem location of the course directory, or None if it is not known
+        '''
+        try:
+            return self.the_context["csm_loader"].get_course_fs_location(self.the_context, self.cs_course)
+        except Exception as err:
+            return None
+
+    def indexed_page_info(self, page):
+        '''
+        Return tuple (index, page_info), with the course index and its record for page, or (None, None) if
+        the course has no index, the page is not in it, or the page file is newer than the index (e.g.
+        converted without updating the index)
+        '''
+        root = self.course_root()
+        index = get_course_index(root)
+        page_info = index.page(page) if index is not None else None
+        if page_info is None:
+            return None, None
+        try:
+            if os.path.getmtime(os.path.join(root, page_info['file'])) > index.mtime:
+                return None, None
+        except OSError:
+            return None, None
+        return index, page_info
+
+    def split_page_info(self, page):
+        '''
+        If page was split into several catsoop pages by ipynb2catsoop (see ipynb2catsoop.write_pages),
+        then return dict with its list of sub-pages (pages) and the sub-page of each question
+        (questions, keyed by csq_name), from the pages index in the page's directory; else None
+        '''
+        root = self.course_root()
+        if root is None:
+            return None
+        page = (page or "").strip("/")
+        for pdir in (page, os.path.dirname(page)):
+            index = read_pages_index(os.path.join(root, pdir, PAGES_INDEX_FN))
+            if index and page in index.get('pages', {}):
+                return {'pages': index['pages'][page], 'questions': index.get('questions', {}).get(page, {})}
+        return None
+
+    def load_page(self, path, username, user_info):
+        '''
+        Return new catsoop context with the page at path loaded into it, for the user with the
+        given username and user_info (which may differ from the cookie's user, e.g. for do=submit)
+        '''
+        from catsoop import loader, dispatch
+
+        context = loader.generate_context(path)
+        context["cs_course"] = self.cs_course
+        context["cs_path_info"] = path
+        context["cs_username"] = username
+        context["cs_user_info"] = user_info
+        cfile = dispatch.content_file_location(context, path)
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug("[nbquestion] Loading course=%s, cfile=%s", self.cs_course, cfile)
+        METRICS.timed("nbif_step_seconds", lambda: loader.load_content(context, self.cs_course, path, context, cfile),
+                      step="load_content")
+        return context
+
+    def render_question(self, context, this_problem_spec):
+        '''
+        Return catsoop HTML page with the single question this_problem_spec, rendered using context
+        '''
+        from catsoop import tutor, dispatch
+
+        context['cs_problem_spec'] = [this_problem_spec]
+        context['cs_form'] = {}
+        context["cs_footer"] = ""
+        context['cs_scripts'] += '<script type="text/javascript" src="https://cdnjs.cloudflare.com/ajax/libs/iframe-resizer/3.6.3/iframeResizer.contentWindow.min.js"></script>'
+        context['cs_scripts'] += f'<script type="text/javascript">{self.JS_iframe_resize}</script>'
+        context["cs_content_header"] = ''
+        if (not context["cs_username"]) or (context["cs_username"]=="None"):
+             msg = 'Warning: you are not authenticated'
+             url = f"{self.cs_url_root}/{self.cs_course}/nbif?do=auth&loginaction=login"
+             msg += f"; please <a target='blank' href='{url}'>login</a> first."
+             msg += f"<br/>You may also need to enable third-party cookies for {self.cs_url_root}"
+             context["cs_content_header"] = msg
+        try:
+            cs_handle_lti_page_modifications(context)
+        except Exception as err:
+            pass
+        res = METRICS.timed("nbif_step_seconds", lambda: tutor.handle_page(context), step="handle_page")
+        out = METRICS.timed("nbif_step_seconds", lambda: dispatch.display_page(context),  # tweak and display HTML
+                            step="display_page")
+        html = out[2]
+        html = html.replace('id="cs_header"', 'id="cs_header" style="display:none"')
+        html = html.replace('id="cs_top_navigation"', 'id="cs_top_navigation" style="display:none"')
+        html = html.replace('<footer>', '<footer style="display:none">')
+        return html
     
@@ -0,0 +1,16 @@
+'''
+catsoop handler for nbif responses: like catsoop's raw_response handler, but also sending the
+headers in nbif_headers (e.g. Content-Encoding, for compressed responses), with the HTTP status
+in nbif_status (default 200 OK).
+catsoop loads handlers by file path: nbif sets cs_handler to ipynb2catsoop.nbif.HANDLER
+'''
+
+def handle(context):
+    content = context["response"]
+    typ = context.get("content_type", "text/plain")
+
+    if isinstance(content, str):
+        content = content.encode("utf-8")
+    headers = {"Content-type": typ, "Content-length": str(len(content))}
+    headers.update(context.get("nbif_headers", {}))
+    return context.get("nbif_status", ("200", "OK")), headers, content
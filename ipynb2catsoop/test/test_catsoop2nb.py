@@ -0,0 +1,163 @@
+'''
+Test interface between python notebook and catsoop, using a local stand-in for the nbif page
+'''
+import json
+import unittest
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ipynb2catsoop.catsoop2nb import CatsoopInterface
+
+class NbifStandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = set()
+
+    def respond(self, form):
+        self.connections.add(self.client_address)
+        do = form.get("do")
+        if do=="question_json" and form.get("csq_name")=="sum42":
+            data = {'ok': True, 'question': {'csq_name': "sum42", 'csq_prompt': "Add 40 and 2", 'qtype': "number"}}
+        elif do=="ping" and form.get("api_token")=="tok123":
+            data = {'ok': True, 'username': "student"}
+        elif do=="submit" and form.get("api_token")=="tok123":
+            data = {'ok': True, 'result': {'score': 1 if form.get("submission")=="42" else 0}}
+        else:
+            data = {'ok': False, 'error': "bad request"}
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header("Content-type", "application/json")
+        self.send_header("Content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        query = urllib.parse.urlparse(self.path).query
+        self.respond(dict(urllib.parse.parse_qsl(query)))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-length"])).decode()
+        self.respond(dict(urllib.parse.parse_qsl(body)))
+
+    def log_message(self, *args):
+        pass
+
+class Test_catsoop_interface(unittest.TestCase):
+    def setUp(self):
+        NbifStandIn.connections = set()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), NbifStandIn)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.CIF = CatsoopInterface(urlbase=f"http://127.0.0.1:{self.server.server_port}/course")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_question(self):
+        question = self.CIF.get_question("test_problems", "sum42")
+        assert question['csq_prompt']=="Add 40 and 2"
+        with self.assertRaises(Exception):
+            self.CIF.get_question("test_problems", "nosuchquestion")
+
+    def test_submit(self):
+        with self.assertRaises(Exception):
+            self.CIF.submit("test_problems", "sum42", "42")	# not yet authenticated
+        self.CIF.set_auth("tok123", "student")
+        assert self.CIF.submit("test_problems", "sum42", "42")['score']==1
+        assert self.CIF.submit("test_problems", "sum42", "41")['score']==0
+        assert len(NbifStandIn.connections)==1		# connection kept alive between requests
+
+    def test_show_question(self):
+        url = f"{self.CIF.urlbase}/nbif?page=test_problems&csq_name=sum42"
+        html = self.CIF.show_question("test_problems", "sum42").data
+        assert f"<iframe src='{url}'" in html
+        assert "data-src" not in html
+
+        html = self.CIF.show_question("test_problems", "sum42", lazy=True).data
+        assert "window.cif_lazy_observe = " in html		# lazy loading scripts injected with first question
+        assert f"data-src='{url}'" in html
+        assert " src=" not in html.split("<iframe")[-1].split(">")[0]
+        html = self.CIF.show_question("test_problems", "sum42", lazy=True).data
+        assert "window.cif_lazy_observe = " not in html
+        assert "iframe.src = iframe.dataset.src" in html		# fallback if the scripts are gone
+        assert "iframeResizer.min.js" in html.split("lazy loading scripts are gone")[1]	# which loads the resizer
+        assert "cif_lazy_observe(iframe)" in html
+
+    def test_auth_kept_for_session(self):
+        assert 'do=auth_token' in self.CIF.do_auth().data	# no token yet: load auth iframe
+        self.CIF.set_auth("tok123", "student")
+        CIF2 = CatsoopInterface(urlbase=self.CIF.urlbase)	# e.g. notebook init cell evaluated again
+        assert CIF2.api_token=="tok123"
+        html = CIF2.do_auth().data
+        assert 'iframe' not in html
+        assert "student" in html
+        assert 'do=auth_token' in CIF2.do_auth(force=True).data
+
+        CIF2.set_auth("expired", "student")
+        assert 'do=auth_token' in CIF2.do_auth().data		# token rejected by ping
+        assert CatsoopInterface(urlbase=self.CIF.urlbase).api_token is None
+
+class Test_catsoop2ipynb(unittest.TestCase):
+    def test_split_page(self):
+        import os
+        import shutil
+        import tempfile
+        import nbformat
+        from ipynb2catsoop.catsoop2nb import catsoop2ipynb
+        cwd = os.getcwd()
+        cdir = tempfile.mkdtemp()
+        try:
+            os.chdir(cdir)
+            os.mkdir("unit1")
+            nav = '<div class="ipynb2catsoop-nav">Part 1 of 2</div>\n\n'
+            with open("unit1/content.md", 'w') as fp:
+                fp.write(nav + "# Intro\n\ntext\n\n" + nav)
+            with open("unit1/part02.md", 'w') as fp:
+                fp.write(nav + "More text\n\n<question pythoncode>\ncsq_name = 'ex1'\n</question>\n\n" + nav)
+            index = {'pages': {'unit1': [{'page': "unit1", 'file': "content.md", 'title': "Intro"},
+                                         {'page': "unit1/part02", 'file': "part02.md", 'title': "Part 2"}]},
+                     'questions': {'unit1': {'ex1': "unit1/part02"}}}
+            with open("unit1/.ipynb2catsoop_pages.json", 'w') as fp:
+                json.dump(index, fp)
+            catsoop2ipynb("unit1", "localhost", "1.01").convert()
+            with open("unit1.ipynb") as fp:
+                nb = nbformat.read(fp, as_version=4)
+            sources = [cell['source'] for cell in nb['cells']]
+            assert not any("ipynb2catsoop-nav" in src for src in sources)
+            assert any("More text" in src for src in sources)
+            assert any('CIF.show_question("unit1", "ex1")' in src for src in sources)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(cdir)
+
+    def test_course_index_names(self):
+        import os
+        import shutil
+        import tempfile
+        import nbformat
+        from ipynb2catsoop import course_index
+        from ipynb2catsoop.catsoop2nb import catsoop2ipynb
+        cwd = os.getcwd()
+        cdir = tempfile.mkdtemp()
+        try:
+            os.chdir(cdir)
+            os.mkdir("unit1")
+            with open("unit1/content.md", 'w') as fp:
+                fp.write('# Intro\n\n<question pythoncode>\ncsq_name =""""ex0"\n"""\n</question>\n')
+            records = {("page", "unit1"): {'unit': "unit1", 'notebook': "unit1/lecture.ipynb", 'file': "unit1/content.md",
+                                           'title': "Intro", 'sub_pages': ["unit1"], 'questions': ['"ex0"\n'], 'assets': []}}
+            course_index.write_index(course_index.INDEX_FN, records)
+            catsoop2ipynb("unit1", "localhost", "1.01").convert()
+            with open("unit1.ipynb") as fp:
+                nb = nbformat.read(fp, as_version=4)
+            assert any('CIF.show_question("unit1", "ex0")' in cell['source'] for cell in nb['cells'])
+
+            with open("unit1/content.md", 'w') as fp:		# question renamed, index not updated
+                fp.write('# Intro\n\n<question pythoncode>\ncsq_name = "renamed"\n</question>\n')
+            os.utime("unit1/content.md", (os.path.getmtime(course_index.INDEX_FN) + 10,) * 2)
+            catsoop2ipynb("unit1", "localhost", "1.01").convert()
+            with open("unit1.ipynb") as fp:
+                nb = nbformat.read(fp, as_version=4)
+            assert any('CIF.show_question("unit1", "renamed")' in cell['source'] for cell in nb['cells'])
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(cdir)
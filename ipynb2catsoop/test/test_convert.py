@@ -0,0 +1,359 @@
+'''
+Test conversion of ipython / jupyter notebooks to catsoop pages
+'''
+import io
+import os
+import json
+import base64
+import shutil
+import tempfile
+import unittest
+import nbformat
+from ipynb2catsoop import ipynb2catsoop, course_index
+
+try:
+    from PIL import Image
+except Exception as err:
+    Image = None
+
+try:
+    import catsoop.markdown
+except Exception as err:
+    catsoop = None
+
+def make_png(width=40, height=20):
+    out = io.BytesIO()
+    Image.new("RGB", (width, height), (255, 0, 0)).save(out, "PNG")
+    return out.getvalue()
+
+class Test_convert(unittest.TestCase):
+    def setUp(self):
+        self.course_dir = tempfile.mkdtemp()
+        self.unit_dir = f"{self.course_dir}/unit1"
+        os.mkdir(self.unit_dir)
+        self.nbfn = f"{self.unit_dir}/lecture.ipynb"
+
+    def tearDown(self):
+        shutil.rmtree(self.course_dir)
+
+    def write_notebook(self, cells):
+        nb = nbformat.v4.new_notebook()
+        nb['cells'] = cells
+        with open(self.nbfn, 'w') as fp:
+            nbformat.write(nb, fp)
+
+    def convert(self, **kwargs):
+        I2C = ipynb2catsoop.ipynb2catsoop("unit1", self.course_dir, **kwargs)
+        I2C.convert(self.nbfn)
+        with open(f"{self.unit_dir}/content.md") as fp:
+            return fp.read()
+
+    def image_cell(self, pngdata):
+        out = nbformat.v4.new_output("display_data", data={"image/png": base64.b64encode(pngdata).decode()})
+        return nbformat.v4.new_code_cell("plot()", outputs=[out])
+
+    def test_convert_basic(self):
+        self.write_notebook([nbformat.v4.new_markdown_cell("# Hello"),
+                             nbformat.v4.new_code_cell("x = 1")])
+        content = self.convert()
+        assert "# Hello" in content
+        assert "<pre>x = 1</pre>" in content
+
+    @unittest.skipIf(Image is None, "requires PIL")
+    def test_optimize_images(self):
+        self.write_notebook([self.image_cell(make_png(400, 200))])
+        content = self.convert(optimize_images=True, max_image_width=100)
+        assert 'width="100" height="50" loading="lazy"' in content
+        imfn = [x for x in os.listdir(f"{self.unit_dir}/__STATIC__") if x.startswith("img_")]
+        assert len(imfn)==1
+        mtime = os.path.getmtime(f"{self.unit_dir}/__STATIC__/{imfn[0]}")
+        content2 = self.convert(optimize_images=True, max_image_width=100)	# cached: not re-processed
+        assert content2==content
+        assert os.path.getmtime(f"{self.unit_dir}/__STATIC__/{imfn[0]}")==mtime
+
+    @unittest.skipIf(Image is None, "requires PIL")
+    def test_optimize_images_cache_written_once(self):
+        from unittest import mock
+        broken = b"\x89PNG\r\n\x1a\n" + b"\x00\x00\x00\x0dIHDR" + b"\x00\x00\x00\x10\x00\x00\x00\x08" + b"garbage"
+        self.write_notebook([self.image_cell(make_png(40 + k, 20)) for k in range(4)] + [self.image_cell(broken)])
+        with mock.patch.object(ipynb2catsoop.json, "dump", wraps=json.dump) as dump, \
+             mock.patch.object(ipynb2catsoop.json, "load", wraps=json.load) as load:
+            content = self.convert(optimize_images=True)
+            content2 = self.convert(optimize_images=True)
+        assert content2==content
+        image_cache_dumps = [c for c in dump.call_args_list if ipynb2catsoop.ipynb2catsoop.IMAGE_CACHE_FN in c.args[1].name]
+        image_cache_loads = [c for c in load.call_args_list if ipynb2catsoop.ipynb2catsoop.IMAGE_CACHE_FN in c.args[0].name]
+        assert len(image_cache_dumps)==1		# written once, at the end of the first conversion
+        assert len(image_cache_loads)==1		# read once, by the second conversion
+        assert len(json.load(open(f"{self.unit_dir}/__STATIC__/{ipynb2catsoop.ipynb2catsoop.IMAGE_CACHE_FN}")))==5
+        assert content.count("<img ")==5
+        imfns = [x for x in os.listdir(f"{self.unit_dir}/__STATIC__") if x.startswith("img_")]
+        assert any(open(f"{self.unit_dir}/__STATIC__/{fn}", 'rb').read()==broken for fn in imfns)	# undecodable: kept as is
+        assert 'width="16" height="8"' in content
+
+    @unittest.skipIf(Image is None, "requires PIL")
+    def test_optimize_images_webp(self):
+        self.write_notebook([self.image_cell(make_png())])
+        content = self.convert(optimize_images=True, image_format="webp")
+        assert '.webp" alt=' in content
+        assert 'width="40" height="20"' in content
+
+    def test_png_dimensions(self):
+        header = b"\x89PNG\r\n\x1a\n" + b"\x00\x00\x00\x0dIHDR" + b"\x00\x00\x01\x00\x00\x00\x00\x80"
+        assert ipynb2catsoop.png_dimensions(header)==(256, 128)
+        assert ipynb2catsoop.png_dimensions(b"GIF89a")==(None, None)
+
+    def test_spill_text_output(self):
+        big = "0123456789\n" * 1000
+        out = nbformat.v4.new_output("display_data", data={"text/plain": big})
+        small = nbformat.v4.new_output("display_data", data={"text/plain": "small output"})
+        self.write_notebook([nbformat.v4.new_code_cell("print(df)", outputs=[small, out])])
+        content = self.convert(max_inline_text=1000, text_preview_length=100)
+        assert "<p>small output</p>" in content
+        assert big not in content
+        assert 'href="CURRENT/cell_1_text_output_02_01.txt"' in content
+        with open(f"{self.unit_dir}/__STATIC__/cell_1_text_output_02_01.txt") as fp:
+            assert fp.read()==big
+
+    def test_custom_handlers(self):
+        self.write_notebook([nbformat.v4.new_markdown_cell("keep"),
+                             nbformat.v4.new_markdown_cell("DROP this"),
+                             nbformat.v4.new_raw_cell("raw text")])
+        I2C = ipynb2catsoop.ipynb2catsoop("unit1", self.course_dir, time_stages=True)
+        I2C.skip_rules.append(lambda cell: cell['source'].startswith("DROP"))
+        I2C.register_cell_handler("raw", lambda cnt, cell: [f"<div>{cell['source']}</div>\n\n"])
+        I2C.convert(self.nbfn)
+        with open(f"{self.unit_dir}/content.md") as fp:
+            content = fp.read()
+        assert content=="keep\n\n<div>raw text</div>\n\n"
+        assert set(I2C.stage_times)=={"source", "filter", "transform"}
+
+    def test_fast_reader(self):
+        out = nbformat.v4.new_output("display_data", data={"text/plain": "line1\nline2\n",
+                                                           "image/png": base64.b64encode(b"x" * 200).decode()})
+        self.write_notebook([nbformat.v4.new_markdown_cell("# Title\n\nsome text\n"),
+                             nbformat.v4.new_markdown_cell("colab", metadata={"id": "view-in-github"}),
+                             nbformat.v4.new_code_cell("x = 1\ny = 2\n", outputs=[out])])
+        with open(self.nbfn) as fp:
+            assert '"x = 1\\n",' in fp.read()		# source is saved as a list of lines
+        content = self.convert()
+        assert self.convert(fast_reader=True)==content
+
+    def test_shards(self):
+        self.write_notebook([nbformat.v4.new_markdown_cell("# Hello")])
+        for unit in ["unit2", "unit3", "unit4"]:
+            os.mkdir(f"{self.course_dir}/{unit}")
+            shutil.copy(self.nbfn, f"{self.course_dir}/{unit}/lecture.ipynb")
+        units = set()
+        for k in range(2):
+            I2C = ipynb2catsoop.ipynb2catsoop()
+            I2C.convert_all(self.course_dir, shard=(k, 2))
+            with open(f"{self.course_dir}/.ipynb2catsoop_shards/shard-{k}-of-2.json") as fp:
+                manifest = json.load(fp)
+            assert not (units & set(manifest['units']))
+            units |= set(manifest['units'])
+        assert units=={"unit1", "unit2", "unit3", "unit4"}
+        assert all([os.path.exists(f"{self.course_dir}/{unit}/content.md") for unit in units])
+        merged = ipynb2catsoop.ipynb2catsoop().merge_shard_manifests(self.course_dir)
+        assert set(merged['units'])==units
+        assert "unit1/content.md" in merged['units']['unit1']['outputs']
+
+        mfn = f"{self.course_dir}/.ipynb2catsoop_shards/shard-0-of-2.json"	# make unit claimed twice
+        with open(mfn) as fp:
+            manifest = json.load(fp)
+        with open(f"{self.course_dir}/.ipynb2catsoop_shards/shard-1-of-2.json") as fp:
+            manifest['units'].update(json.load(fp)['units'])
+        with open(mfn, 'w') as fp:
+            json.dump(manifest, fp)
+        with self.assertRaises(Exception):
+            ipynb2catsoop.ipynb2catsoop().merge_shard_manifests(self.course_dir)
+
+    @unittest.skipIf(catsoop is None, "requires catsoop")
+    def test_html_output(self):
+        celltext = "#csq_pythoncode\n#csq_initial\nx = 0\n#csq_soln\nx = 1\n#csq_tests\n[]\n"
+        self.write_notebook([nbformat.v4.new_markdown_cell("# Title\n\nsome *text* and $x^2$"),
+                             nbformat.v4.new_code_cell("if a<b:\n    print(a)"),
+                             nbformat.v4.new_code_cell(celltext)])
+        I2C = ipynb2catsoop.ipynb2catsoop("unit1", self.course_dir, output_format="html")
+        I2C.convert_unit(self.unit_dir)
+        with open(f"{self.unit_dir}/content.xml") as fp:
+            content = fp.read()
+        assert content.startswith("<!-- ipynb2catsoop content_hash=")
+        assert "<h1>Title</h1>" in content
+        assert "<em>text</em>" in content
+        assert "<pre>if a<b:\n    print(a)</pre>" in content
+        assert "<question pythoncode>" in content
+        assert 'csq_soln ="""x = 1\n"""' in content
+        assert not os.path.exists(f"{self.unit_dir}/content.md")
+
+    def test_cell_cache(self):
+        calls = []
+        def counting_handler(cnt, cell):
+            calls.append(cnt)
+            yield from I2C.handle_markdown_cell(cnt, cell)
+        cells = [nbformat.v4.new_markdown_cell(f"cell {k}") for k in range(5)]
+        cells.append(self.image_cell(b"\x89PNG fake image data"))
+        self.write_notebook(cells)
+        I2C = ipynb2catsoop.ipynb2catsoop("unit1", self.course_dir, cell_cache=True)
+        I2C.register_cell_handler("markdown", counting_handler)
+        I2C.convert(self.nbfn)
+        with open(f"{self.unit_dir}/content.md") as fp:
+            content = fp.read()
+        assert calls==[0, 1, 2, 3, 4]
+        assert content==self.convert()
+
+        cells[2]['source'] = "cell 2, fixed"
+        self.write_notebook(cells)
+        calls.clear()
+        I2C.convert(self.nbfn)
+        with open(f"{self.unit_dir}/content.md") as fp:
+            content = fp.read()
+        assert calls==[2]
+        assert "cell 2, fixed" in content
+        assert content==self.convert()
+
+        os.unlink(f"{self.unit_dir}/__STATIC__/cell_6_display_data_01.png")	# missing static file: re-rendered
+        I2C.convert(self.nbfn)
+        assert os.path.exists(f"{self.unit_dir}/__STATIC__/cell_6_display_data_01.png")
+        with open(f"{self.unit_dir}/.ipynb2catsoop_cells.json") as fp:
+            assert len(json.load(fp)['content.md'])==6
+
+    def test_split_pages(self):
+        cells = [nbformat.v4.new_markdown_cell("# Lecture\n\nintro")]
+        for sec in range(3):
+            cells.append(nbformat.v4.new_markdown_cell(f"## Section {sec}\n\ntext"))
+            cells += [nbformat.v4.new_code_cell(f"x = {k}") for k in range(3)]
+            cells.append(nbformat.v4.new_code_cell(f'#csq_pythoncode\n#csq_name\nex{sec}\n#csq_initial\nx\n#csq_soln\ny\n#csq_tests\n[]\n'))
+        cells.append(nbformat.v4.new_code_cell("#csq_pythoncode\n#csq_initial\nx\n#csq_soln\ny\n#csq_tests\n[]\n"))
+        self.write_notebook(cells)
+        I2C = ipynb2catsoop.ipynb2catsoop(split_heading_level=2)
+        I2C.convert_all(self.course_dir)
+        files = sorted(x for x in os.listdir(self.unit_dir) if x.endswith(".md"))
+        assert files==["content.md", "part02.md", "part03.md", "part04.md"]
+        with open(f"{self.unit_dir}/part03.md") as fp:
+            content = fp.read()
+        assert content.startswith('<div class="ipynb2catsoop-nav"><a href="CURRENT/part02">&laquo; Section 0</a> | Part 3 of 4 |')
+        assert "<pre>x = 0</pre>" in content
+        with open(f"{self.unit_dir}/part02.md") as fp:
+            assert '<a href="CURRENT">&laquo; Lecture</a>' in fp.read()
+        with open(f"{self.unit_dir}/.ipynb2catsoop_pages.json") as fp:
+            index = json.load(fp)
+        assert [p['page'] for p in index['pages']['unit1']]==["unit1", "unit1/part02", "unit1/part03", "unit1/part04"]
+        assert index['questions']['unit1']=={"ex0\n": "unit1/part02", "ex1\n": "unit1/part03", "ex2\n": "unit1/part04",
+                                             f"cell_{cells[-1]['id']}": "unit1/part04"}
+
+        I2C = ipynb2catsoop.ipynb2catsoop("unit1", self.course_dir, max_page_cells=10, force_conversion=True)
+        outputs = I2C.convert_unit(self.unit_dir)
+        assert outputs==[f"{self.unit_dir}/content.md", f"{self.unit_dir}/part02.md"]
+        assert not os.path.exists(f"{self.unit_dir}/part03.md")		# left over part removed
+        with open(f"{self.unit_dir}/part02.md") as fp:
+            assert '<a href="CURRENT">&laquo; Lecture</a> | Part 2 of 2</div>' in fp.read()
+
+        cells[4]['source'] = cells[4]['source'].replace("ex0", "renamed")
+        self.write_notebook(cells)
+        I2C = ipynb2catsoop.ipynb2catsoop("unit1", self.course_dir, force_conversion=True)	# no longer split
+        outputs = I2C.convert_unit(self.unit_dir)
+        assert outputs==[f"{self.unit_dir}/content.md"]
+        assert sorted(x for x in os.listdir(self.unit_dir) if x.endswith(".md"))==["content.md"]
+        with open(f"{self.unit_dir}/.ipynb2catsoop_pages.json") as fp:
+            assert json.load(fp)=={'pages': {}, 'questions': {}}
+        with open(f"{self.unit_dir}/content.md") as fp:
+            content = fp.read()
+        assert "ipynb2catsoop-nav" not in content
+        assert f'csq_name ="""cell_{cells[-1]["id"]}"""' in content		# same name as when split
+
+    @unittest.skipIf(Image is None, "requires PIL")
+    def test_course_index(self):
+        big = "0123456789\n" * 1000
+        out = nbformat.v4.new_output("display_data", data={"text/plain": big})
+        cells = [nbformat.v4.new_markdown_cell("# Lecture\n\nintro"), nbformat.v4.new_code_cell("print(x)", outputs=[out])]
+        for sec in range(2):
+            cells.append(nbformat.v4.new_markdown_cell(f"## Section {sec}\n\ntext"))
+            cells.append(nbformat.v4.new_code_cell(f'#csq_pythoncode\n#csq_name\nex{sec}\n#csq_initial\nx\n#csq_soln\ny\n#csq_tests\n[]\n'))
+        cells.append(nbformat.v4.new_markdown_cell('<question multiplechoice>\ncsq_name = "mc1"\ncsq_soln = "a"\n</question>'))
+        self.write_notebook(cells)
+        I2C = ipynb2catsoop.ipynb2catsoop(split_heading_level=2, max_inline_text=1000)
+        I2C.convert_all(self.course_dir)
+
+        index = course_index.CourseIndex(self.course_dir)
+        assert index.units()==["unit1"]
+        assert index.unit("unit1")=={'notebooks': ["unit1/lecture.ipynb"], 'pages': ["unit1"], 'unconverted': []}
+        page = index.page("unit1/")
+        assert page['sub_pages']==["unit1", "unit1/part02", "unit1/part03"]
+        assert page['title']=="Lecture"
+        assert page['questions']==["ex0\n", "ex1\n", "mc1"]
+        assert page['assets']==["unit1/__STATIC__/cell_2_text_output_01_01.txt"]
+        question = index.question("unit1", '"ex1"')
+        assert (question['sub_page'], question['notebook'], question['cell'], question['qtype'])==\
+            ("unit1/part03", "unit1/lecture.ipynb", 6, "pythoncode")
+        assert index.question("unit1", "mc1")['qtype']=="multiplechoice"
+        assert index.question("unit1", "nosuch") is None
+        asset = index.asset("unit1/__STATIC__/cell_2_text_output_01_01.txt")
+        assert asset['generated'] and asset['size']==len(big)
+        index.close()
+
+        stale = f"{self.unit_dir}/__STATIC__/cell_9_display_data_01.png"
+        for fn in [stale, f"{self.unit_dir}/__STATIC__/logo.png"]:
+            with open(fn, 'wb') as fp:
+                fp.write(b"png")
+        assert I2C.clean_stale_assets(self.course_dir, dry_run=True)==["unit1/__STATIC__/cell_9_display_data_01.png"]
+        assert os.path.exists(stale)
+        I2C.clean_stale_assets(self.course_dir)
+        assert not os.path.exists(stale)
+        assert sorted(os.listdir(f"{self.unit_dir}/__STATIC__"))==["cell_2_text_output_01_01.txt", "logo.png"]
+        index = course_index.CourseIndex(self.course_dir)
+        assert index.asset("unit1/__STATIC__/cell_9_display_data_01.png") is None
+        assert index.asset("unit1/__STATIC__/logo.png")['generated']==False
+
+    def test_course_index_updates(self):
+        cells = [nbformat.v4.new_markdown_cell("# Lecture")]
+        for sec in range(2):
+            cells.append(nbformat.v4.new_markdown_cell(f"## Section {sec}\n\ntext"))
+            cells.append(nbformat.v4.new_code_cell(f'#csq_pythoncode\n#csq_name\nex{sec}\n#csq_initial\nx\n#csq_soln\ny\n#csq_tests\n[]\n'))
+        cells.append(nbformat.v4.new_markdown_cell('<question multiplechoice>\ncsq_name = "ex1"\n</question>'))	# duplicate
+        self.write_notebook(cells)
+        os.mkdir(f"{self.course_dir}/unit2")
+        nb = nbformat.v4.new_notebook()
+        nb['cells'] = [nbformat.v4.new_markdown_cell('# Other\n\n<question multiplechoice>\ncsq_name = "q2"\n</question>')]
+        with open(f"{self.course_dir}/unit2/other.ipynb", 'w') as fp:
+            nbformat.write(nb, fp)
+        ipynb2catsoop.ipynb2catsoop(split_heading_level=2).convert_all(self.course_dir)
+        index = course_index.CourseIndex(self.course_dir)
+        assert index.page("unit1")['questions']==["ex0\n", "ex1\n"]
+        assert index.question("unit1", "ex1")['qtype']=="pythoncode"
+        index.close()
+
+        cells[2]['source'] = cells[2]['source'].replace("ex0", "renamed")
+        self.write_notebook(cells)
+        I2C = ipynb2catsoop.ipynb2catsoop("unit1", self.course_dir, force_conversion=True)
+        read = []
+        read_notebook = I2C.read_notebook
+        I2C.read_notebook = lambda nbfn: read.append(nbfn) or read_notebook(nbfn)
+        I2C.convert(self.nbfn)		# not split, and index updated by convert
+        assert read==[self.nbfn] * 2		# converted, and indexed; other notebooks not read
+        index = course_index.CourseIndex(self.course_dir)
+        assert index.page("unit1")['sub_pages']==["unit1"]
+        assert index.page("unit1")['questions']==["renamed\n", "ex1\n"]
+        assert index.question("unit1", "ex1")['sub_page']=="unit1"
+        assert index.question("unit1", "ex0") is None
+        assert index.question("unit2", "q2")['notebook']=="unit2/other.ipynb"	# copied from existing index
+        updated = {kind: dict(index.items(kind)) for kind in course_index.KINDS}
+        index.close()
+        ipynb2catsoop.ipynb2catsoop().write_course_index(self.course_dir)
+        index = course_index.CourseIndex(self.course_dir)
+        assert updated=={kind: dict(index.items(kind)) for kind in course_index.KINDS}	# same as full rebuild
+        index.close()
+
+    @unittest.skipIf(Image is None, "requires PIL")
+    def test_clean_assets_html(self):
+        self.write_notebook([self.image_cell(make_png())])
+        ipynb2catsoop.ipynb2catsoop(output_format="html").convert_all(self.course_dir)
+        assert os.path.exists(f"{self.unit_dir}/content.xml")
+        assert ipynb2catsoop.ipynb2catsoop().clean_stale_assets(self.course_dir)==[]	# finds content.xml
+        assert os.listdir(f"{self.unit_dir}/__STATIC__")==["cell_1_display_data_01.png"]
+
+        os.unlink(f"{self.unit_dir}/content.xml")
+        with open(f"{self.unit_dir}/__STATIC__/cell_9_display_data_01.png", 'wb') as fp:
+            fp.write(b"png")
+        assert ipynb2catsoop.ipynb2catsoop().clean_stale_assets(self.course_dir)==[]	# unit not converted: not cleaned
+        assert len(os.listdir(f"{self.unit_dir}/__STATIC__"))==2
@@ -0,0 +1,77 @@
+'''
+Test warm pre-forked interpreter pool for pythoncode grading
+'''
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import catsoop
+import catsoop.util
+from ipynb2catsoop import forkpool
+
+class Test_forkpool(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = forkpool.ForkPool(size=1, preload=["json"])
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.shutdown()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def run_script(self, code, **kwargs):
+        with open(f"{self.tmpdir}/script.py", 'w') as fp:
+            fp.write(code)
+        return self.pool.run(self.tmpdir, "script.py", **kwargs)
+
+    def test_run(self):
+        out, err = self.run_script("import sys\nprint(sys.stdin.read().upper(), 'json' in sys.modules)\n",
+                                   stdin="hello")
+        assert out=="HELLO True\n"
+        assert err==""
+
+    def test_error(self):
+        out, err = self.run_script("x = 1\nraise ValueError('bad')\n")
+        assert 'File "script.py", line 2' in err
+        assert "ValueError: bad" in err
+        assert "runpy" not in err
+
+    def test_timeout(self):
+        t0 = time.time()
+        out, err = self.run_script("print('start', flush=True)\nwhile True: pass\n", timeout=0.5)
+        assert out=="start\n"
+        assert time.time() - t0 < 3
+
+    def test_isolation(self):
+        self.run_script("import json\njson.dumps = None\n")
+        out, err = self.run_script("import json\nprint(json.dumps([1]))\n")	# each run is a fresh fork
+        assert out=="[1]\n"
+
+    def test_run_code(self):
+        context = {'cs_fs_root': os.path.dirname(catsoop.__file__), 'csm_util': catsoop.util,
+                   'csq_sandbox_dir': self.tmpdir}
+        options = {'do_rlimits': False, 'FILES': [], 'STDIN': "", 'CLOCKTIME': 5}
+        ret = forkpool.run_code(context, "_catsoop_answer = [x**2 for x in range(4)]\n", options)
+        assert ret['info']['result']==[0, 1, 4, 9]
+        assert ret['info']['complete']
+
+    def test_run_code_default_rlimits(self):
+        base_ns = {}
+        base_fn = os.path.join(os.path.dirname(catsoop.__file__), "__QTYPES__", "pythoncode", "__SANDBOXES__", "base.py")
+        with open(base_fn) as fp:
+            exec(compile(fp.read(), base_fn, "exec"), base_ns)
+        context = {'cs_fs_root': os.path.dirname(catsoop.__file__), 'csm_util': catsoop.util,
+                   'csq_sandbox_dir': self.tmpdir}
+        options = dict(base_ns['DEFAULT_OPTIONS'], CLOCKTIME=5, CPUTIME=5)	# catsoop's rlimits, incl. 32MB MEMORY
+        assert options.get("do_rlimits", True) and options['MEMORY'] > 0
+        ret = forkpool.run_code(context, "_catsoop_answer = [x**2 for x in range(4)]\n", options)	# numpy preloaded
+        assert ret['info']['result']==[0, 1, 4, 9]
+        assert ret['info']['complete']
+        ret = forkpool.run_code(context, "x = bytearray(%d)\n_catsoop_answer = 1\n" % (2 * options['MEMORY']), options)
+        assert "MemoryError" in ret['err']		# limit still applies to what the script allocates
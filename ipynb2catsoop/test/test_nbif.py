@@ -0,0 +1,282 @@
+'''
+Test parts of the nbif catsoop page which do not need a running catsoop instance
+'''
+import time
+import unittest
+import threading
+from ipynb2catsoop import nbif
+
+class Test_single_flight(unittest.TestCase):
+    def test_coalesce(self):
+        sf = nbif.SingleFlight()
+        ncalls = []
+        results = []
+        def load():
+            ncalls.append(1)
+            time.sleep(0.2)
+            return "page"
+        def request():
+            results.append(sf.do(("course", "page1"), load))
+        threads = [threading.Thread(target=request) for k in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(ncalls)==1
+        assert sorted(results)==[("page", False)] + [("page", True)] * 7
+        assert sf.do(("course", "page1"), lambda: "reloaded")==("reloaded", False)	# nothing kept
+
+    def test_error(self):
+        sf = nbif.SingleFlight()
+        def fail():
+            raise ValueError("load failed")
+        with self.assertRaises(ValueError):
+            sf.do("key", fail)
+        assert sf.in_flight=={}
+
+class Test_metrics(unittest.TestCase):
+    def test_prometheus_text(self):
+        metrics = nbif.Metrics()
+        metrics.inc("nbif_requests_total", action="list", page="p1")
+        metrics.inc("nbif_requests_total", action="list", page="p1")
+        metrics.observe("nbif_request_seconds", 0.02, action="list")
+        metrics.observe("nbif_request_seconds", 20, action="list")
+        assert metrics.timed("nbif_step_seconds", lambda: 42, step="load_content")==42
+        text = metrics.prometheus_text()
+        assert '# TYPE nbif_requests_total counter' in text
+        assert 'nbif_requests_total{action="list",page="p1"} 2' in text
+        assert 'nbif_request_seconds_bucket{action="list",le="0.01"} 0' in text
+        assert 'nbif_request_seconds_bucket{action="list",le="0.025"} 1' in text
+        assert 'nbif_request_seconds_bucket{action="list",le="+Inf"} 2' in text
+        assert 'nbif_request_seconds_count{action="list"} 2' in text
+        assert 'nbif_step_seconds_count{step="load_content"} 1' in text
+
+    def test_label_escaping(self):
+        metrics = nbif.Metrics()
+        metrics.inc("nbif_requests_total", page='a"b')
+        assert 'nbif_requests_total{page="a\\"b"} 1' in metrics.prometheus_text()
+
+class Test_compression(unittest.TestCase):
+    def test_choose_encoding(self):
+        choose = nbif.CompressionCache.choose_encoding
+        assert choose("")==None
+        assert choose("identity")==None
+        assert choose("gzip, deflate")=="gzip"
+        assert choose("gzip;q=0")==None
+        assert choose("*")==("br" if nbif.brotli else "gzip")
+        assert choose("br;q=0.5, gzip;q=1.0")=="gzip"
+
+    def test_compress_cached(self):
+        import gzip
+        cc = nbif.CompressionCache()
+        body = "<html>" + "question " * 1000 + "</html>"
+        data, encoding = cc.compress(body, "gzip")
+        assert encoding=="gzip"
+        assert gzip.decompress(data).decode()==body
+        assert len(data) < len(body) / 10
+        assert cc.compress(body, "gzip")[0] is data		# compressed only once
+        assert cc.compress("small", "gzip")==(b"small", None)
+        assert cc.compress(body, "")==(body.encode(), None)
+
+    def test_cache_size_limit(self):
+        cc = nbif.CompressionCache(max_bytes=1000)
+        for k in range(20):
+            cc.compress(f"{k} " + "x" * 10000, "gzip")
+        assert 0 < cc.nbytes <= 1000
+        assert cc.nbytes==sum(len(v) for v in cc.cache.values())
+
+    def test_send_response(self):
+        import gzip
+        from ipynb2catsoop import nbif_handler
+        response = nbif.catsoop_response.__new__(nbif.catsoop_response)
+        response.the_context = {'cs_env': {'HTTP_ACCEPT_ENCODING': "gzip, deflate"}}
+        response.json_response({'problem_names': ["q%d" % k for k in range(1000)]})
+        assert response.the_context['cs_handler']==nbif.HANDLER
+        status, headers, body = nbif_handler.handle(response.the_context)
+        assert headers['Content-Encoding']=="gzip"
+        assert headers['Content-type']=="application/json"
+        assert headers['Content-length']==str(len(body))
+        assert '"q999"' in gzip.decompress(body).decode()
+
+class Test_auth(unittest.TestCase):
+    class FakeApi:
+        def get_user_information(self, context, api_token=None, course=None):
+            if api_token=="tok123":
+                return {'ok': True, 'user_info': {'username': "student", 'api_token': api_token}}
+            return {'ok': False, 'error': "invalid api_token"}
+
+    def make_response(self, form, username="student"):
+        context = {'cs_form': form, 'cs_username': username, 'cs_course': "1.01",
+                   'cs_url_root': "https://catsoop", 'csm_api': self.FakeApi(),
+                   'cs_user_info': {'username': username, 'api_token': "tok123", 'role': "Student"}}
+        nbif.catsoop_response(context)
+        return context
+
+    def test_auth_token(self):
+        context = self.make_response({'do': "auth_token"})
+        assert context['cs_handler']==nbif.HANDLER
+        assert '"api_token": "tok123"' in context['response'].decode()
+        assert 'postMessage' in context['response'].decode()
+        assert context['nbif_headers']['Cache-Control']=="no-store"
+        context = self.make_response({'do': "auth_token"}, username="None")
+        assert 'api_token' not in context['response'].decode()
+        assert 'login' in context['response'].decode()
+
+    def test_ping(self):
+        import json
+        context = self.make_response({'do': "ping", 'api_token': "tok123"})
+        assert json.loads(context['response'])=={'ok': True, 'username': "student"}
+        context = self.make_response({'do': "ping", 'api_token': "bad"})
+        assert json.loads(context['response'])['ok']==False
+        context = self.make_response({'do': "ping"})
+        assert json.loads(context['response'])['error']=="missing api_token"
+
+    def test_metrics_staff_only(self):
+        from ipynb2catsoop import nbif_handler
+        context = self.make_response({'do': "metrics"})
+        status, headers, content = nbif_handler.handle(context)
+        assert status==("403", "Forbidden")
+        assert b"nbif_requests_total" not in content
+        context = self.make_response({'do': "metrics"})
+        context['cs_user_info']['role'] = "TA"
+        nbif.catsoop_response(context)
+        status, headers, content = nbif_handler.handle(context)
+        assert status==("200", "OK")
+        assert headers['Content-type']=="text/plain; version=0.0.4"
+
+class Test_split_pages(unittest.TestCase):
+    def setUp(self):
+        import os
+        import json
+        import tempfile
+        self.course_root = tempfile.mkdtemp()
+        os.mkdir(f"{self.course_root}/unit1")
+        index = {'pages': {'unit1': [{'page': "unit1", 'file': "content.md", 'title': "Intro"},
+                                     {'page': "unit1/part02", 'file': "part02.md", 'title': "More"}]},
+                 'questions': {'unit1': {'"ex0"\n': "unit1", 'ex1': "unit1/part02"}}}
+        with open(f"{self.course_root}/unit1/.ipynb2catsoop_pages.json", 'w') as fp:
+            json.dump(index, fp)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.course_root)
+
+    def make_response(self, form):
+        course_root = self.course_root
+        class FakeLoader:
+            def get_course_fs_location(self, context, course):
+                return course_root
+        context = {'cs_form': form, 'cs_username': "student", 'cs_course': "1.01", 'csm_loader': FakeLoader(),
+                   'cs_user_info': {'username': "student", 'role': "Student"}}
+        return nbif.catsoop_response.__new__(nbif.catsoop_response), context
+
+    def test_split_page_info(self):
+        response, context = self.make_response({})
+        response.the_context = context
+        response.cs_course = "1.01"
+        info = response.split_page_info("unit1")
+        assert [p['page'] for p in info['pages']]==["unit1", "unit1/part02"]
+        assert info['questions']['ex1']=="unit1/part02"
+        assert response.split_page_info("unit2") is None
+
+    def test_list(self):
+        import json
+        response, context = self.make_response({'do': "list", 'page': "unit1"})
+        response.__init__(context)
+        assert json.loads(context['response'])=={'problem_names': ['"ex0"\n', "ex1"]}
+
+    def test_list_from_course_index(self):
+        import os
+        import json
+        from ipynb2catsoop import course_index
+        records = {("page", "unit1"): {'unit': "unit1", 'notebook': "unit1/lecture.ipynb", 'file': "unit1/content.md",
+                                       'title': "Intro", 'sub_pages': ["unit1", "unit1/part02"],
+                                       'questions': ['"ex0"\n', "ex1", "ex2"], 'assets': []}}
+        with open(f"{self.course_root}/unit1/content.md", 'w') as fp:
+            fp.write("page")
+        os.utime(f"{self.course_root}/unit1/content.md", (0, 0))
+        course_index.write_index(f"{self.course_root}/{course_index.INDEX_FN}", records)
+        response, context = self.make_response({'do': "list", 'page': "unit1"})
+        response.__init__(context)
+        assert json.loads(context['response'])=={'problem_names': ['"ex0"\n', "ex1", "ex2"]}	# index used, not pages index
+        index = nbif.get_course_index(self.course_root)
+        assert nbif.get_course_index(self.course_root) is index		# kept open
+        records[("page", "unit1")]['questions'] = ["ex1"]
+        course_index.write_index(f"{self.course_root}/{course_index.INDEX_FN}", records)
+        assert nbif.get_course_index(self.course_root).page("unit1")['questions']==["ex1"]	# reopened when replaced
+        os.utime(f"{self.course_root}/unit1/content.md", (time.time() + 10, time.time() + 10))
+        response, context = self.make_response({'do': "list", 'page': "unit1"})
+        response.__init__(context)
+        assert json.loads(context['response'])=={'problem_names': ['"ex0"\n', "ex1"]}	# page newer than index
+
+    def test_page_load_per_user(self):
+        import json
+        import random
+        loads = []
+        def load_page(response, path, username, user_info):	# like catsoop: cs_random seeded per user and page
+            loads.append(username)
+            time.sleep(0.2)
+            rand = random.Random("___".join([username] + path))
+            return {'cs_problem_spec': [({'qtype': "pythoncode"},
+                                         {'csq_name': "ex1", 'csq_prompt': f"compute {rand.randint(0, 10**9)}"})]}
+        def prompt(username):
+            return f"compute {random.Random('___'.join([username, '1.01', 'unit2'])).randint(0, 10**9)}"
+
+        responses = {}
+        def request(username):
+            response, context = self.make_response({'do': "question_json", 'page': "unit2", 'csq_name': "ex1"})
+            context['cs_username'] = username
+            context['cs_user_info'] = {'username': username, 'role': "Student"}
+            response.__init__(context)
+            responses[username] = json.loads(context['response'])
+        saved = nbif.catsoop_response.load_page
+        try:
+            nbif.catsoop_response.load_page = load_page
+            threads = [threading.Thread(target=request, args=(username,)) for username in ["alice", "bob"]]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert sorted(loads)==["alice", "bob"]		# concurrent loads by different users are not shared
+            assert responses['alice']['question']['csq_prompt']==prompt("alice")
+            assert responses['bob']['question']['csq_prompt']==prompt("bob")
+            assert prompt("alice")!=prompt("bob")
+
+            class FakeApi:
+                def get_user_information(self, context, api_token=None, course=None):
+                    return {'ok': True, 'user_info': {'username': "carol", 'role': "Student"}}
+            response, context = self.make_response({'do': "submit", 'page': "unit2", 'csq_name': "ex9",
+                                                    'api_token': "tok"})
+            context['csm_api'] = FakeApi()
+            response.__init__(context)
+            assert loads[-1]=="carol"			# loaded as the api_token's user, not the cookie's
+        finally:
+            nbif.catsoop_response.load_page = saved
+
+    def test_metrics_page_labels(self):
+        from ipynb2catsoop import course_index
+        records = {("page", "unit1"): {'unit': "unit1", 'notebook': "unit1/lecture.ipynb", 'file': "unit1/content.md",
+                                       'title': "Intro", 'sub_pages': ["unit1"], 'questions': ["ex1"], 'assets': []}}
+        with open(f"{self.course_root}/unit1/content.md", 'w') as fp:
+            fp.write("page")
+        course_index.write_index(f"{self.course_root}/{course_index.INDEX_FN}", records)
+        response, context = self.make_response({'do': "list", 'page': "unit1"})
+        response.__init__(context)
+        response, context = self.make_response({'do': "list", 'page': "no_such_page_1234"})
+        try:
+            response.__init__(context)
+        except Exception:
+            pass
+        text = nbif.METRICS.prometheus_text()
+        assert 'nbif_requests_total{action="list",page="unit1"}' in text
+        assert 'nbif_requests_total{action="list",page="other"}' in text
+        assert "no_such_page_1234" not in text		# unknown client-supplied pages are not labels
+
+        saved = nbif.MAX_PAGE_LABELS
+        try:
+            nbif.MAX_PAGE_LABELS = len(nbif._PAGE_LABELS) + 1
+            assert nbif.page_label("unit1")=="unit1"
+            assert nbif.page_label("new_page")=="new_page"
+            assert nbif.page_label("another_page")=="other"
+        finally:
+            nbif.MAX_PAGE_LABELS = saved
@@ -94,3 +94,125 @@ def p(x):
         ret = ipynb2catsoop.pythoncode_test(self.celltext_bad, verbose=True, return_csq=False)
         print(ret)
         assert ret['score']==0
+
+    def test_validate(self):
+        import os
+        import tempfile
+        import nbformat
+        nbfn = f"{tempfile.mkdtemp()}/lecture.ipynb"
+        nb = nbformat.v4.new_notebook()
+        wrong_soln = self.celltext.replace("return (1/(np.sqrt", "return 3 + (1/(np.sqrt")
+        bad_tests = self.celltext.replace("#csq_tests\n[", "#csq_tests\n[[")
+        assert wrong_soln!=self.celltext and bad_tests!=self.celltext
+        nb['cells'] = [nbformat.v4.new_markdown_cell("# Hello"),
+                       nbformat.v4.new_code_cell(self.celltext),
+                       nbformat.v4.new_code_cell("ret = pythoncode_test(_i)"),
+                       nbformat.v4.new_code_cell(wrong_soln),
+                       nbformat.v4.new_code_cell(bad_tests)]
+        with open(nbfn, 'w') as fp:
+            nbformat.write(nb, fp)
+        I2C = ipynb2catsoop.ipynb2catsoop(course_dir=os.path.dirname(nbfn), validate_nprocs=1)
+        problems = I2C.collect_pythoncode_problems(nbfn)
+        assert [p['cell'] for p in problems]==[2, 4, 5]
+        results = I2C.validate_pythoncode_problems(problems)
+        assert [r['csq_name'] for r in results]==["exercise0", "exercise0", None]
+        assert [r['status'] for r in results]==["pass", "fail", "error"]
+        assert results[0]['soln_score']==1 and results[0]['submission_score']==1
+        assert results[1]['soln_score']==0
+        assert "csq_tests" in results[2]['msg']
+        assert all(r['time'] > 0 for r in results)
+
+    def test_kill_child_processes(self):
+        import sys
+        import subprocess
+        worker = subprocess.Popen([sys.executable, "-c", "import subprocess; "	# sandbox started like catsoop's
+                                   "p = subprocess.Popen(['sleep', '1000'], start_new_session=True); "
+                                   "print(p.pid, flush=True); print(p.wait(), flush=True)"],
+                                  stdout=subprocess.PIPE, text=True)
+        int(worker.stdout.readline())		# sandbox started
+        ipynb2catsoop.kill_child_processes(worker.pid)
+        assert int(worker.stdout.readline())==-9
+        assert worker.wait(timeout=5)==0
+
+    def test_validate_timeout(self):
+        hang = self.celltext.replace("#csq_tests\n", "#csq_tests\n__import__('time').sleep(1000) or ")
+        stuck = self.celltext.replace("#csq_tests\n", "#csq_tests\n__import__('signal').signal(14, 1) and __import__('time').sleep(1000) or ")
+        assert hang!=self.celltext and stuck!=self.celltext
+        problems = [{'nbfn': "/tmp/lecture.ipynb", 'cell': k+1, 'celltext': text}
+                    for k, text in enumerate([hang, stuck, self.celltext])]
+        I2C = ipynb2catsoop.ipynb2catsoop(course_dir="/tmp", validate_nprocs=1, validate_timeout=1)
+        I2C.VALIDATE_KILL_GRACE = 0.5
+        results = I2C.validate_pythoncode_problems(problems)
+        assert [r['status'] for r in results][:2]==["timeout", "timeout"]
+        assert "killed" in results[1]['msg']		# ignored the alarm: worker killed
+        assert results[2]['status']!="timeout"		# not held up by the hung problems
+        assert results[2]['csq_name']=="exercise0"
+        assert all(r['time'] < 5 for r in results)
+
+    def test_grade_cache(self):
+        import tempfile
+        cache = ipynb2catsoop.GradeCache(maxsize=2)
+        tests = [{'code': 'ans = p(1)', 'check_function': ipynb2catsoop.pycode_equal}]
+        key = cache.make_key("def p(x):\n    return x  \n\n", "soln", tests, "")
+        assert key==cache.make_key("def p(x):\r\n    return x\r\n", "soln", tests, "")
+        assert key!=cache.make_key("def p(x):\n  return x\n", "soln", tests, "")
+        assert key!=cache.make_key("def p(x):\n    return x\n", "soln2", tests, "")
+        assert key!=cache.make_key("def p(x):\n    return x\n", "soln", tests, "", {'sandbox': "forkpool"})
+        assert cache.make_key('s = """a\n\nb  """', "soln", tests, "")!=cache.make_key('s = """a\nb"""', "soln", tests, "")
+
+        def make_tests(checker):
+            return [{'code': 'ans = p(1)', 'check_function': checker}]
+        loose, tight = ipynb2catsoop.pycode_allclose_checker(rtol=1e-1), ipynb2catsoop.pycode_allclose_checker(rtol=1e-9)
+        assert cache.make_key("x", "soln", make_tests(loose), "")!=cache.make_key("x", "soln", make_tests(tight), "")
+        assert cache.make_key("x", "soln", make_tests(loose), "")==\
+            cache.make_key("x", "soln", make_tests(ipynb2catsoop.pycode_allclose_checker(rtol=1e-1)), "")
+        def check(sub, soln):
+            return 1
+        key1 = cache.make_key("x", "soln", make_tests(check), "")
+        def check(sub, soln):		# redefined, e.g. by re-evaluating a notebook cell
+            return sub==soln
+        assert key1!=cache.make_key("x", "soln", make_tests(check), "")
+
+        outcome = {'cacheable': True}
+        checker = ipynb2catsoop.GradeCache.watch_checker(lambda sub, soln: 1, outcome)
+        assert checker({'err': "", 'details': {'complete': True}}, {'err': "", 'details': {'complete': True}})==1
+        assert outcome=={'cacheable': True, 'checks': 1}
+        checker({'err': "", 'details': {'complete': False}}, {'err': "", 'details': {'complete': True}})	# timed out
+        assert outcome['cacheable']==False
+        cache.put("a", {'score': 1})
+        cache.put("b", {'score': 0})
+        assert cache.get("a")=={'score': 1}
+        cache.put("c", {'score': 1})		# evicts b, the least recently used
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+
+        cache_dir = tempfile.mkdtemp()
+        ipynb2catsoop.GradeCache(cache_dir=cache_dir).put(key, {'score': 1, 'msg': "ok"})
+        assert ipynb2catsoop.GradeCache(cache_dir=cache_dir).get(key)=={'score': 1, 'msg': "ok"}
+
+    def test_do_submit_cached(self):
+        assert ipynb2catsoop.ipynb2catsoop().grade_cache is None		# off by default
+        I2C = ipynb2catsoop.ipynb2catsoop(grade_cache_size=16)
+        parameters = I2C.celltext_to_parameters_pythoncode(self.celltext)
+        key = I2C.grade_cache.make_key(parameters['csq_submission'], parameters['csq_soln'],
+                                       parameters['csq_tests'], "")
+        I2C.grade_cache.put(key, {'score': 1, 'msg': "cached"})
+        ret = I2C.do_submit(verbose=False, **parameters)
+        assert ret=={'score': 1, 'msg': "cached"}
+
+    def test_pycode_allclose(self):
+        import numpy as np
+        soln = repr([np.float64(x) for x in np.linspace(0, 1, 100000)])
+        assert ipynb2catsoop.pycode_allclose({'result': soln}, {'result': soln})==(1.0, "")
+        sub = repr([x * (1 + 1e-9) for x in np.linspace(0, 1, 100000)])
+        assert ipynb2catsoop.pycode_allclose(sub, soln)[0]==1.0
+        assert ipynb2catsoop.pycode_equal(sub, soln)==False
+        score, msg = ipynb2catsoop.pycode_allclose("[0.1, 0.25, 0.3, 0.5]", "[0.1, 0.2, 0.3, 0.4]")
+        assert score==0
+        assert "first mismatch at index 1: got 0.25, expected 0.2" in msg
+        assert ipynb2catsoop.pycode_allclose("[[1, 2], [3, 5]]", "[[1, 2], [3, 4]]")[1].endswith("index (1, 1): got 5, expected 4")
+        assert ipynb2catsoop.pycode_allclose("[1, 2]", "[1, 2, 3]")[0]==0
+        assert ipynb2catsoop.pycode_allclose("None", "[1, 2]")[0]==0
+        check = ipynb2catsoop.pycode_allclose_checker(rtol=0.1)
+        assert check("[1.05, 2]", "array([1., 2.])")[0]==1.0
+        assert ipynb2catsoop.pycode_allclose("[1.05, 2]", "array([1., 2.])")[0]==0
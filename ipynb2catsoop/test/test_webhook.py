@@ -0,0 +1,88 @@
+'''
+Test bulk webhook trigger, using local HTTP stand-ins for catsoop servers
+'''
+import json
+import time
+import unittest
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ipynb2catsoop import webhook
+
+class GitreloadStandIn(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        server = self.server
+        payload = json.loads(self.rfile.read(int(self.headers["Content-length"])))
+        with server.lock:
+            server.connections.add(self.client_address)
+            server.requests.append((self.path, payload, self.headers.get("X-GitHub-Event")))
+            server.active += 1
+            server.max_active = max(server.max_active, server.active)
+            nfail = server.fail_counts.get(self.path, 0)
+            if nfail:
+                server.fail_counts[self.path] = nfail - 1
+        time.sleep(server.delay.get(self.path, 0.05))
+        with server.lock:
+            server.active -= 1
+        status = server.status.get(self.path, 200) if not nfail else 503
+        body = json.dumps({'all': {'stdout': f"updated {self.path}"}}).encode()
+        try:
+            self.send_response(status)
+            self.send_header("Content-type", "application/json")
+            self.send_header("Content-length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:		# client gave up (timeout)
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+class Test_webhook(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), GitreloadStandIn)
+        self.server.lock = threading.Lock()
+        self.server.connections = set()
+        self.server.requests = []
+        self.server.active = self.server.max_active = 0
+        self.server.fail_counts = {}
+        self.server.delay = {}
+        self.server.status = {}
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_push(self):
+        self.server.fail_counts["/flaky/"] = 2
+        self.server.status["/missing/"] = 404
+        self.server.delay["/slow/"] = 2
+        targets = [f"{self.base}/r{k}/" for k in range(6)] + [f"{self.base}/{x}/" for x in ["flaky", "missing", "slow"]]
+        payload = {'ref': "a/b/master", 'repository': {'name': "ipynb"}, 'deleted': False}
+        report = webhook.push_webhooks(targets, payload, headers={'X-GitHub-Event': "push"}, concurrency=3,
+                                       retries=2, backoff=0.05, timeout=5, host_timeouts={"127.0.0.1": 0.5})
+        results = {r['url'][len(self.base):]: r for r in report}
+        assert [r['url'] for r in report]==targets
+        for k in range(6):
+            assert results[f"/r{k}/"]['ok']
+            assert results[f"/r{k}/"]['response']['all']['stdout']==f"updated /r{k}/"
+        assert results["/flaky/"]['ok'] and results["/flaky/"]['attempts']==3
+        assert not results["/missing/"]['ok']
+        assert results["/missing/"]['attempts']==1		# 4xx is not retried
+        assert results["/missing/"]['status']==404
+        assert not results["/slow/"]['ok']
+        assert results["/slow/"]['attempts']==3
+        assert "timeout" in results["/slow/"]['error']
+        assert self.server.max_active <= 3
+        assert self.server.requests[0][1]==payload
+        assert self.server.requests[0][2]=="push"
+        assert len(self.server.connections) < len(self.server.requests)	# connections reused
+
+    def test_connection_error(self):
+        report = webhook.push_webhooks(["http://127.0.0.1:1/gitreload/"], {}, retries=1, backoff=0.01)
+        assert report[0]['ok']==False
+        assert report[0]['attempts']==2
+        assert report[0]['status'] is None
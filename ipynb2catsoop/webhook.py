@@ -0,0 +1,228 @@
+'''
+Send github-like webhook updates to many catsoop servers at once, e.g. to trigger an ipynb2catsoop
+conversion update on each of a fleet of catsoop replicas.
+
+This uses asyncio, with a pool of keep-alive HTTP/1.1 connections per host (and a single shared
+TLS context), a limit on the number of concurrent requests, retries with exponential backoff for
+connection errors, timeouts, and 5xx / 429 responses, and per-host timeouts.  The result is a
+report with the status of every target:
+
+    from ipynb2catsoop.webhook import push_webhooks
+    report = push_webhooks(["https://replica1/gitreload/", "https://replica2/gitreload/"],
+                           payload, headers={'X-GitHub-Event': 'push'})
+'''
+import ssl
+import json
+import time
+import random
+import asyncio
+import threading
+import urllib.parse
+from collections import defaultdict
+
+class HTTPError(Exception):
+    pass
+
+class ConnectionPool:
+    '''
+    Pool of keep-alive HTTP/1.1 connections, kept per (scheme, host, port), for use within one event loop
+    '''
+    def __init__(self, verify=True, max_idle_per_host=4):
+        '''
+        verify = (bool) if False, then TLS certificates are not verified
+        max_idle_per_host = (int) maximum number of idle connections kept for each host
+        '''
+        self.ssl_context = ssl.create_default_context()
+        if not verify:
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.max_idle_per_host = max_idle_per_host
+        self.idle = defaultdict(list)
+        self.nconnections = 0		# number of connections opened
+
+    async def acquire(self, key, reuse=True):
+        '''
+        Return tuple (conn, reused), with conn an idle (reader, writer) connection for key (if reuse
+        is set and there is one), else a new connection
+        '''
+        scheme, host, port = key
+        while reuse and self.idle[key]:
+            reader, writer = self.idle[key].pop()
+            if not (writer.is_closing() or reader.at_eof()):
+                return (reader, writer), True
+            writer.close()
+        self.nconnections += 1
+        conn = await asyncio.open_connection(host, port, ssl=self.ssl_context if scheme=="https" else None,
+                                             server_hostname=host if scheme=="https" else None)
+        return conn, False
+
+    def release(self, key, conn, reusable):
+        reader, writer = conn
+        if reusable and len(self.idle[key]) < self.max_idle_per_host:
+            self.idle[key].append(conn)
+        else:
+            writer.close()
+
+    async def close(self):
+        for conns in self.idle.values():
+            for reader, writer in conns:
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except Exception:
+                    pass
+        self.idle.clear()
+
+    async def request(self, method, url, body=b"", headers=None, timeout=10):
+        '''
+        Make HTTP request, returning tuple (status, headers, body), with headers a dict with
+        lower-case keys.  Raises asyncio.TimeoutError if the request takes longer than timeout seconds.
+        '''
+        return await asyncio.wait_for(self._request(method, url, body, headers or {}), timeout)
+
+    async def _request(self, method, url, body, headers):
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme or "http"
+        port = parts.port or (443 if scheme=="https" else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {parts.netloc}", f"Content-Length: {len(body)}",
+                 "Connection: keep-alive"]
+        lines += [f"{k}: {v}" for k, v in headers.items()]
+        data = ("\r\n".join(lines) + "\r\n\r\n").encode() + body
+
+        conn, reused = await self.acquire(key)
+        reusable = False
+        try:
+            reader, writer = conn
+            writer.write(data)
+            await writer.drain()
+            status_line = await reader.readline()
+            if not status_line and reused:	# idle connection was closed by the server: use a new one
+                self.release(key, conn, False)
+                conn, reused = await self.acquire(key, reuse=False)
+                reader, writer = conn
+                writer.write(data)
+                await writer.drain()
+                status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionError(f"connection to {parts.netloc} closed")
+            try:
+                status = int(status_line.split()[1])
+            except Exception:
+                raise HTTPError(f"bad HTTP status line {status_line[:100]!r}")
+            rheaders = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                k, _, v = line.decode("latin-1").partition(":")
+                rheaders[k.strip().lower()] = v.strip()
+            if rheaders.get("transfer-encoding", "").lower()=="chunked":
+                rbody = b""
+                while True:
+                    size = int((await reader.readline()).split(b";")[0], 16)
+                    if size==0:
+                        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                            pass
+                        break
+                    rbody += await reader.readexactly(size)
+                    await reader.readexactly(2)
+                reusable = True
+            elif "content-length" in rheaders:
+                rbody = await reader.readexactly(int(rheaders["content-length"]))
+                reusable = True
+            else:
+                rbody = await reader.read()
+            if rheaders.get("connection", "").lower()=="close":
+                reusable = False
+            return status, rheaders, rbody
+        finally:
+            self.release(key, conn, reusable)
+
+async def push_webhooks_async(targets, payload, headers=None, concurrency=10, retries=3, backoff=0.5, timeout=10,
+                              host_timeouts=None, verify=True, pool=None):
+    '''
+    POST payload (as JSON) to each of the target URLs, concurrently, and return report: a list with a
+    dict for each target, giving url, ok (True if a 2xx response was received), status (HTTP status,
+    or None), attempts, time (seconds), error (str, or None), and response (decoded JSON, or text).
+
+    targets = (list) URLs to send the webhook update to
+    payload = (dict) JSON payload
+    headers = (dict) extra HTTP headers
+    concurrency = (int) maximum number of requests in progress at once
+    retries = (int) number of retries after a connection error, timeout, or 5xx or 429 response
+    backoff = (float) delay in seconds before the first retry; doubled (with jitter) for each further retry
+    timeout = (float) timeout in seconds for each request
+    host_timeouts = (dict) timeouts for specific hosts (keyed by hostname), overriding timeout
+    verify = (bool) if False, then TLS certificates are not verified
+    pool = (ConnectionPool) connection pool to use (a new pool, closed at the end, if None)
+    '''
+    body = json.dumps(payload).encode()
+    headers = dict({'Content-Type': "application/json"}, **(headers or {}))
+    semaphore = asyncio.Semaphore(concurrency)
+    own_pool = pool is None
+    pool = pool or ConnectionPool(verify=verify)
+
+    async def push(url):
+        result = {'url': url, 'ok': False, 'status': None, 'attempts': 0, 'time': 0, 'error': None, 'response': None}
+        host_timeout = (host_timeouts or {}).get(urllib.parse.urlsplit(url).hostname, timeout)
+        t0 = time.monotonic()
+        for attempt in range(retries + 1):
+            if attempt:
+                await asyncio.sleep(backoff * 2 ** (attempt - 1) * random.uniform(1, 1.5))
+            result['attempts'] += 1
+            try:
+                async with semaphore:
+                    status, rheaders, rbody = await pool.request("POST", url, body, headers, timeout=host_timeout)
+            except asyncio.TimeoutError:
+                result['error'] = f"timeout after {host_timeout} seconds"
+                continue
+            except (OSError, HTTPError, asyncio.IncompleteReadError, ValueError) as err:
+                result['error'] = f"{type(err).__name__}: {err}"
+                continue
+            result['status'] = status
+            text = rbody.decode(errors="replace")
+            try:
+                result['response'] = json.loads(text)
+            except ValueError:
+                result['response'] = text
+            if 200 <= status < 300:
+                result['ok'] = True
+                result['error'] = None
+                break
+            result['error'] = f"HTTP status {status}"
+            if not (status >= 500 or status==429):
+                break
+        result['time'] = time.monotonic() - t0
+        return result
+
+    try:
+        return list(await asyncio.gather(*[push(url) for url in targets]))
+    finally:
+        if own_pool:
+            await pool.close()
+
+def push_webhooks(targets, payload, **kwargs):
+    '''
+    Synchronous version of push_webhooks_async (with the same arguments); this also works when called
+    from within a running event loop (e.g. in a jupyter notebook), by running in a separate thread
+    '''
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(push_webhooks_async(targets, payload, **kwargs))
+    ret = {}
+    def run():
+        try:
+            ret['report'] = asyncio.run(push_webhooks_async(targets, payload, **kwargs))
+        except BaseException as err:
+            ret['error'] = err
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    if 'error' in ret:
+        raise ret['error']
+    return ret['report']